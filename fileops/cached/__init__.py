@@ -1 +1,3 @@
+from ._plane_cache import PlaneCache, plane_cache_dir
+from .cached_image_file import CachedImageFile
 from .intermediate_step import cached_step
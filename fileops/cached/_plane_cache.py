@@ -0,0 +1,197 @@
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Hashable, Iterable, Tuple, Union
+
+import numpy as np
+
+from fileops.logger import get_logger
+from fileops.pathutils import ensure_dir
+
+log = get_logger(name='plane_cache')
+
+MEMORY_BYTES = 1 << 30  # default budget of the memory tier
+DISK_BYTES = 16 << 30  # default budget of the disk tier
+
+
+def plane_cache_dir() -> Path:
+    """ Folder of the disk tier of plane caches; it can be set through the FILEOPS_CACHE_DIR environment variable. """
+    base = os.environ.get('FILEOPS_CACHE_DIR', Path.home() / '.cache' / 'fileops')
+    return Path(base) / 'planes'
+
+
+def source_identity(paths: Union[Path, Iterable[Path]], *extra) -> str:
+    """
+    Hash of the absolute path, size and modification time of the files of a source, so that editing any of them gives
+    the source a new identity.
+    """
+    paths = [paths] if isinstance(paths, (str, Path)) else list(paths)
+    stats = [(str(Path(p).absolute()), os.stat(p).st_size, os.stat(p).st_mtime_ns) for p in paths]
+    return hashlib.sha1(repr((*stats, *extra)).encode()).hexdigest()
+
+
+class _MemoryTier:
+    """ Least recently used arrays, bounded by the bytes they take; arrays can be stored compressed with zlib. """
+
+    def __init__(self, max_bytes: int, compress=False):
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Union[None, np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+        if not self.compress:
+            return entry
+        data, dtype, shape = entry
+        return np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape)
+
+    def put(self, key: Hashable, image: np.ndarray):
+        if self.compress:
+            entry = (zlib.compress(np.ascontiguousarray(image).data, 1), image.dtype, image.shape)
+            size = len(entry[0])
+        else:
+            entry = np.array(image)
+            entry.flags.writeable = False
+            size = entry.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._size(self._entries.pop(key))
+            self._entries[key] = entry
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= self._size(evicted)
+
+    def _size(self, entry) -> int:
+        return len(entry[0]) if self.compress else entry.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+class _DiskTier:
+    """
+    Arrays stored as .npy files in a folder shared by all sources, read back as memory maps.
+    When the files take more than max_bytes, the least recently used ones are removed. There is one tier per folder
+    in a process (see _disk_tier), so that the budget holds for all the caches that use the folder.
+    """
+
+    def __init__(self, folder: Path, max_bytes: int):
+        self.folder = ensure_dir(Path(folder))
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # files by time of last use; files written by other processes are counted when they are first read
+        files = [(e.stat().st_mtime_ns, Path(e.path), e.stat().st_size) for e in os.scandir(self.folder)
+                 if e.name.endswith('.npy') and not e.name.startswith('.')]
+        self._files = OrderedDict((path, size) for _, path, size in sorted(files))
+        self.nbytes = sum(self._files.values())
+
+    def _path(self, key: Hashable) -> Path:
+        return self.folder / f"{hashlib.sha1(repr(key).encode()).hexdigest()}.npy"
+
+    def _touch(self, path: Path, size: int):
+        """ Accounts path as the most recently used file, and evicts the least recently used ones over budget. """
+        with self._lock:
+            self.nbytes += size - self._files.pop(path, 0)
+            self._files[path] = size
+            while self.nbytes > self.max_bytes and len(self._files) > 1:
+                evicted, evicted_size = self._files.popitem(last=False)
+                self.nbytes -= evicted_size
+                try:
+                    os.remove(evicted)
+                except OSError:
+                    pass
+
+    def get(self, key: Hashable) -> Union[None, np.ndarray]:
+        path = self._path(key)
+        try:
+            image = np.load(path, mmap_mode='r')
+            os.utime(path)
+            size = path.stat().st_size
+        except (OSError, ValueError):
+            return None
+        self._touch(path, size)
+        return image
+
+    def put(self, key: Hashable, image: np.ndarray):
+        path = self._path(key)
+        tmp_path = path.with_name(f".{path.stem}.{os.getpid()}.{threading.get_ident()}.npy")
+        try:
+            np.save(tmp_path, image)
+            os.replace(tmp_path, path)
+            size = path.stat().st_size
+        except OSError as e:
+            log.warning(f"Could not write {path} into the plane cache: {e}")
+            return
+        self._touch(path, size)
+
+
+_disk_tiers: Dict[Path, _DiskTier] = dict()
+_disk_tiers_lock = threading.Lock()
+
+
+def _disk_tier(folder: Union[str, Path], max_bytes: int) -> _DiskTier:
+    """ Disk tier of a folder, shared by every cache of the process; its budget is the smallest one asked for. """
+    folder = Path(ensure_dir(Path(folder))).resolve()
+    with _disk_tiers_lock:
+        tier = _disk_tiers.get(folder)
+        if tier is None:
+            tier = _disk_tiers[folder] = _DiskTier(folder, max_bytes)
+        tier.max_bytes = min(tier.max_bytes, max_bytes)
+        return tier
+
+
+class PlaneCache:
+    """
+    Two tier cache of the planes of an image file, and of products derived from them, keyed by the identity of the
+    source and a key of the plane (e.g. series, row of the plane table and region).
+    Arrays are looked up in a memory tier of least recently used arrays first, and then in a tier of files on disk;
+    arrays found on disk are brought back into memory.
+    """
+
+    def __init__(self, identity: str, memory_bytes: int = MEMORY_BYTES, compress=False,
+                 disk_bytes: int = DISK_BYTES, cache_dir: Union[None, str, Path] = None):
+        self.identity = identity
+        self.memory = _MemoryTier(memory_bytes, compress=compress)
+        self.disk = _disk_tier(plane_cache_dir() if cache_dir is None else cache_dir, disk_bytes) \
+            if disk_bytes > 0 else None
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def get(self, key: Tuple) -> Union[None, np.ndarray]:
+        """ Cached array of key, read-only, or None. """
+        key = (self.identity, *key)
+        image = self.memory.get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+        image = self.disk.get(key) if self.disk is not None else None
+        if image is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self.memory.put(key, image)
+        return image
+
+    def put(self, key: Tuple, image: np.ndarray):
+        key = (self.identity, *key)
+        self.memory.put(key, image)
+        if self.disk is not None:
+            self.disk.put(key, image)
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'memory_bytes': self.memory.nbytes, 'disk_bytes': self.disk.nbytes if self.disk is not None else 0}
@@ -0,0 +1,154 @@
+from pathlib import Path
+from typing import Dict, Tuple, Union
+
+import numpy as np
+
+from fileops.cached._plane_cache import DISK_BYTES, MEMORY_BYTES, PlaneCache, source_identity
+from fileops.image import ImageFile
+from fileops.image._projection import PROJECTIONS
+from fileops.image.factory import load_image_file
+from fileops.image.imagemeta import MetadataImage
+from fileops.logger import get_logger
+
+
+class CachedImageFile:
+    """
+    Wraps an image file with a two tier cache (see PlaneCache) of its planes and, with cache_results, of the
+    z-projections made from them, so that planes read once are then taken from memory or from local disk.
+    Planes are cached as they are in the file, before the transforms of the file are applied; anything that isn't
+    defined here is taken from the wrapped file.
+    """
+    log = get_logger(name='CachedImageFile')
+    _own_attributes = ('image_file', 'cache_results', 'cache', '_metadata')
+
+    def __init__(self, image_file: Union[ImageFile, str, Path], cache_results=True, memory_bytes=MEMORY_BYTES,
+                 compress=False, disk_bytes=DISK_BYTES, cache_dir: Union[None, str, Path] = None, **kwargs):
+        """
+        :param image_file: An image file, or the path of one to open with load_image_file (along with kwargs).
+        :param cache_results: Whether to cache z-projections besides planes.
+        :param memory_bytes: Budget of the memory tier.
+        :param compress: Whether to compress the planes held in memory, which fits more planes into the budget at
+            the cost of decompressing them on every read.
+        :param disk_bytes: Budget of the disk tier, which is shared by all the cached files; 0 disables it.
+        :param cache_dir: Folder of the disk tier; see plane_cache_dir for the default.
+        """
+        if not isinstance(image_file, ImageFile):
+            path = Path(image_file)
+            image_file = load_image_file(path, **kwargs)
+            if image_file is None:
+                raise FileNotFoundError(f"Could not open an image file reader for {path}.")
+        self.image_file = image_file
+        self.cache_results = cache_results
+        # every file of multi-file acquisitions is part of the identity, so that rewriting any of them is noticed
+        self.cache = PlaneCache(source_identity(image_file._source_files(), type(image_file).__name__),
+                                memory_bytes=memory_bytes, compress=compress, disk_bytes=disk_bytes,
+                                cache_dir=cache_dir)
+        image_file.plane_cache = self.cache
+        self._metadata: Dict[Tuple, MetadataImage] = dict()
+
+    def __getattr__(self, name):
+        if name == 'image_file':
+            raise AttributeError(name)
+        return getattr(self.image_file, name)
+
+    def __setattr__(self, name, value):
+        # settings such as transforms belong to the wrapped file
+        if name in self._own_attributes:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.image_file, name, value)
+
+    def __repr__(self):
+        return f"CachedImageFile({self.image_file!r})"
+
+    def image(self, ix: int, roi=None) -> MetadataImage:
+        """ Plane at row ix of the plane table, or its region roi, as returned by ImageFile.image. """
+        f = self.image_file
+        ix = int(ix)
+        bounds = f._read_bounds(roi)
+        key = (f._series, ix, bounds)
+        md = self._metadata.get(key)
+        if md is None:
+            if self.cache.get(key) is None:
+                # the first read of the plane fills both the cache and its metadata
+                mdimg = f._image_roi(ix, bounds)
+                self.cache.put(key, mdimg.image)
+                md = self._metadata[key] = mdimg._replace(image=None, intensity_range=None)
+            else:
+                md = self._plane_metadata(ix)
+        image = f._read_plane(ix, bounds)
+        return md._replace(image=image, width=image.shape[1], height=image.shape[0],
+                           intensity_range=f._intensity_range(image))
+
+    def _plane_metadata(self, ix: int) -> MetadataImage:
+        """
+        Metadata of a plane that is in the cache but hasn't been read in this session, taken from the plane table
+        (timestamps are in seconds, which may differ from the units of some readers).
+        """
+        f = self.image_file
+        plane = f.planes[ix]
+        t = int(plane['t'])
+        timestamp = float(plane['timestamp'])
+        if not np.isfinite(timestamp):
+            timestamp = f.timestamps[t] if f.timestamps and t < len(f.timestamps) else None
+        return MetadataImage(reader=type(f).__name__, image=None,
+                             pix_per_um=f.pix_per_um, um_per_pix=f.um_per_pix, time_interval=f.time_interval,
+                             timestamp=timestamp, frame=t, channel=int(plane['c']), z=int(plane['z']),
+                             width=None, height=None, intensity_range=None)
+
+    def _results_key(self, *key) -> Union[None, Tuple]:
+        # products of files with transforms depend on the transforms, which can't be keyed
+        if not self.cache_results or self.image_file.transforms is not None:
+            return None
+        return ('result', self.image_file._series, *key)
+
+    def z_projections(self, frame: int, channel: int, projections=PROJECTIONS, as_8bit=False,
+                      n_workers: int = None, roi=None) -> Dict[str, np.ndarray]:
+        """ Projections along the z axis of a frame and channel (see ImageFile.z_projections), cached one by one. """
+        f = self.image_file
+        bounds = f._read_bounds(roi)
+        keys = {p: self._results_key('z', frame, channel, p, as_8bit, bounds) for p in projections}
+        out = dict()
+        if all(k is not None for k in keys.values()):
+            out = {p: self.cache.get(k) for p, k in keys.items()}
+            out = {p: img for p, img in out.items() if img is not None}
+        missing = [p for p in projections if p not in out]
+        if missing:
+            computed = f.z_projections(frame, channel, projections=missing, as_8bit=as_8bit, n_workers=n_workers,
+                                       roi=roi)
+            for p, img in computed.items():
+                if keys[p] is not None:
+                    self.cache.put(keys[p], img)
+            out.update(computed)
+        return {p: out[p] for p in projections}
+
+    def z_projection(self, frame: int, channel: int, projection='max', as_8bit=False, n_workers: int = None,
+                     roi=None) -> MetadataImage:
+        im_proj = self.z_projections(frame, channel, projections=(projection,), as_8bit=as_8bit,
+                                     n_workers=n_workers, roi=roi)[projection]
+        return MetadataImage(reader='MaxProj',
+                             image=im_proj,
+                             pix_per_um=self.pix_per_um, um_per_pix=self.um_per_pix,
+                             frame=frame, timestamp=None, time_interval=None,
+                             channel=channel, z=None,
+                             width=im_proj.shape[1], height=im_proj.shape[0],
+                             intensity_range=self.image_file._intensity_range(im_proj))
+
+    def z_projection_series(self, channel: int, projection='max', frame='all', as_8bit=False,
+                            n_workers: int = None, roi=None) -> np.ndarray:
+        """ Projections along the z axis of the frames of a channel (see ImageFile.z_projection_series). """
+        f = self.image_file
+        frames = f.frames if frame == 'all' else list(frame)
+        bounds = f._read_bounds(roi)
+        keys = [self._results_key('z', fr, channel, projection, as_8bit, bounds) for fr in frames]
+        cached = [self.cache.get(k) if k is not None else None for k in keys]
+        missing = [fr for fr, img in zip(frames, cached) if img is None]
+        if missing:
+            computed = iter(f.z_projection_series(channel, projection=projection, frame=missing, as_8bit=as_8bit,
+                                                  n_workers=n_workers, roi=roi))
+            for k, (key, img) in enumerate(zip(keys, cached)):
+                if img is None:
+                    cached[k] = next(computed)
+                    if key is not None:
+                        self.cache.put(key, cached[k])
+        return np.stack(cached)
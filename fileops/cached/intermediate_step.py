@@ -1,49 +1,317 @@
+import functools
+import hashlib
 import os
 import pickle
+import re
+import socket
+import time
+import types
+from pathlib import Path
+from typing import Iterable, Union
+
+import numpy as np
+import pandas as pd
 
 from fileops.logger import get_logger
 from fileops.pathutils import ensure_dir
 
 log = get_logger(name='cached_ops')
 
+CACHE_MAX_BYTES = int(os.environ.get('FILEOPS_STEP_CACHE_BYTES', 32 << 30))  # budget of every cache folder
+LOCK_TIMEOUT = 6 * 3600  # seconds after which the lock of a step is considered left behind by a killed job
+
+_FORMATS = ('npy', 'parquet', 'pkl')
+_entry_re = re.compile(r'^.+-[0-9a-f]{20}\.(npy|parquet|pkl)$')
+_MISS = object()  # result of a lookup that found nothing in the cache, as steps may return None
+
+
+def _hash_function(h, function):
+    """
+    Feeds the identity and code of a function into the hash h, along with the values its closure captured, the object
+    of bound methods and the arguments of partial functions.
+    """
+    if isinstance(function, functools.partial):
+        h.update(b"partial")
+        _hash_function(h, function.func)
+        _hash_value(h, function.args)
+        _hash_value(h, function.keywords)
+        return
+    h.update(f"{getattr(function, '__module__', '')}.{getattr(function, '__qualname__', repr(function))}".encode())
+    bound_to = getattr(function, '__self__', None)
+    if bound_to is not None and not isinstance(bound_to, types.ModuleType):
+        _hash_value(h, bound_to)
+    code = getattr(function, '__code__', None)
+    if code is not None:
+        h.update(code.co_code)
+        _hash_value(h, [c for c in code.co_consts if isinstance(c, (str, bytes, int, float, tuple))])
+        for cell in getattr(function, '__closure__', None) or []:
+            try:
+                captured = cell.cell_contents
+            except ValueError:  # not assigned yet
+                continue
+            if captured is not function:
+                _hash_value(h, captured)
+
+
+def _hash_value(h, value):
+    """
+    Feeds value into the hash h; arrays and data frames are hashed by content. Objects can define their own key
+    through a __fileops_key__ method (image files are keyed by their path, series and transforms); anything else must
+    be picklable, as keys made from the address of an object would change from one call to the next.
+    """
+    key = getattr(value, '__fileops_key__', None)
+    if callable(key) and not isinstance(value, type):
+        h.update(f"key{type(value).__name__}".encode())
+        _hash_value(h, key())
+    elif isinstance(value, (list, tuple)):
+        h.update(f"{type(value).__name__}{len(value)}".encode())
+        for v in value:
+            _hash_value(h, v)
+    elif isinstance(value, dict):
+        h.update(f"dict{len(value)}".encode())
+        for k in sorted(value, key=repr):
+            _hash_value(h, k)
+            _hash_value(h, value[k])
+    elif isinstance(value, np.ndarray):
+        h.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+        h.update(np.ascontiguousarray(value).data if value.dtype != object else pickle.dumps(value))
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        h.update(f"{type(value).__name__}{value.shape}{list(getattr(value, 'columns', [value.name]))}".encode())
+        h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, Path):
+        h.update(f"Path{value.absolute()}".encode())
+    else:
+        try:
+            h.update(pickle.dumps(value, protocol=4))
+        except Exception as e:
+            if callable(value) and hasattr(value, '__code__'):
+                # lambdas and nested functions
+                _hash_function(h, value)
+                return
+            raise TypeError(f"Can't make a cache key out of an argument of type {type(value).__name__}; "
+                            f"pass something picklable or define its __fileops_key__ method.") from e
+
+
+def _input_files(args, kwargs, input_files: Iterable) -> list:
+    """ Files that the step reads: paths among the arguments that exist, and the ones given in input_files. """
+    candidates = [a for a in (*args, *kwargs.values()) if isinstance(a, (str, Path))] + list(input_files or [])
+    files = list()
+    for c in candidates:
+        try:
+            if os.path.isfile(c):
+                files.append(Path(c).absolute())
+        except (TypeError, ValueError, OSError):
+            pass
+    return sorted(set(files))
+
 
-def cached_step(filename, function, *args, cache_folder=None, override_cache=False, **kwargs):
+def step_key(function, args, kwargs, input_files: Iterable = None) -> str:
+    """
+    Key of a call of function: a hash of the identity and code of the function, of the arguments, and of the size and
+    modification time of the files it reads, so that editing any of them invalidates cached results.
+    """
+    h = hashlib.sha1()
+    _hash_function(h, function)
+    _hash_value(h, args)
+    _hash_value(h, kwargs)
+    for f in _input_files(args, kwargs, input_files):
+        st = os.stat(f)
+        h.update(f"{f}{st.st_size}{st.st_mtime_ns}".encode())
+    return h.hexdigest()[:20]
+
+
+class _StepLock:
+    """
+    Lock file next to the cached result of a step, so that concurrent workers compute the step only once.
+    The lock holds the host and process id of its owner; locks of processes of this host that are no longer running
+    are broken right away, and other ones once they are older than timeout.
+    """
+
+    def __init__(self, path: Path, timeout=LOCK_TIMEOUT, poll=0.5):
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+
+    def __enter__(self):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, f"{socket.gethostname()}:{os.getpid()}".encode())
+                os.close(fd)
+                return self
+            except FileExistsError:
+                try:
+                    if self._owner_is_dead() or time.time() - os.stat(self.path).st_mtime > self.timeout:
+                        log.warning(f"Removing stale lock {self.path}.")
+                        os.remove(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(self.poll)
+
+    def _owner_is_dead(self) -> bool:
+        """ Whether the lock was taken by a process of this host that is no longer running. """
+        try:
+            with open(self.path) as f:
+                host, _, pid = f.read().rpartition(':')
+            pid = int(pid)
+        except (OSError, ValueError):
+            # gone, or still being written by its owner
+            return False
+        if os.name != 'posix' or host != socket.gethostname():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # running under another user
+            pass
+        return False
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _find(base: Path) -> Union[None, Path]:
+    for ext in _FORMATS:
+        path = base.with_name(f"{base.name}.{ext}")
+        if path.exists():
+            return path
+    return None
+
+
+def _load(path: Path):
+    if path.suffix == '.npy':
+        # copy on write, so that callers can modify the array without touching the cache
+        return np.load(path, mmap_mode='c', allow_pickle=False)
+    if path.suffix == '.parquet':
+        return pd.read_parquet(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _load_cached(base: Path, filename):
+    """ Cached result of the step stored under base, or _MISS; unreadable results are deleted. """
+    output_path = _find(base)
+    if output_path is None:
+        return _MISS
+    log.debug(f"Loading object {filename} from cache (path={output_path}).")
+    try:
+        obj = _load(output_path)
+        os.utime(output_path)
+        return obj
+    except (pickle.UnpicklingError, EOFError, OSError, ValueError) as e:
+        log.error(e)
+        log.info("Deleting file")
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
+        return _MISS
+
+
+def _save(base: Path, obj) -> Path:
+    """ Writes obj in the native format of its type, through a temporary file that is renamed once complete. """
+    tmp = base.with_name(f".{base.name}.{os.getpid()}.tmp")
+    try:
+        if isinstance(obj, np.ndarray) and obj.dtype != object:
+            with open(tmp, 'wb') as f:
+                np.save(f, obj, allow_pickle=False)
+            ext = 'npy'
+        else:
+            ext = 'pkl'
+            if isinstance(obj, pd.DataFrame):
+                try:
+                    obj.to_parquet(tmp)
+                    ext = 'parquet'
+                except (ImportError, ValueError, TypeError) as e:
+                    # no parquet engine installed, or columns that parquet can't store
+                    log.debug(f"Storing data frame as a pickle: {e}")
+            if ext == 'pkl':
+                with open(tmp, 'wb') as f:
+                    pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        path = base.with_name(f"{base.name}.{ext}")
+        os.replace(tmp, path)
+        for other in _FORMATS:
+            # results of a previous run stored in another format
+            if other != ext and base.with_name(f"{base.name}.{other}").exists():
+                os.remove(base.with_name(f"{base.name}.{other}"))
+        return path
+    finally:
+        if tmp.exists():
+            os.remove(tmp)
+
+
+def _evict(cache_folder: Path, max_bytes: int):
+    """ Removes the least recently used results of the cache folder until they take less than max_bytes. """
+    entries = list()
+    for e in os.scandir(cache_folder):
+        if _entry_re.match(e.name):
+            st = e.stat()
+            entries.append((max(st.st_atime, st.st_mtime), st.st_size, e.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            log.debug(f"Evicted {path} from the cache.")
+        except OSError:
+            pass
+
+
+def cached_step(filename, function, *args, cache_folder=None, override_cache=False, input_files=None,
+                max_cache_bytes=CACHE_MAX_BYTES, **kwargs):
     """
     Calls function with arguments args & kwargs and stores result in a file in the cache_folder folder.
-    If the file is already in the folder, it loads the result instead.
+    If the result is already in the folder, it loads the result instead.
+
+    Results are keyed by the function (and its code), the arguments and the size and modification time of the files
+    that it reads (see step_key), and stored next to each other under filename. Arrays are stored as .npy files and
+    reloaded as memory maps, data frames as parquet files when a parquet engine is installed, and anything else is
+    pickled. Concurrent calls of the same step wait for the first one to store its result instead of computing it
+    again.
 
-    :param filename: Name of the file to store the result.
+    :param filename: Name of the file to store the result; the key of the call is appended to it.
     :param function: Function to call.
     :param args: Position arguments to pass to the function.
     :param cache_folder: Folder to store the output of function.
     :param override_cache: Flag to overwrite the file in case it already exists.
+    :param input_files: Files read by function besides the ones passed as arguments, whose changes invalidate the
+        result.
+    :param max_cache_bytes: Size of the cache folder over which the least recently used results are removed.
     :param kwargs: Keyword arguments to pass to the function.
     :return: The (cached) object calculated by the function.
     """
-    cache_folder = ensure_dir(os.path.abspath("") if cache_folder is None else cache_folder)
-    output_path = os.path.join(cache_folder, filename)
-    if not os.path.exists(output_path) or override_cache:
-        log.debug(f"Generating data for step that calls function {function.__name__}.")
+    cache_folder = Path(ensure_dir(os.path.abspath("") if cache_folder is None else cache_folder))
+    name = Path(filename).stem if Path(filename).suffix in ('.pkl', '.npy', '.parquet') else Path(filename).name
+    base = cache_folder / f"{name}-{step_key(function, args, kwargs, input_files=input_files)}"
+
+    if not override_cache:
+        # results are renamed into place once complete, so they can be read without holding the lock
+        obj = _load_cached(base, filename)
+        if obj is not _MISS:
+            return obj
+
+    with _StepLock(base.with_name(f".{base.name}.lock")):
+        # another worker may have computed the step while this one waited for the lock
+        obj = _MISS if override_cache else _load_cached(base, filename)
+        if obj is not _MISS:
+            return obj
+
+        log.debug(f"Generating data for step that calls function {getattr(function, '__name__', function)}.")
         out = function(*args, **kwargs)
-        log.debug(f"Saving object {filename} in cache (path={output_path}).")
         try:
-            with open(output_path, 'wb') as f:
-                pickle.dump(out, f)
-        except IOError as e:
-            log.error(e)
-        return out
-    else:
-        log.debug(f"Loading object {filename} from cache (path={output_path}).")
-        try:
-            with open(output_path, 'rb') as f:
-                obj = pickle.load(f)
-        except (pickle.UnpicklingError, EOFError) as e:
+            output_path = _save(base, out)
+            log.debug(f"Saved object {filename} in cache (path={output_path}).")
+        except (IOError, pickle.PicklingError, AttributeError, TypeError) as e:
             log.error(e)
+            return out
 
-            log.info("Deleting file")
-            f.close()
-            os.remove(output_path)
-
-            log.info("Re-trying calculation")
-            obj = function(*args, **kwargs)
-        return obj
+    _evict(cache_folder, max_cache_bytes)
+    return out
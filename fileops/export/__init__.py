@@ -1,3 +1,5 @@
 from ._bioformats import bioformats_to_ndarray_zstack_timeseries, bioformats_to_ndarray_zstack, bioformats_to_tiffseries
+from ._bioformats import bioformats_zstack_timeseries_range, bioformats_iter_zstack_timeseries
 # from ._openvdb import export_paraview
 # from ._vtk import export_vtk
+from ._zarr import export_ome_zarr
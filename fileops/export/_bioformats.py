@@ -1,127 +1,223 @@
+import json
 import os.path
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from itertools import takewhile
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import Dict, Iterator, List, Tuple, Union
 
 import numpy as np
 from matplotlib import pyplot as plt
 from tifffile import imwrite, imread
 
-from fileops.image._bleach_correction import photobleach_correct, bleach_func
+from fileops.image._bleach_correction import bleach_func, fit_photobleach
 from fileops.pathutils import ensure_dir
 from fileops.export.config import ExportConfig
 from fileops.image import OMEImageFile
+from fileops.image import ImageFile
+from fileops.image.to_8bit import histogram_limits, to_8bit
 from fileops.image.exceptions import FrameNotFoundError
 from fileops.logger import get_logger
 
 log = get_logger(name='export')
 
 
-def bioformats_to_tiffseries(cfg_struct: ExportConfig, save_path=Path('_vol_paraview'), until_frame=np.inf) -> Tuple[
-    np.array, Dict]:
+def _volume_stats(volume: np.ndarray) -> Dict:
+    """
+    Minimum, maximum, sum, mean and standard deviation of a volume, accumulated plane by plane in one pass.
+    The variance of every plane is taken around its own mean and merged into the running one (Chan et al.), which keeps
+    its precision on 16 bit data.
+    """
+    vmin, vmax, total = np.inf, -np.inf, 0.0
+    n, mean, m2 = 0, 0.0, 0.0
+    for plane in volume:
+        plane = plane.astype(np.float64).ravel()
+        k, plane_mean = plane.size, plane.mean()
+        centered = plane - plane_mean
+        delta = plane_mean - mean
+        mean += delta * k / (n + k)
+        m2 += np.dot(centered, centered) + delta ** 2 * n * k / (n + k)
+        n += k
+        vmin, vmax = min(vmin, plane.min()), max(vmax, plane.max())
+        total += plane.sum()
+    return {"min": float(vmin), "max": float(vmax), "sum": float(total), "mean": float(mean),
+            "std": float(np.sqrt(m2 / n))}
+
+
+def _output_dtype(img_struct: ImageFile, channel: int) -> np.dtype:
+    """ Data type of the planes of a channel as they are returned by the file, with its transforms applied. """
+    rows = img_struct.planes.rows(c=channel)
+    if len(rows) == 0:
+        raise FrameNotFoundError(f"no planes of channel {channel} in the file.")
+    return img_struct.image(int(rows[0])).image.dtype
+
+
+def _export_tiff_volume(img_struct: ImageFile, channel: int, frame: int, roi, shape: Tuple[int, ...],
+                        fpath: Path, compression=None, read_lock: threading.Semaphore = None,
+                        keep_volume=False, dtype=np.uint16) -> Tuple[Union[None, np.ndarray], Dict]:
+    """
+    Writes the z-stack of a channel and frame into fpath, together with its statistics in a json file next to it.
+    If the volume was written in a previous run, its statistics are read back instead. The volume is only returned
+    with keep_volume, so that finished jobs hold nothing but their statistics; reads are made holding read_lock.
+    """
+    stats_path = fpath.with_suffix('.json')
+    if os.path.exists(fpath) and os.path.exists(stats_path):
+        log.debug(f"skipping file {fpath.as_posix()}")
+        with open(stats_path) as f:
+            return None, json.load(f)
+
+    if os.path.exists(fpath):
+        # written by a version that didn't save the statistics
+        image = imread(fpath)
+    else:
+        log.debug(f"Attempting to save image {fpath.name} in path={fpath}.")
+        image = np.zeros(shape, dtype=dtype)
+        try:
+            with read_lock if read_lock is not None else nullcontext():
+                _read_zstack(img_struct, frame, channel, roi, image)
+        except (FrameNotFoundError, IndexError):
+            log.error(f"Frame index corresponding to c={channel} t={frame} not found (file corrupted?)")
+        tmp_path = fpath.with_name(f".{fpath.name}")
+        # ImageJ hyperstacks only hold 8 and 16 bit integers and 32 bit floats
+        imwrite(tmp_path, image, imagej=image.dtype in (np.uint8, np.uint16, np.float32), metadata={'order': 'ZXY'},
+                compression=compression)
+        os.replace(tmp_path, fpath)
+
+    stats = _volume_stats(image)
+    with open(stats_path, "w") as f:
+        json.dump(stats, f)
+    return image if keep_volume else None, stats
+
+
+def bioformats_to_tiffseries(cfg_struct: ExportConfig, save_path=Path('_vol_paraview'), until_frame=np.inf,
+                             n_workers=4, compression=None, correct_photobleaching=False) -> Tuple[np.array, Dict]:
+    """
+    Exports every frame of the configured channels as a TIFF volume, optionally compressed (e.g. compression='zlib'
+    or 'zstd'). Volumes are read and written by a pool of n_workers threads, with at most max_read_workers of the
+    image file reading at the same time, and only a few volumes in flight. Their statistics are computed while each
+    volume is still in memory and saved next to it, so that volumes written in a previous run are never read back.
+    The volume returned is the last one, if it was written in this run.
+
+    With correct_photobleaching, the photobleaching model of the file (see ImageFile.correct_photobleaching) is
+    fitted, or loaded from the metadata index, and volumes are corrected as they are read. The parameters of the model
+    of every channel are returned under 'photobleach_params' and plotted next to the volumes.
+    """
     log.info("Exporting bioformats file to series of tiff file volumes.")
     save_path = ensure_dir(save_path)
 
-    dct = dict()
     img_struct = cfg_struct.image_file
-    image = np.empty(shape=(len(img_struct.zstacks), img_struct.width, img_struct.height), dtype=np.uint16)
-    for j, c in enumerate(cfg_struct.channels):
-        print(f"{j=} {c=}")
-        dct[f"ch{c:01d}"] = {
-            "files":  [],
-            "minmax": [],
-            "sum":    [],
-            "mean":   [],
-            "std":    [],
-        }
+    if correct_photobleaching and img_struct.photobleach_correction is None:
+        img_struct.correct_photobleaching()
+    shape = (len(img_struct.zstacks), *img_struct.plane_shape(cfg_struct.roi))
+    dtypes = {c: _output_dtype(img_struct, c) for c in cfg_struct.channels}
+    frames = list(takewhile(lambda fr: fr <= until_frame, cfg_struct.frames))
+    # readers that are not thread safe are read from one thread at a time, while writes still run in parallel
+    read_lock = threading.BoundedSemaphore(max(1, min(n_workers, img_struct.max_read_workers)))
+
+    dct = dict()
+    jobs = list()
+    for c in cfg_struct.channels:
+        dct[f"ch{c:01d}"] = {"files": [], "minmax": [], "sum": [], "mean": [], "std": []}
         ensure_dir(save_path / f"ch{c:01d}")
-        for fr in cfg_struct.frames:
-            if fr > until_frame:
-                break
+        for fr in frames:
+            fpath = (save_path / f"ch{c:01d}" / f'C{c:02d}T{fr:04d}_vol.tiff').absolute()
+            dct[f"ch{c:01d}"]["files"].append(fpath.as_posix())
+            jobs.append((c, fr, fpath))
 
-            fname = f'C{c:02d}T{fr:04d}_vol.tiff'
-            fpath = (save_path / f"ch{c:01d}" / fname).absolute()
+    image = None
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        in_flight = deque()
 
-            dct[f"ch{c:01d}"]["files"].append(fpath.as_posix())
+        def _collect():
+            nonlocal image
+            c, fr, future = in_flight.popleft()
+            vol, stats = future.result()
+            image = vol if vol is not None else image
+            dct[f"ch{c:01d}"]["minmax"].append((stats["min"], stats["max"]))
+            dct[f"ch{c:01d}"]["sum"].append(stats["sum"])
+            dct[f"ch{c:01d}"]["mean"].append(stats["mean"])
+            dct[f"ch{c:01d}"]["std"].append(stats["std"])
+            if fr == frames[-1]:
+                log.info(f"Channel {c} exported.")
 
-            log.debug(f"Attempting to save image {fname} in path={fpath}.")
-            if not os.path.exists(fpath):
-                for i, z in enumerate(img_struct.zstacks):
-                    try:
-                        ix = img_struct.ix_at(c=j, z=z, t=fr)
-                        mdimg = img_struct.image(ix)
-                        if mdimg and hasattr(mdimg, "image") and mdimg.image is not None:
-                            image[i, :, :] = mdimg.image
-                    except FrameNotFoundError or IndexError as e:
-                        print(f"Frame index corresponding to  c={j} z={z} t={fr} not found (file corrupted?)")
-                imwrite(fpath, np.array(image), imagej=True, metadata={'order': 'ZXY'})
-            else:
-                print(f"skipping file {fpath.as_posix()}")
-                image = imread(fpath)
-            # add stats
-            dct[f"ch{c:01d}"]["minmax"].append((np.min(image), np.max(image)))
-            dct[f"ch{c:01d}"]["std"].append(np.std(image))
-            dct[f"ch{c:01d}"]["mean"].append(np.mean(image))
-            dct[f"ch{c:01d}"]["sum"].append(np.mean(image))
-
-        agg_intensities = np.array(dct[f"ch{c:01d}"]["mean"])
-        xdata = np.array(range(len(agg_intensities)))
-        pbparms = photobleach_correct(agg_intensities)
-
-        dct[f"ch{c:01d}"]["photobleach_params"] = pbparms
-
-        # --------------------------------------------------------------------------------------------------------------
-        #  Plot the curve fit with de-trended data
-        # --------------------------------------------------------------------------------------------------------------
-        f = plt.figure()
-        ax = f.gca()
-        ax.scatter(xdata, agg_intensities, c='b', label='Mean Intensity')
-
-        dtrend = int(dct[f"ch{c:01d}"]['mean'][0] - pbparms[2]) - int(pbparms[0]) * np.exp(
-            -np.round(pbparms[1], 4) * xdata)
-        ax.scatter(xdata, agg_intensities + dtrend, c='k', label='Corrected Intensity')
-
-        ax.plot(xdata, bleach_func(xdata, *pbparms), 'r-',
-                label='fit: a=%5.3f, b=%5.3f, c=%5.3f' % tuple(pbparms))
-        ax.plot(xdata, dtrend, 'y-', label='Values Added')
-        ax.text(0.7, .1, r"$f(x)=a \cdot e^{-b \cdot x} +c$", color="k", fontsize=10, transform=ax.transAxes)
-
-        ax.set_xlabel('Frame')
-        ax.set_ylabel('Avg. Intensity [au]')
-        ax.legend()
-        f.savefig(save_path / f'ch{c:01d}_photobleach.pdf')
+        for k, (c, fr, fpath) in enumerate(jobs):
+            in_flight.append((c, fr, executor.submit(_export_tiff_volume, img_struct, c, fr, cfg_struct.roi, shape,
+                                                     fpath, compression=compression, read_lock=read_lock,
+                                                     keep_volume=k == len(jobs) - 1, dtype=dtypes[c])))
+            if len(in_flight) >= 2 * n_workers:
+                _collect()
+        while in_flight:
+            _collect()
+
+    if frames:
+        for c, pbparms in zip(cfg_struct.channels, _photobleach_params(img_struct, dct, cfg_struct.channels, frames)):
+            dct[f"ch{c:01d}"]["photobleach_params"] = pbparms
+            _plot_photobleach(dct, c, frames, save_path)
 
     return image, dct
 
 
+def _photobleach_params(img_struct: ImageFile, dct: Dict, channels: List[int], frames: List[int]) -> np.ndarray:
+    """
+    Parameters of the photobleaching model of every channel: the ones of the correction set on the file if it has one
+    for the whole field, or else a single fit of the mean intensities of all the exported channels at once.
+    """
+    correction = img_struct.photobleach_correction
+    if correction is not None and correction.tiles == (1, 1) and all(c in correction.channels for c in channels):
+        return np.stack([correction.params[correction.channels.index(c), 0, 0] for c in channels])
+    means = np.stack([dct[f"ch{c:01d}"]["mean"] for c in channels])
+    return fit_photobleach(means, x=np.asarray(frames))
+
+
+def _plot_photobleach(dct: Dict, c: int, frames: List[int], save_path: Path):
+    agg_intensities = np.array(dct[f"ch{c:01d}"]["mean"])
+    xdata = np.asarray(frames)
+    pbparms = dct[f"ch{c:01d}"]["photobleach_params"]
+
+    # --------------------------------------------------------------------------------------------------------------
+    #  Plot the curve fit with de-trended data
+    # --------------------------------------------------------------------------------------------------------------
+    f = plt.figure()
+    ax = f.gca()
+    ax.scatter(xdata, agg_intensities, c='b', label='Mean Intensity')
+
+    dtrend = int(dct[f"ch{c:01d}"]['mean'][0] - pbparms[2]) - int(pbparms[0]) * np.exp(
+        -np.round(pbparms[1], 4) * xdata)
+    ax.scatter(xdata, agg_intensities + dtrend, c='k', label='Corrected Intensity')
+
+    ax.plot(xdata, bleach_func(xdata, *pbparms), 'r-',
+            label='fit: a=%5.3f, b=%5.3f, c=%5.3f' % tuple(pbparms))
+    ax.plot(xdata, dtrend, 'y-', label='Values Added')
+    ax.text(0.7, .1, r"$f(x)=a \cdot e^{-b \cdot x} +c$", color="k", fontsize=10, transform=ax.transAxes)
+
+    ax.set_xlabel('Frame')
+    ax.set_ylabel('Avg. Intensity [au]')
+    ax.legend()
+    f.savefig(save_path / f'ch{c:01d}_photobleach.pdf')
+    plt.close(f)
+
+
 def bioformats_to_ndarray_zstack(img_struct: OMEImageFile, roi=None, channel=0, frame=0):
     log.info("Exporting bioformats file to a single ndarray representing a z-stack volume.")
 
     if roi is not None:
         log.debug("Processing ROI definition that is in configuration file")
-        w = abs(roi.right - roi.left)
-        h = abs(roi.top - roi.bottom)
-        x0 = int(roi.left)
-        y0 = int(roi.top)
-        x1 = int(x0 + w)
-        y1 = int(y0 + h)
     else:
         log.debug("No ROI definition in configuration file")
-        w = img_struct.width
-        h = img_struct.height
-        x0 = 0
-        y0 = 0
-        x1 = w
-        y1 = h
-
-    image = np.empty(shape=(len(img_struct.zstacks), h, w), dtype=np.uint16)
+    # only the region of the ROI is read from the file
+    h, w = img_struct.plane_shape(roi)
+
+    image = np.empty(shape=(len(img_struct.zstacks), h, w), dtype=_output_dtype(img_struct, channel))
     for i, z in enumerate(img_struct.zstacks):
         log.debug(f"c={channel}, z={z}, t={frame}")
         ix = img_struct.ix_at(c=channel, z=z, t=frame)
-        mdimg = img_struct.image(ix)
-        image[i, :, :] = mdimg.image[y0:y1, x0:x1]
+        mdimg = img_struct.image(ix, roi=roi)
+        image[i, :, :] = mdimg.image
 
     # convert to 8 bit data
-    image = ((image - image.min()) / (image.ptp() / 255.0)).astype(np.uint8)
+    image = to_8bit(image, image.min(), image.max())
 
     return image
 
@@ -135,38 +231,86 @@ def bioformats_to_ndarray_zstack_timeseries(img_struct: OMEImageFile, frames: Li
 
     if roi is not None:
         log.debug("Processing ROI definition that is in configuration file")
-        w = abs(roi.right - roi.left)
-        h = abs(roi.top - roi.bottom)
-        x0 = int(roi.left)
-        y0 = int(roi.top)
-        x1 = int(x0 + w)
-        y1 = int(y0 + h)
     else:
         log.debug("No ROI definition in configuration file")
-        w = img_struct.width
-        h = img_struct.height
-        x0 = 0
-        y0 = 0
-        x1 = w
-        y1 = h
-
-    image = np.empty(shape=(len(frames), len(img_struct.zstacks), h, w), dtype=np.uint16)
+    # only the region of the ROI is read from the file
+    h, w = img_struct.plane_shape(roi)
+
+    dtype = _output_dtype(img_struct, channel)
+    image = np.empty(shape=(len(frames), len(img_struct.zstacks), h, w), dtype=dtype)
     try:
         for i, frame in enumerate(frames):
-            img_z = np.empty(shape=(len(img_struct.zstacks), h, w), dtype=np.uint16)
+            img_z = np.empty(shape=(len(img_struct.zstacks), h, w), dtype=dtype)
             for j, z in enumerate(img_struct.zstacks):
                 log.debug(f"c={channel}, z={z}, t={frame}")
                 ix = img_struct.ix_at(c=channel, z=z, t=frame)
-                mdimg = img_struct.image(ix)
-                img_z[j, :, :] = mdimg.image[y0:y1, x0:x1]
+                mdimg = img_struct.image(ix, roi=roi)
+                img_z[j, :, :] = mdimg.image
 
             # assign volume into timeseries numpy array
             image[i, :, :, :] = img_z
     except (FrameNotFoundError, IndexError):
-        print("FrameNotFoundError or IndexError")
+        log.error(f"Frame index corresponding to c={channel} t={frame} not found (file corrupted?)")
     # convert to 8 bit data and normalize intensities across whole timeseries
     # image = exposure.equalize_hist(image)
     # image = exposure.rescale_intensity(image)
-    image = ((image - image.min()) / (image.ptp() / 255.0)).astype(np.uint8)
-    print(image.dtype)
+    image = to_8bit(image, image.min(), image.max())
     return image
+
+
+def _read_zstack(img_struct: ImageFile, frame: int, channel: int, roi, out: np.ndarray) -> np.ndarray:
+    ix = img_struct.planes.rows_grid(t=frame, c=channel, z=img_struct.zstacks)[0, 0, 0]
+    out[:] = 0
+    img_struct.read_planes(ix, out, roi=roi)
+    return out
+
+
+def bioformats_zstack_timeseries_range(img_struct: ImageFile, frames: List[int], roi=None, channel=0,
+                                       percentiles: Union[None, Tuple[float, float]] = None) -> Tuple[float, float]:
+    """
+    First pass of the streaming export of a timeseries of z-stacks: reads one volume at a time and returns the global
+    intensity range, either (min, max) or the given pair of percentiles. Percentiles are computed exactly from a
+    histogram of the intensities, so they are only available for integer data of up to 16 bits.
+    """
+    h, w = img_struct.plane_shape(roi)
+    first = img_struct.image(img_struct.planes.rows(c=channel)[0]).image
+    volume = np.zeros((len(img_struct.zstacks), h, w), dtype=first.dtype)
+    if percentiles is not None and (volume.dtype.kind not in 'ui' or volume.dtype.itemsize > 2):
+        log.warning(f"Percentiles can't be computed on {volume.dtype} data; using the minimum and maximum instead.")
+        percentiles = None
+
+    vmin, vmax = np.inf, -np.inf
+    histogram = None
+    offset = -int(np.iinfo(volume.dtype).min) if volume.dtype.kind == 'i' else 0
+    for frame in frames:
+        _read_zstack(img_struct, frame, channel, roi, volume)
+        if percentiles is None:
+            vmin, vmax = min(vmin, volume.min()), max(vmax, volume.max())
+        else:
+            counts = np.bincount(volume.ravel().astype(np.int64) + offset, minlength=1 << (8 * volume.dtype.itemsize))
+            histogram = counts if histogram is None else histogram + counts
+    if percentiles is not None:
+        vmin, vmax = histogram_limits(histogram, percentiles=percentiles, offset=offset)
+
+    log.info(f"Intensity range of channel {channel} over {len(frames)} frames is [{vmin}, {vmax}].")
+    return float(vmin), float(vmax)
+
+
+def bioformats_iter_zstack_timeseries(img_struct: ImageFile, frames: List[int], vmin: float = None,
+                                      vmax: float = None, roi=None, channel=0) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Second pass of the streaming export of a timeseries of z-stacks: yields (frame, volume) pairs of 8 bit volumes
+    normalized to the [vmin, vmax] range, holding only one volume in memory at a time.
+    Without a range, volumes are yielded at the bit depth of the file.
+    """
+    h, w = img_struct.plane_shape(roi)
+    first = img_struct.image(img_struct.planes.rows(c=channel)[0]).image
+    normalize = vmin is not None and vmax is not None
+    volume = np.zeros((len(img_struct.zstacks), h, w), dtype=first.dtype)
+    for frame in frames:
+        if not normalize:
+            # volumes may still be in use by the consumer, so every frame gets its own buffer
+            yield frame, _read_zstack(img_struct, frame, channel, roi, np.zeros_like(volume))
+            continue
+        _read_zstack(img_struct, frame, channel, roi, volume)
+        yield frame, to_8bit(volume, vmin, vmax)
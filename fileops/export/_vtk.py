@@ -1,33 +1,54 @@
 import os.path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Tuple, Union
 
 import numpy as np
 import vtk
 from tifffile import imwrite
 from vtkmodules.vtkIOOpenVDB import vtkOpenVDBWriter
 
-from fileops.export import bioformats_to_ndarray_zstack_timeseries
+from fileops.export import bioformats_iter_zstack_timeseries, bioformats_zstack_timeseries_range
 from fileops.export.config import ExportConfig
 from fileops.logger import get_logger
 from fileops.pathutils import ensure_dir
 
 log = get_logger(name='export-vtk')
 
+# VTK pipeline of the process, reused for every frame that the process writes
+_pipeline: Union[None, Tuple[vtk.vtkImageImport, vtkOpenVDBWriter]] = None
+
+# scalar types that volumes can be imported into VTK with, without conversion
+VTK_SCALAR_TYPES = {
+    np.dtype(np.uint8):   vtk.VTK_UNSIGNED_CHAR,
+    np.dtype(np.uint16):  vtk.VTK_UNSIGNED_SHORT,
+    np.dtype(np.int16):   vtk.VTK_SHORT,
+    np.dtype(np.float32): vtk.VTK_FLOAT,
+}
+
 
 def save_ndarray_as_vdb(data: np.ndarray, um_per_pix=1.0, um_per_z=1.0, filename="output.vdb"):
     vtkim = _ndarray_to_vtk_image(data, um_per_pix=um_per_pix, um_per_z=um_per_z)
     _save_vtk_image_to_disk(vtkim, filename)
 
 
-def _ndarray_to_vtk_image(data: np.ndarray, um_per_pix=1.0, um_per_z=1.0):
+def _ndarray_to_vtk_image(data: np.ndarray, um_per_pix=1.0, um_per_z=1.0, vtk_image: vtk.vtkImageImport = None):
     ztot, col, row = data.shape
 
+    dtype = data.dtype.newbyteorder('=')
+    if dtype not in VTK_SCALAR_TYPES:
+        raise ValueError(f"Volumes of type {data.dtype} can't be imported into VTK; "
+                         f"use one of {[str(t) for t in VTK_SCALAR_TYPES]}.")
+
     # For VTK to be able to use the data, it must be stored as a VTK-image.
-    vtk_image = vtk.vtkImageImport()
-    data_string = data.tobytes()
-    vtk_image.CopyImportVoidPointer(data_string, len(data_string))
-    # The type of the newly imported data is set to unsigned char (uint8)
-    vtk_image.SetDataScalarTypeToUnsignedChar()
+    # The importer reads straight from the buffer of the array (copies are only made for arrays that are not
+    # contiguous or in native byte order), so a reference to the array is kept for as long as the importer uses it.
+    vtk_image = vtk.vtkImageImport() if vtk_image is None else vtk_image
+    data = np.ascontiguousarray(data, dtype=dtype)
+    vtk_image.SetImportVoidPointer(data, 1)
+    vtk_image.numpy_buffer = data
+    vtk_image.SetDataScalarType(VTK_SCALAR_TYPES[dtype])
 
     # dimensions of the array that data is stored in.
     vtk_image.SetNumberOfScalarComponents(1)
@@ -79,8 +100,8 @@ def _vtk_image_to_vtk_volume(vtk_image):
     return volume
 
 
-def _save_vtk_image_to_disk(vtk_image, filename):
-    writer = vtkOpenVDBWriter()
+def _save_vtk_image_to_disk(vtk_image, filename, writer: vtkOpenVDBWriter = None):
+    writer = vtkOpenVDBWriter() if writer is None else writer
     writer.SetInputConnection(vtk_image.GetOutputPort())
     if os.path.exists(filename):
         os.remove(filename)
@@ -88,24 +109,96 @@ def _save_vtk_image_to_disk(vtk_image, filename):
     writer.Update()
 
 
-def export_vtk(cfg: ExportConfig, out_path: Path, until_frame=np.inf):
+def _init_vtk_pipeline():
+    global _pipeline
+    _pipeline = (vtk.vtkImageImport(), vtkOpenVDBWriter())
+
+
+def _write_frame(vol: np.ndarray, vdb_path: Path, tiff_path: Path, um_per_pix: float, um_per_z: float):
+    if _pipeline is None:
+        _init_vtk_pipeline()
+    importer, writer = _pipeline
+    vtkim = _ndarray_to_vtk_image(vol, um_per_pix=um_per_pix, um_per_z=um_per_z, vtk_image=importer)
+    _save_vtk_image_to_disk(vtkim, vdb_path, writer=writer)
+    imwrite(tiff_path, vol, imagej=True, metadata={'order': 'ZXY'})
+
+
+def _available_memory() -> Union[None, int]:
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def export_vtk(cfg: ExportConfig, out_path: Path, until_frame=np.inf, percentiles=None, normalize=True,
+               n_workers=1, max_memory: int = None):
+    """
+    Exports every frame of the configured channels as an OpenVDB and a TIFF volume, normalized to 8 bits with the
+    intensity range of the whole timeseries (or the given pair of percentiles of it).
+    Data is streamed in two passes, the first one to find the intensity range and the second one to normalize and
+    write the volumes, so only a few volumes are held in memory regardless of the length of the movie.
+    If normalize is False, volumes are exported at the bit depth of the file (8 or 16 bit integers, or 32 bit floats)
+    in a single pass.
+
+    With more than one worker, frames are encoded and written by a pool of n_workers processes, each one with its own
+    VTK pipeline, while this process reads the volumes. The number of volumes in flight is capped so that their copies
+    fit in max_memory bytes (half of the available memory by default); progress is reported in frame order.
+    """
     log.info(f"Exporting data from configuration file {cfg.path} into VTK format")
     # cfg.image_file.info.to_excel(cfg.path.parent / "movies_list.xls")
 
-    for ch in cfg.channels:
-        # prepare path for exporting data
-        export_path = ensure_dir(cfg.path.parent / "openvdb" / f"ch{ch:01d}")
-        export_tiff_path = ensure_dir(cfg.path.parent / "tiff" / f"ch{ch:01d}")
-
-        frames = list(range(cfg.image_file.n_frames))
-        vol_timeseries = bioformats_to_ndarray_zstack_timeseries(cfg.image_file, frames, roi=cfg.roi, channel=ch)
-        # plot_intensity_histogram(vol_timeseries, filename=cfg_path.parent / f"histogram_ch{ch}.pdf")
-
-        for fr, vol in enumerate(vol_timeseries):
-            if fr not in cfg.frames:
-                continue
-            vtkim = _ndarray_to_vtk_image(vol, um_per_pix=cfg.image_file.um_per_pix, um_per_z=cfg.um_per_z)
-            _save_vtk_image_to_disk(vtkim, export_path / f"ch{ch:01d}_fr{fr:03d}.vdb")
-            imwrite(export_tiff_path / f"ch{ch:01d}_fr{fr:03d}.tiff", vol, imagej=True, metadata={'order': 'ZXY'})
-        with open(cfg.path.parent / "vol_info", "w") as f:
-            f.write(f"min {np.min(vol_timeseries)} max {np.max(vol_timeseries)}")
+    if max_memory is None:
+        available = _available_memory()
+        max_memory = available // 2 if available is not None else np.inf
+    executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_vtk_pipeline) if n_workers > 1 else None
+
+    try:
+        for ch in cfg.channels:
+            # prepare path for exporting data
+            export_path = ensure_dir(cfg.path.parent / "openvdb" / f"ch{ch:01d}")
+            export_tiff_path = ensure_dir(cfg.path.parent / "tiff" / f"ch{ch:01d}")
+
+            frames = list(range(cfg.image_file.n_frames))
+            vmin = vmax = None
+            if normalize:
+                vmin, vmax = bioformats_zstack_timeseries_range(cfg.image_file, frames, roi=cfg.roi, channel=ch,
+                                                                percentiles=percentiles)
+
+            export_frames = [fr for fr in frames if fr in cfg.frames and fr <= until_frame]
+            vol_min, vol_max = np.inf, -np.inf
+            in_flight = deque()
+            n_written = 0
+
+            def _frame_done(fr: int):
+                nonlocal n_written
+                n_written += 1
+                log.info(f"Channel {ch}: frame {fr} written ({n_written}/{len(export_frames)}).")
+
+            for fr, vol in bioformats_iter_zstack_timeseries(cfg.image_file, export_frames, vmin, vmax, roi=cfg.roi,
+                                                             channel=ch):
+                vol_min, vol_max = min(vol_min, vol.min()), max(vol_max, vol.max())
+                args = (vol, export_path / f"ch{ch:01d}_fr{fr:03d}.vdb",
+                        export_tiff_path / f"ch{ch:01d}_fr{fr:03d}.tiff", cfg.image_file.um_per_pix, cfg.um_per_z)
+                if executor is None:
+                    _write_frame(*args)
+                    _frame_done(fr)
+                    continue
+
+                # every volume in flight is held twice, here and in the worker that writes it
+                max_in_flight = int(max(1, min(2 * n_workers, max_memory // (2 * vol.nbytes))))
+                while len(in_flight) >= max_in_flight:
+                    future, done_fr = in_flight.popleft()
+                    future.result()
+                    _frame_done(done_fr)
+                in_flight.append((executor.submit(_write_frame, *args), fr))
+
+            while in_flight:
+                future, done_fr = in_flight.popleft()
+                future.result()
+                _frame_done(done_fr)
+
+            with open(cfg.path.parent / "vol_info", "w") as f:
+                f.write(f"min {vol_min} max {vol_max}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,138 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import numpy as np
+
+try:
+    import zarr
+    from numcodecs import Blosc
+except ImportError:  # optional dependencies, installed with the zarr extra of the package
+    zarr = Blosc = None
+
+from fileops.image import ImageFile
+from fileops.image.exceptions import FrameNotFoundError
+from fileops.logger import get_logger
+
+log = get_logger(name='export-zarr')
+
+NGFF_VERSION = "0.4"
+
+
+def _downsample(image: np.ndarray, factor: int) -> np.ndarray:
+    """ Mean over factor x factor blocks of the last two axes; borders that don't fill a block are dropped. """
+    h, w = image.shape[-2] // factor * factor, image.shape[-1] // factor * factor
+    blocks = image[..., :h, :w].reshape((*image.shape[:-2], h // factor, factor, w // factor, factor))
+    return blocks.mean(axis=(-3, -1)).astype(image.dtype)
+
+
+def _ngff_metadata(image_file: ImageFile, name: str, n_levels: int, downscale: int, frames: List) -> dict:
+    datasets = list()
+    for level in range(n_levels):
+        xy_scale = float(image_file.um_per_pix) * downscale ** level
+        datasets.append({
+            "path":                      str(level),
+            "coordinateTransformations": [{
+                "type":  "scale",
+                "scale": [float(image_file.time_interval or 1), 1.0, float(image_file.um_per_z or 1),
+                          xy_scale, xy_scale]
+            }]
+        })
+    timestamps = [float(image_file.timestamps[f]) for f in frames
+                  if image_file.timestamps is not None and f < len(image_file.timestamps)]
+    return {
+        "multiscales": [{
+            "version":  NGFF_VERSION,
+            "name":     name,
+            "axes":     [
+                {"name": "t", "type": "time", "unit": "second"},
+                {"name": "c", "type": "channel"},
+                {"name": "z", "type": "space", "unit": "micrometer"},
+                {"name": "y", "type": "space", "unit": "micrometer"},
+                {"name": "x", "type": "space", "unit": "micrometer"},
+            ],
+            "datasets": datasets,
+            "type":     "mean",
+        }],
+        # acquisition times of the frames, which NGFF has no field for
+        "fileops":     {"timestamps": timestamps, "source": Path(image_file.image_path).as_posix()},
+    }
+
+
+def export_ome_zarr(image_file: ImageFile, store_path: Union[str, Path], chunks=(1, 1, 16, 512, 512),
+                    compressor=None, n_levels=3, downscale=2, n_workers=4,
+                    channel='all', zstack='all', frame='all', roi=None, overwrite=False) -> 'zarr.Group':
+    """
+    Streams the planes of an image file into an OME-Zarr (NGFF 0.4) store with TCZYX axes.
+
+    :param image_file: The file to export.
+    :param store_path: Path of the zarr store to create.
+    :param chunks: Chunk size along the (t, c, z, y, x) axes of the full resolution level.
+    :param compressor: A numcodecs compressor; Blosc with zstd and bit shuffling by default.
+    :param n_levels: Number of resolution levels, each one downsampled in x and y from the previous one.
+    :param downscale: Downsampling factor in x and y between consecutive levels.
+    :param n_workers: Number of threads that compress and write blocks of chunks concurrently; each thread holds a
+        single block in memory. At most max_read_workers of them read from the image file at the same time.
+    :param roi: Region of interest to export (see roi_bounds); only that region of the planes is read.
+    :param overwrite: Whether to replace an existing store.
+    :return: The zarr group of the store.
+    """
+    if zarr is None:
+        raise ImportError("export_ome_zarr needs the zarr and numcodecs packages; "
+                          "install them with pip install imgfileops[zarr].")
+    frames = image_file.frames if frame == 'all' else [*frame]
+    zstacks = image_file.zstacks if zstack == 'all' else [*zstack]
+    channels = sorted(image_file.channels) if channel == 'all' else [*channel]
+    compressor = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE) if compressor is None else compressor
+
+    # rows of the plane table in TCZ order
+    ix = image_file.planes.rows_grid(t=frames, c=channels, z=zstacks)[0]
+    if not np.any(ix >= 0):
+        raise FrameNotFoundError("none of the requested planes were found in the file.")
+    first = image_file.image(int(ix[ix >= 0].flat[0]), roi=roi).image
+    plane_shape, dtype = first.shape, first.dtype
+
+    root = zarr.open_group(str(store_path), mode='w' if overwrite else 'w-')
+    levels: List[zarr.Array] = list()
+    h, w = plane_shape
+    for level in range(n_levels):
+        if level > 0:
+            h, w = h // downscale, w // downscale
+            if h == 0 or w == 0:
+                break
+        levels.append(root.create_dataset(str(level), shape=(*ix.shape, h, w),
+                                          chunks=(*chunks[:3], min(chunks[3], h), min(chunks[4], w)),
+                                          dtype=dtype, compressor=compressor, dimension_separator='/'))
+    root.attrs.update(_ngff_metadata(image_file, Path(store_path).stem, len(levels), downscale, frames))
+
+    # readers that are not thread safe are read from one thread at a time, while writes still run in parallel
+    read_lock = threading.BoundedSemaphore(max(1, min(n_workers, image_file.max_read_workers)))
+
+    def _write_block(sl: Tuple[slice, slice, slice]):
+        block_ix = ix[sl]
+        block = np.zeros((block_ix.size, *plane_shape), dtype=dtype)
+        with read_lock:
+            image_file.read_planes(block_ix.ravel(), block, roi=roi)
+        block = block.reshape((*block_ix.shape, *plane_shape))
+        for level, arr in enumerate(levels):
+            if level > 0:
+                block = _downsample(block, downscale)
+            arr[sl] = block[..., :arr.shape[-2], :arr.shape[-1]]
+
+    # blocks span whole chunks along t, c and z, and whole planes, so no two workers write into the same chunk
+    blocks = [tuple(slice(k, min(k + n, size)) for k, n, size in zip(start, chunks[:3], ix.shape))
+              for start in product(*(range(0, size, n) for size, n in zip(ix.shape, chunks[:3])))]
+    log.info(f"Exporting {np.count_nonzero(ix >= 0)} planes in {len(blocks)} blocks to {store_path}.")
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        in_flight = deque()
+        for sl in blocks:
+            in_flight.append(executor.submit(_write_block, sl))
+            if len(in_flight) >= 2 * n_workers:
+                in_flight.popleft().result()
+        while in_flight:
+            in_flight.popleft().result()
+
+    return root
@@ -2,9 +2,13 @@ from ._image_file_bioio_ome import BioioOMEImageFile
 from ._image_file_ome import OMEImageFile
 from ._image_file_tiffile_ome import TifffileOMEImageFile
 from ._mmagellan import folder_is_micromagellan
+from ._mmagellan_dataset import MicroMagellanDataset
 from ._mmanager_folder_series import MicroManagerFolderSeries
 from ._mmanager_single_stack import MicroManagerSingleImageStack
+from ._plane_table import PlaneTable
+from ._tiff_pool import TiffFilePool, tiff_pool
 from ._pycromanager_single_stack import PycroManagerSingleImageStack
+from ._transforms import BleachCorrection, Cast, Crop, FlatField, Rescale, Subtract, TransformPipeline
 from .image_file import ImageFile
 from .imagemeta import MetadataImage, MetadataImageSeries
 from .to_8bit import to_8bit
@@ -3,6 +3,7 @@ from typing import Union, List, Dict, Set
 
 import pandas as pd
 
+from fileops.image._plane_table import PlaneTable
 from fileops.image.imagemeta import MetadataImage
 
 
@@ -18,8 +19,7 @@ class ImageFileBase:
     md: Union[None, Dict] = None
     images_md: Union[None, Dict] = None
     planes_md: Union[None, Dict] = None
-    all_planes: Union[None, List] = None  # TODO: need to deprecate
-    all_planes_md_dict: Union[None, Dict] = None
+    planes: Union[None, PlaneTable] = None  # table of all image planes and their location in the files
 
     timestamps: Union[None, List] = None  # list of all timestamps recorded in the experiment
     time_interval: float = 0  # average time difference between frames in seconds
@@ -62,7 +62,7 @@ class ImageFileBase:
     def _load_imageseries(self):
         pass
 
-    def _image(self, plane, row=0, col=0, fid=0) -> MetadataImage:
+    def _image(self, ix, row=0, col=0, fid=0) -> MetadataImage:
         raise NotImplementedError
 
     def _get_metadata(self):
@@ -1,7 +1,14 @@
+from typing import List, Tuple, Union
+
 import numpy as np
 
 from scipy.optimize import curve_fit
 
+from fileops.image._roi import Bounds
+
+UI16_MAX = np.iinfo(np.uint16).max
+B_MAX = 1.  # bound of the decay rate, the same as in photobleach_correct
+
 
 def bleach_func(x, a, b, c):
     return a * np.exp(-b * x) + c
@@ -14,3 +21,112 @@ def photobleach_correct(mean_intensities: np.array) -> np.array:
     popt, pcov = curve_fit(bleach_func, xdata, mean_intensities, bounds=(0, [ui16_max, 1., ui16_max]))
 
     return popt
+
+
+def _fit_amplitude_offset(y: np.ndarray, x: np.ndarray, b: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """ Least squares amplitude and offset of every series in y for fixed decay rates b, and the residual. """
+    e = np.exp(-b[:, np.newaxis] * x[np.newaxis])
+    e_mean, y_mean = e.mean(axis=1), y.mean(axis=1)
+    ec, yc = e - e_mean[:, np.newaxis], y - y_mean[:, np.newaxis]
+    see = np.einsum('ij,ij->i', ec, ec)
+    a = np.divide(np.einsum('ij,ij->i', ec, yc), see, out=np.zeros_like(see), where=see > 0)
+    a = np.clip(a, 0, UI16_MAX)
+    c = np.clip(y_mean - a * e_mean, 0, UI16_MAX)
+    r = y - a[:, np.newaxis] * e - c[:, np.newaxis]
+    return a, c, np.einsum('ij,ij->i', r, r)
+
+
+def fit_photobleach(mean_intensities: np.ndarray, x: np.ndarray = None, n_iter=40) -> np.ndarray:
+    """
+    Fits bleach_func to every row of mean_intensities at once, with the same bounds as photobleach_correct.
+    The amplitude and offset are solved in closed form for a given decay rate, which is first searched on a grid and
+    then refined by golden section search, all vectorized over the rows. Returns the (a, b, c) parameters of each row.
+    """
+    y = np.atleast_2d(np.asarray(mean_intensities, dtype=np.float64))
+    x = np.arange(y.shape[1], dtype=np.float64) if x is None else np.asarray(x, dtype=np.float64)
+    n = len(y)
+
+    grid = np.concatenate([[0.], np.logspace(-6, np.log10(B_MAX), 120)])
+    sse = np.stack([_fit_amplitude_offset(y, x, np.full(n, b))[2] for b in grid])
+    k = np.argmin(sse, axis=0)
+    lo, hi = grid[np.maximum(k - 1, 0)], grid[np.minimum(k + 1, len(grid) - 1)]
+
+    ratio = (np.sqrt(5) - 1) / 2
+    for _ in range(n_iter):
+        b1, b2 = hi - ratio * (hi - lo), lo + ratio * (hi - lo)
+        left = _fit_amplitude_offset(y, x, b1)[2] < _fit_amplitude_offset(y, x, b2)[2]
+        hi, lo = np.where(left, b2, hi), np.where(left, lo, b1)
+    b = (lo + hi) / 2
+    a, c, _ = _fit_amplitude_offset(y, x, b)
+    return np.stack([a, b, c], axis=1)
+
+
+def _tile_edges(n: int, size: int) -> np.ndarray:
+    return np.linspace(0, size, n + 1).astype(int)
+
+
+def tile_means(image: np.ndarray, tiles: Tuple[int, int]) -> np.ndarray:
+    """ Mean intensity of each one of the tiles=(rows, columns) regions that the image is split into. """
+    ys, xs = _tile_edges(tiles[0], image.shape[0]), _tile_edges(tiles[1], image.shape[1])
+    sums = np.add.reduceat(np.add.reduceat(image, ys[:-1], axis=0, dtype=np.float64), xs[:-1], axis=1)
+    return sums / np.outer(np.diff(ys), np.diff(xs))
+
+
+def _interp_weights(at: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """ Weights of the linear interpolation at positions at between values placed at centers (clamped at the ends). """
+    eye = np.eye(len(centers))
+    return np.stack([np.interp(at, centers, eye[k]) for k in range(len(centers))], axis=1)
+
+
+class PhotobleachCorrection:
+    """
+    Exponential photobleaching model of every channel of an acquisition, optionally fitted per tile of the field.
+    Planes are corrected by the gain f(0) / f(t) of the model, interpolated bilinearly between tile centers.
+    """
+
+    def __init__(self, params: np.ndarray, channels: List[int], shape: Tuple[int, int]):
+        self.params = np.asarray(params, dtype=np.float64)  # (channels, tile rows, tile columns, 3)
+        self.channels = list(channels)
+        self.shape = tuple(shape)  # (height, width) of the planes that the model was fitted on
+
+    @property
+    def tiles(self) -> Tuple[int, int]:
+        return self.params.shape[1], self.params.shape[2]
+
+    def tile_gains(self, channel: int, frame: int) -> Union[None, np.ndarray]:
+        if channel not in self.channels:
+            return None
+        a, b, c = np.moveaxis(self.params[self.channels.index(channel)], -1, 0)
+        decayed = bleach_func(frame, a, b, c)
+        return np.divide(a + c, decayed, out=np.ones_like(decayed), where=decayed > 0)
+
+    def gain(self, channel: int, frame: int, roi: Union[None, Bounds] = None) -> Union[None, float, np.ndarray]:
+        """ Gain to multiply the plane (or the region roi of it) of a channel and frame with, or None. """
+        gains = self.tile_gains(channel, frame)
+        if gains is None or gains.size == 1:
+            return None if gains is None else float(gains.flat[0])
+
+        h, w = self.shape
+        y0, y1, x0, x1 = roi if roi is not None else (0, h, 0, w)
+        ys, xs = _tile_edges(gains.shape[0], h), _tile_edges(gains.shape[1], w)
+        # bilinear interpolation between tile centers is separable, so it is computed as wy @ gains @ wx.T
+        wy = _interp_weights(np.arange(y0, y1) + 0.5, (ys[:-1] + ys[1:]) / 2)
+        wx = _interp_weights(np.arange(x0, x1) + 0.5, (xs[:-1] + xs[1:]) / 2)
+        return (wy @ gains @ wx.T).astype(np.float32)
+
+    def apply(self, image: np.ndarray, channel: int, frame: int, roi: Union[None, Bounds] = None,
+              out: np.ndarray = None) -> np.ndarray:
+        """ Corrects a plane, keeping its data type; integer planes are rounded and clipped to their range. """
+        out = image if out is None else out
+        gain = self.gain(channel, frame, roi=roi)
+        if gain is None:
+            if out is not image:
+                out[:] = image
+            return out
+        corrected = np.multiply(image, gain, dtype=np.float32)
+        if np.issubdtype(out.dtype, np.integer):
+            info = np.iinfo(out.dtype)
+            np.rint(corrected, out=corrected)
+            np.clip(corrected, info.min, info.max, out=corrected)
+        out[:] = corrected
+        return out
@@ -1,31 +1,42 @@
 import statistics
 import xml.etree.ElementTree
 from pathlib import Path
-from typing import Tuple
+from typing import Union
 
 import bioio_base
 import numpy as np
+import tifffile as tf
 from bioio import BioImage
-from bs4 import BeautifulSoup as bs
-from ome_types import OME
+from ome_types import OME, from_xml, to_xml
 
 from fileops.image._image_file_ome import OMEImageFile
+from fileops.image._ome_xml import parse_ome_xml, planes_from_dimension_order
+from fileops.image._plane_table import PlaneTable
 from fileops.image.imagemeta import MetadataImage
 from fileops.logger import get_logger
 
 
 class BioioOMEImageFile(OMEImageFile):
+    """
+    Reads files through BioIO. The OME-XML of the file is parsed in a single streaming pass (see parse_ome_xml), and
+    both the BioIO reader and the ome_types model of the metadata are only built when they are first used.
+    """
     ome_ns = {'ome': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'}
     log = get_logger(name='BioioOMEImageFile')
 
     def __init__(self, image_path: Path, **kwargs):
+        self._reader = None
+        self._md = None
+        self._instrument_md = None
+        self._ome_images = list()
         super(BioioOMEImageFile, self).__init__(image_path, **kwargs)
 
-        self.md, self.md_xml = self._get_metadata()
-        self.all_series = self._rdr.scenes
-        self.instrument_md = self.md.instruments
+        self.md_xml = self._read_ome_xml()
+        self._ome_images = parse_ome_xml(self.md_xml)
+        self.all_series = tuple(image.attrib.get('ID', str(k)) for k, image in enumerate(self._ome_images))
+        self.instrument_md = None
         self.objectives_md = None
-        self.md_description = bs(self.md_xml, "lxml-xml")
+        self.md_description = None
 
         self._load_imageseries()
 
@@ -34,13 +45,42 @@ class BioioOMEImageFile(OMEImageFile):
     @staticmethod
     def has_valid_format(path: Path):
         try:
-            with BioImage(path) as rdr:
-                print(rdr)
+            with BioImage(path):
+                pass
         except bioio_base.exceptions.UnsupportedFileFormatError:
             return False
 
         return True
 
+    @property
+    def _rdr(self) -> BioImage:
+        if self._reader is None:
+            self._reader = BioImage(self.image_path.as_posix())
+            if self._reader.scenes:
+                self._reader.set_scene(self._series)
+        return self._reader
+
+    @property
+    def md(self) -> Union[None, OME]:
+        # the full model of the metadata is only built if someone asks for it
+        if self._md is None and self.md_xml:
+            self._md = from_xml(self.md_xml)
+        return self._md
+
+    @md.setter
+    def md(self, value):
+        self._md = value
+
+    @property
+    def instrument_md(self):
+        if self._instrument_md is None and self.md_xml:
+            return self.md.instruments
+        return self._instrument_md
+
+    @instrument_md.setter
+    def instrument_md(self, value):
+        self._instrument_md = value
+
     @property
     def series(self):
         if len(self.all_series) == 0:
@@ -54,31 +94,47 @@ class BioioOMEImageFile(OMEImageFile):
         if type(s) is int:
             self._series = s
         elif type(s) is str:
-            for k, imser in enumerate(self.all_series):
-                if imser.attrib['Name'] == s:
+            for k, image in enumerate(self._ome_images):
+                if s in (image.attrib.get('ID'), image.attrib.get('Name')):
                     self._series = k
                     break
         elif type(s) is xml.etree.ElementTree.Element:
-            for k, imser in enumerate(self.all_series):
-                if imser.attrib == s.attrib:
+            for k, image in enumerate(self._ome_images):
+                if image.attrib == s.attrib:
                     self._series = k
                     break
         else:
             raise ValueError("Unexpected type of variable to load series.")
 
-        super().__init__(s)
+        if self._reader is not None and self._reader.scenes:
+            self._reader.set_scene(self._series)
+        self._load_imageseries()
+
+    def _read_ome_xml(self) -> str:
+        """ OME-XML of the file, taken from the description of OME-TIFF files and from the BioIO reader otherwise. """
+        try:
+            with tf.TiffFile(self.image_path) as tif:
+                if tif.ome_metadata:
+                    return tif.ome_metadata
+        except (tf.TiffFileError, OSError, ValueError):
+            pass
+        self._md = self._rdr.ome_metadata
+        return to_xml(self._md)
 
     def _load_imageseries(self):
         if not self.all_series:
             return
-        self.images_md = self.all_series[self._series]
-        self.planes_md = self.md_description.find('Pixels')
-        self.all_planes = self.md_description.find_all('Plane')
-
-        self.channels = set(int(p.get('TheC')) for p in self.all_planes)
-        self.zstacks = sorted(np.unique([p.get('TheZ') for p in self.all_planes]).astype(int))
-        self.z_position = np.array([p.get('PositionZ') for p in self.all_planes]).astype(float)
-        self.frames = sorted(np.unique([p.get('TheT') for p in self.all_planes]).astype(int))
+        image = self._ome_images[self._series]
+        self.images_md = image.attrib
+        self.planes_md = image.pixels
+        columns = image.planes if len(image.planes['TheC']) > 0 else planes_from_dimension_order(image.pixels)
+
+        self.planes = PlaneTable.from_columns(t=columns['TheT'], c=columns['TheC'], z=columns['TheZ'], page=0,
+                                              timestamp=columns['DeltaT'], z_um=columns['PositionZ'])
+        self.channels = set(self.planes.channels.tolist())
+        self.zstacks = sorted(self.planes.zstacks)
+        self.z_position = self.planes.records['z_um']
+        self.frames = sorted(self.planes.frames)
         self.n_channels = len(self.channels)
         self.n_zstacks = len(self.zstacks)
         self.n_frames = len(self.frames)
@@ -93,67 +149,37 @@ class BioioOMEImageFile(OMEImageFile):
         self.pix_per_um = 1. / self.um_per_pix
         self.width = int(self.planes_md.get('SizeX'))
         self.height = int(self.planes_md.get('SizeY'))
-        if self.md_description:
-            px_md = self.md_description.find('Pixels')
-            self.um_per_z = float(px_md.get('PhysicalSizeZ'))
-        elif self.planes_md.get('PhysicalSizeZ'):
+        z_diff = np.diff(np.unique(self.z_position[~np.isnan(self.z_position)]))
+        if self.planes_md.get('PhysicalSizeZ'):
             self.um_per_z = float(self.planes_md.get('PhysicalSizeZ'))
-        elif len(self.z_position) > 0:
-            z_diff = np.diff(self.z_position)
-            self.um_per_z = statistics.mode(z_diff[z_diff > 0])
-
-        # obj = self.images_md.find('ObjectiveSettings', self.ome_ns)
-        # obj_id = obj.get('ID') if obj else None
-        # objective = self.md.find(f'Instrument/Objective[@ID="{obj_id}"]', self.ome_ns) if obj else None
-        # self.magnification = int(float(objective.get('NominalMagnification'))) if objective else None
+        elif len(z_diff) > 0:
+            self.um_per_z = statistics.mode(z_diff)
+        else:
+            self.um_per_z = 1
 
-        self.timestamps = sorted(
-            np.array([p.get('DeltaT') for p in self.all_planes if p.get('DeltaT') is not None]).astype(np.float64))
+        timestamps = self.planes.records['timestamp']
+        self.timestamps = sorted(np.unique(timestamps[~np.isnan(timestamps)]).tolist())
         ts_diff = np.diff(self.timestamps)
-        self.time_interval = statistics.mode(ts_diff)
-        # # values higher than 2s likely to be waiting times
-        # self.time_interval = statistics.mode(ts_diff[(0<ts_diff) & (ts_diff<2000)])
-        # # plot ticks
-        # import matplotlib.pyplot as plt
-        # fig, ax = plt.subplots(figsize=(8, 4))
-        # ax.plot(self.timestamps, [0.01] * len(self.timestamps), '|', color='k')
-
-        # build dictionary where the keys are combinations of c z t and values are the index
-        self.all_planes_md_dict = {f"c{int(plane.get('TheC')):0{len(str(self._md_n_channels))}d}"
-                                   f"z{int(plane.get('TheZ')):0{len(str(self._md_n_zstacks))}d}"
-                                   f"t{int(plane.get('TheT')):0{len(str(self._md_n_frames))}d}": plane
-                                   for i, plane in enumerate(self.all_planes)}
+        if len(ts_diff) > 0:
+            self.time_interval = statistics.mode(ts_diff)
 
         self.log.info(f"Image series {self._series} loaded. "
                       f"Image size (WxH)=({self.width:d}x{self.height:d}); "
                       f"calibration is {self.pix_per_um:0.3f} pix/um and {self.um_per_z:0.3f} um/z-step; "
                       f"movie has {len(self.frames)} frames, {self.n_channels} channels, {self.n_zstacks} z-stacks and "
-                      f"{len(self.all_planes)} image planes in total.")
-
-    def _image(self, plane_ix, row=0, col=0, fid=0) -> MetadataImage:  # PLANE HAS METADATA INFO OF THE IMAGE PLANE
-        plane = self.all_planes_md_dict[plane_ix]
-        c, z, t = int(plane.get('TheC')), int(plane.get('TheZ')), int(plane.get('TheT'))
-        # logger.debug('retrieving image id=%d row=%d col=%d fid=%d' % (_id, row, col, fid))
+                      f"{len(self.planes)} image planes in total.")
 
-        # image = self._rdr.read(c=c, z=z, t=t, series=self._series, rescale=False)
-        # returns 5D TCZYX xarray data array backed by dask array
-        image = self._rdr.get_image_data("TCZYX", c=c, z=z, t=t)
+    def _image(self, ix, row=0, col=0, fid=0) -> MetadataImage:
+        plane = self.planes[ix]
+        c, z, t = int(plane['c']), int(plane['z']), int(plane['t'])
 
-        w = int(self.planes_md.get('SizeX'))
-        h = int(self.planes_md.get('SizeY'))
+        # only the requested plane is read from the TCZYX data of the scene
+        image = self._rdr.get_image_data("YX", c=c, z=z, t=t)
 
         return MetadataImage(reader='OME',
                              image=image,
                              pix_per_um=1. / self.um_per_pix, um_per_pix=self.um_per_pix,
                              time_interval=None,
-                             timestamp=float(plane.get('DeltaT')) if plane.get('DeltaT') is not None else 0.0,
-                             frame=int(t), channel=int(c), z=int(z), width=w, height=h,
-                             intensity_range=[np.min(image), np.max(image)])
-
-    def _get_metadata(self) -> Tuple[OME, str]:
-        biofile_kwargs = {'options': {}, 'original_meta': False, 'memoize': 0, 'dask_tiles': False, 'tile_size': None}
-        with BioImage(self.image_path.as_posix(), **biofile_kwargs) as rdr:
-            md_xml = rdr.ome_xml
-        md = self._rdr.ome_metadata
-
-        return md, md_xml
+                             timestamp=float(plane['timestamp']) if not np.isnan(plane['timestamp']) else 0.0,
+                             frame=int(t), channel=int(c), z=int(z), width=self.width, height=self.height,
+                             intensity_range=self._intensity_range(image))
@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from pathlib import Path
 
 import numpy as np
@@ -6,19 +7,23 @@ from bs4 import BeautifulSoup as bs
 
 from fileops.image._image_file_ome import OMEImageFile
 from fileops.image._tifffile_imagej_metadata import MetadataImageJTifffileMixin
+from fileops.image._tifffile_planes import PlanesTifffileMixin
 from fileops.image.imagemeta import MetadataImage
 from fileops.logger import get_logger
 
 import bioio_base as biob
 
-class TifffileOMEImageFile(OMEImageFile, MetadataImageJTifffileMixin):
+class TifffileOMEImageFile(PlanesTifffileMixin, OMEImageFile, MetadataImageJTifffileMixin):
     log = get_logger(name='TifffileOMEImageFile')
 
-    def __init__(self, image_path: Path, **kwargs):
+    def __init__(self, image_path: Path, tif: tf.TiffFile = None, **kwargs):
+        # an already open handle of the file may be given, which is then owned by this reader
+        self._tif = tif
         super(TifffileOMEImageFile, self).__init__(image_path, **kwargs)
 
         self._rdr: biob.reader.Reader = None
 
+        self._tif.filehandle.set_lock(True)
         self.md_xml = self._tif.ome_metadata
         if self.md_xml:
             self.md = bs(self.md_xml, "lxml-xml")
@@ -32,16 +37,21 @@ class TifffileOMEImageFile(OMEImageFile, MetadataImageJTifffileMixin):
                 has_ome_meta = hasattr(_tif, "ome_metadata") and _tif.ome_metadata is not None
                 return has_ome_meta
 
-    def ix_at(self, c, z, t):
-        czt_str = self.plane_at(c, z, t)
-        if czt_str in self.all_planes_md_dict:
-            return self.all_planes_md_dict[czt_str][0]
-        self.log.warning(f"No index found for c={c}, z={z}, and t={t}.")
+    def _plane_file(self, fid: int) -> Path:
+        return self.image_path
 
-    def _image(self, plane_ix, row=0, col=0, fid=0) -> MetadataImage:  # PLANE HAS METADATA INFO OF THE IMAGE PLANE
-        page, c, z, t = self.all_planes_md_dict[plane_ix]
+    @contextmanager
+    def _open_tiff(self, fid: int) -> tf.TiffFile:
+        yield self._tif
+
+    def _image(self, ix, row=0, col=0, fid=0) -> MetadataImage:
+        plane = self.planes[ix]
+        page, c, z, t = int(plane['page']), int(plane['c']), int(plane['z']), int(plane['t'])
         # logger.debug('retrieving image id=%d row=%d col=%d fid=%d' % (_id, row, col, fid))
-        image = self._tif.pages[page].asarray()
+        image = self._memmap_plane(ix)
+        if image is None:
+            with self._tif.filehandle.lock:
+                image = self._tif.pages[page].asarray()
 
         return MetadataImage(reader='OME',
                              image=image,
@@ -49,4 +59,4 @@ class TifffileOMEImageFile(OMEImageFile, MetadataImageJTifffileMixin):
                              time_interval=self._md_deltaT_ms,
                              timestamp=self._md_deltaT_ms * t,
                              frame=int(t), channel=int(c), z=int(z), width=self.width, height=self.height,
-                             intensity_range=[np.min(image), np.max(image)])
+                             intensity_range=self._intensity_range(image))
@@ -0,0 +1,68 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple, Union
+
+from fileops.logger import get_logger
+from fileops.pathutils import ensure_dir
+
+log = get_logger(name='metadata_index')
+
+INDEX_VERSION = 1
+
+
+def index_cache_dir() -> Path:
+    """ Folder where metadata indexes are stored; it can be set through the FILEOPS_CACHE_DIR environment variable. """
+    base = os.environ.get('FILEOPS_CACHE_DIR', Path.home() / '.cache' / 'fileops')
+    return Path(base) / 'metadata_index'
+
+
+def _index_path(image_path: Path, kind: str = None) -> Path:
+    key = hashlib.sha1(str(Path(image_path).absolute()).encode('utf-8')).hexdigest()
+    return index_cache_dir() / (f"{key}.pkl" if kind is None else f"{key}.{kind}.pkl")
+
+
+def _fingerprint(paths: Iterable[Path]) -> List[Tuple[str, int, int]]:
+    out = list()
+    for p in paths:
+        st = os.stat(p)
+        out.append((str(Path(p).absolute()), st.st_size, st.st_mtime_ns))
+    return out
+
+
+def load_index(image_path: Path, kind: str = None) -> Union[None, Dict]:
+    """
+    Returns the state stored in the index of the acquisition of image_path, or None if there is no index or any of
+    the files it was built from changed since. Other kinds of state derived from the acquisition are stored under
+    their own kind.
+    """
+    path = _index_path(image_path, kind=kind)
+    if not path.exists():
+        return None
+    try:
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+        if index.get('version') != INDEX_VERSION:
+            return None
+        if _fingerprint(Path(p) for p, _, _ in index['sources']) != index['sources']:
+            log.debug(f"Metadata index of {image_path} is outdated.")
+            return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, KeyError, ValueError) as e:
+        log.warning(f"Could not load metadata index of {image_path}: {e}")
+        return None
+    return index['state']
+
+
+def save_index(image_path: Path, sources: Iterable[Path], state: Dict, kind: str = None):
+    """ Stores state in the index of the acquisition of image_path, keyed by size and mtime of the source files. """
+    path = _index_path(image_path, kind=kind)
+    try:
+        index = {'version': INDEX_VERSION, 'sources': _fingerprint(sources), 'state': state}
+        ensure_dir(path.parent)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning(f"Could not save metadata index of {image_path}: {e}")
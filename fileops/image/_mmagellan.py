@@ -1,4 +1,6 @@
 import pathlib
+import re
+from typing import Dict, Union
 
 import numpy as np
 
@@ -18,3 +20,35 @@ def folder_is_micromagellan(path: str) -> bool:
         return np.all(key_folders)
     else:
         return False
+
+
+_level_re = re.compile(r'^(Full resolution|Downsampled_x[0-9]+)$')
+
+
+def micromagellan_root(path) -> Union[None, pathlib.Path]:
+    """
+    Returns the folder of the Micro-Magellan dataset that path is, or None. Only the dataset folder itself, one of its
+    resolution level folders or a file directly in one of them are taken as part of the dataset.
+    """
+    p = pathlib.Path(path)
+    if p.is_dir() and (p / 'Full resolution').is_dir():
+        return p
+    level = p if p.is_dir() else p.parent
+    if _level_re.match(level.name) and (level.parent / 'Full resolution').is_dir():
+        return level.parent
+    return None
+
+
+def micromagellan_levels(root) -> Dict[int, pathlib.Path]:
+    """ Folders of the resolution levels of a Micro-Magellan dataset, indexed by their downsampling factor. """
+    levels = dict()
+    for f in pathlib.Path(root).iterdir():
+        if not f.is_dir():
+            continue
+        if f.name == 'Full resolution':
+            levels[1] = f
+        else:
+            m = re.match(r'^Downsampled_x([0-9]+)$', f.name)
+            if m:
+                levels[int(m.group(1))] = f
+    return dict(sorted(levels.items()))
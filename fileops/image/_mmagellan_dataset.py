@@ -0,0 +1,303 @@
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import tifffile as tf
+
+from fileops.image._mmagellan import micromagellan_levels, micromagellan_root
+from fileops.image._plane_table import PlaneTable
+from fileops.image._tiff_pool import tiff_pool
+from fileops.image._tifffile_planes import PlanesTifffileMixin, _read_pages
+from fileops.image.exceptions import FrameNotFoundError
+from fileops.image.image_file import ImageFile
+from fileops.image.imagemeta import MetadataImage
+from fileops.logger import get_logger
+
+MM_METADATA_TAG = 51123  # per image JSON metadata written by Micro-Manager
+
+
+class MicroMagellanLevel:
+    """
+    Index of the tiles stored at one resolution level of a Micro-Magellan dataset, built from the index maps in the
+    headers of the TIFF files of the level; the position column of the plane table is the tile index.
+    """
+
+    def __init__(self, factor: int, folder: Path, files: List[str], planes: PlaneTable,
+                 grid: Dict[int, Tuple[int, int]], tile_shape: Tuple[int, int], dtype: np.dtype,
+                 summary: Dict, first_image_md: Dict):
+        self.factor = factor
+        self.folder = folder
+        self.files = files
+        self.planes = planes
+        self.grid = grid  # (row, column) of each tile in the grid of the level
+        self.tile_shape = tile_shape
+        self.dtype = dtype
+        self.summary = summary
+        self.first_image_md = first_image_md
+
+    @property
+    def grid_shape(self) -> Tuple[int, int]:
+        rows, cols = zip(*self.grid.values()) if self.grid else ((0,), (0,))
+        return max(rows) - min(rows) + 1, max(cols) - min(cols) + 1
+
+
+class MicroMagellanDataset(PlanesTifffileMixin, ImageFile):
+    """
+    Micro-Magellan dataset with all the resolution levels that Micro-Magellan writes next to the full resolution
+    data (the Downsampled_x2 ... Downsampled_x2048 folders).
+    The planes of the series are the ones of one tile at the active level; mosaic stitches all the tiles of a plane
+    and can be served from the smallest level that satisfies a target size or pixel size.
+    """
+    log = get_logger(name='MicroMagellanDataset')
+
+    def __init__(self, image_path: Path = None, level=1, **kwargs):
+        self.root = micromagellan_root(image_path)
+        if self.root is None or not self.has_valid_format(image_path):
+            raise FileNotFoundError("Format is not correct.")
+        self.levels: Dict[int, Path] = micromagellan_levels(self.root)
+        if level not in self.levels:
+            raise ValueError(f"Resolution level x{level} not found; available levels are {list(self.levels)}.")
+        self.level = level
+        self._level_index: Dict[int, MicroMagellanLevel] = dict()
+
+        super().__init__(image_path=Path(image_path), **kwargs)
+
+    @staticmethod
+    def has_valid_format(path: Path):
+        """check whether the path is inside of a dataset with the folder structure of Micro-Magellan"""
+        root = micromagellan_root(path)
+        return root is not None and len(micromagellan_levels(root)) > 0
+
+    def _index_level(self, factor: int) -> MicroMagellanLevel:
+        if factor in self._level_index:
+            return self._level_index[factor]
+
+        folder = self.levels[factor]
+        files = sorted(f for f in os.listdir(folder) if f[-4:] == '.tif' and f[0] != '.')
+        columns = list()
+        grid = dict()
+        tile_shape = dtype = None
+        summary = first_image_md = dict()
+        for fid, fname in enumerate(files):
+            with tiff_pool.acquire(folder / fname) as tif, tif.filehandle.lock:
+                mm = tf.read_micromanager_metadata(tif.filehandle, keys={'Summary', 'IndexMap'})
+                index_map = mm.get('IndexMap')
+                if index_map is None or len(index_map) == 0:
+                    self.log.warning(f"File {fname} of level x{factor} has no index map; skipping it.")
+                    continue
+                summary = summary or mm.get('Summary', dict())
+
+                # images are written one after the other, so the page of a plane is the rank of its IFD offset
+                pages = np.argsort(np.argsort(index_map[:, 4], kind='stable'))
+                if tile_shape is None:
+                    tile_shape, dtype = tif.pages[0].shape, tif.pages[0].dtype
+
+                # the grid coordinates of a tile are only found in the metadata of its images
+                positions, first = np.unique(index_map[:, 3], return_index=True)
+                for p, k in zip(positions, first):
+                    if int(p) in grid:
+                        continue
+                    tag = tif.pages[int(pages[k])].tags.get(MM_METADATA_TAG)
+                    img_md = tag.value if tag is not None and isinstance(tag.value, dict) else dict()
+                    first_image_md = first_image_md or img_md
+                    grid[int(p)] = (int(img_md.get('GridRowIndex', 0)), int(img_md.get('GridColumnIndex', p)))
+                columns.append((index_map[:, 0], index_map[:, 1], index_map[:, 2], index_map[:, 3],
+                                np.full(len(index_map), fid), pages))
+
+        if not columns:
+            raise FileNotFoundError(f"No images found in level x{factor} of {self.root}.")
+        c, z, t, p, fid, page = (np.concatenate(col) for col in zip(*columns))
+        planes = PlaneTable.from_columns(t=t, c=c, z=z, p=p, fid=fid, page=page, files=files)
+
+        level = MicroMagellanLevel(factor, folder, files, planes, grid, tile_shape, dtype, summary, first_image_md)
+        self._level_index[factor] = level
+        self.log.info(f"Level x{factor} has {len(grid)} tiles and {len(planes)} image planes.")
+        return level
+
+    def _load_imageseries(self):
+        lvl = self._index_level(self.level)
+        self.md = {'Summary': lvl.summary, 'FirstImage': lvl.first_image_md}
+        self.base_path = lvl.folder
+        self.files = lvl.files
+
+        # the series is one tile of the active level
+        self.all_series = set(lvl.grid.keys())
+        tile = sorted(self.all_series)[self._series]
+        records = lvl.planes.records[lvl.planes.records['p'] == tile].copy()
+        records['p'] = 0
+        self.planes = PlaneTable(records, files=self.files)
+        self.position_md = {'tile': tile, 'grid': lvl.grid[tile]}
+
+        self.channels = set(self.planes.channels.tolist())
+        self.zstacks = sorted(self.planes.zstacks.tolist())
+        self.frames = sorted(self.planes.frames.tolist())
+        self.n_channels, self.n_zstacks, self.n_frames = len(self.channels), len(self.zstacks), len(self.frames)
+
+        self.height, self.width = lvl.tile_shape
+        um_per_pix = float(lvl.first_image_md.get('PixelSizeUm', lvl.summary.get('PixelSize_um', 0)) or 0)
+        if um_per_pix > 0:
+            # the pixel size in the metadata is the one of the full resolution data
+            self.um_per_pix = um_per_pix * self.level
+            self.pix_per_um = 1 / self.um_per_pix
+        self.um_per_z = float(lvl.summary.get('z-step_um', self.um_per_z))
+        interval = float(lvl.summary.get('Interval_ms', -1))
+        if interval > 0:
+            self.time_interval = interval / 1000
+            self.timestamps = [self.time_interval * f for f in self.frames]
+
+        self.log.info(f"Tile {tile} at level x{self.level}: {self.n_frames} frames and {len(self.planes)} planes.")
+
+    @property
+    def info(self) -> pd.DataFrame:
+        if self._info is not None:
+            return self._info
+
+        fname_stat = Path(self.image_path).stat()
+        fmodified = datetime.fromtimestamp(fname_stat.st_mtime).strftime('%a %b/%d/%Y, %H:%M:%S')
+        size_inv = self.pix_per_um if self.um_per_pix > 0 else None
+        self._info = pd.DataFrame([{
+            'folder':                   self.root,
+            'filename':                 self.files[0] if self.files else '',
+            'image_name':               self.root.name,
+            'channels':                 self.n_channels,
+            'z-stacks':                 self.n_zstacks,
+            'frames':                   self.n_frames,
+            'position':                 self._series,
+            'delta_t':                  self.time_interval,
+            'width':                    self.width,
+            'height':                   self.height,
+            'data_type':                self.md['Summary'].get('PixelType', ''),
+            'pixel_size':               (self.um_per_pix, self.um_per_pix, self.um_per_z),
+            'pixel_size_unit':          ('µm', 'µm', 'µm'),
+            'pix_per_um':               (size_inv, size_inv, size_inv),
+            'resolution_levels':        tuple(self.levels),
+            'most recent modification': fmodified,
+        }])
+        return self._info
+
+    @property
+    def series(self):
+        return sorted(self.all_series)[self._series] if self.all_series else 0
+
+    @series.setter
+    def series(self, s):
+        if type(s) != int:
+            raise ValueError("Unexpected type of variable to load series.")
+        self._series = s
+        self._info = None
+        self._load_imageseries()
+
+    def select_level(self, level: int):
+        """
+        Makes level the resolution level of the planes of the series; the series becomes the tile of the new level
+        that covers the current one.
+        """
+        if level not in self.levels:
+            raise ValueError(f"Resolution level x{level} not found; available levels are {list(self.levels)}.")
+        row, col = self.position_md['grid']
+        row, col = row * self.level // level, col * self.level // level
+        grid = self._index_level(level).grid
+        tiles = sorted(grid)
+        covering = [k for k, p in enumerate(tiles) if grid[p] == (row, col)]
+        self._series = covering[0] if covering else 0
+        self.level = level
+        self._mm_files, self._mm_offsets, self._mm_layout = dict(), None, dict()
+        self._info = None
+        self._load_imageseries()
+
+    def mosaic_shape(self, level: int) -> Tuple[int, int]:
+        lvl = self._index_level(level)
+        (rows, cols), (h, w) = lvl.grid_shape, lvl.tile_shape
+        oy, ox = self._tile_crop(level)
+        return rows * (h - 2 * oy), cols * (w - 2 * ox)
+
+    def level_for(self, max_size: int = None, um_per_pix: float = None) -> int:
+        """
+        Smallest resolution level that still has a mosaic of at least max_size pixels along its longest side, and
+        pixels no larger than um_per_pix.
+        """
+        full_um_per_pix = self.um_per_pix / self.level
+        for factor in sorted(self.levels, reverse=True):
+            if um_per_pix is not None and full_um_per_pix * factor > um_per_pix:
+                continue
+            if max_size is not None and max(self.mosaic_shape(factor)) < max_size:
+                continue
+            return factor
+        return min(self.levels)
+
+    def _tile_crop(self, level: int) -> Tuple[int, int]:
+        # full resolution tiles overlap, while downsampled tiles are stored already cropped
+        if level != 1:
+            return 0, 0
+        summary = self._index_level(level).summary
+        return int(summary.get('GridPixelOverlapY', 0)) // 2, int(summary.get('GridPixelOverlapX', 0)) // 2
+
+    def _read_level_planes(self, lvl: MicroMagellanLevel, ix: np.ndarray, out: np.ndarray):
+        dst = np.flatnonzero(ix >= 0)
+        rec = lvl.planes.records[ix[dst]]
+        fids, pages = rec['fid'].astype(np.int64), rec['page'].astype(np.int64)
+        order = np.lexsort((pages, fids))
+        dst, fids, pages = dst[order], fids[order], pages[order]
+        for fid in np.unique(fids):
+            in_file = fids == fid
+            with tiff_pool.acquire(lvl.folder / lvl.files[fid]) as tif, tif.filehandle.lock:
+                _read_pages(tif, pages[in_file], dst[in_file], out)
+
+    def mosaic(self, frame=0, channel=0, zstack=0, level: int = None, max_size: int = None,
+               um_per_pix: float = None) -> MetadataImage:
+        """
+        Stitches all the tiles of one plane at the given resolution level. If the level is not given, the mosaic is
+        made from the smallest level that satisfies max_size and um_per_pix (see level_for), so that previews of
+        large tiled acquisitions only read the data they need.
+        """
+        level = self.level_for(max_size=max_size, um_per_pix=um_per_pix) if level is None else level
+        lvl = self._index_level(level)
+        tiles = sorted(lvl.grid)
+        ix = lvl.planes.rows_grid(t=frame, c=channel, z=zstack, p=tiles).ravel()
+        if not np.any(ix >= 0):
+            raise FrameNotFoundError(f"Plane t={frame} c={channel} z={zstack} not found at level x{level}.")
+
+        images = np.zeros((len(tiles), *lvl.tile_shape), dtype=lvl.dtype)
+        self._read_level_planes(lvl, ix, images)
+
+        oy, ox = self._tile_crop(level)
+        h, w = lvl.tile_shape[0] - 2 * oy, lvl.tile_shape[1] - 2 * ox
+        row0 = min(r for r, _ in lvl.grid.values())
+        col0 = min(c for _, c in lvl.grid.values())
+        mosaic = np.zeros(self.mosaic_shape(level), dtype=lvl.dtype)
+        for k, p in enumerate(tiles):
+            r, c = lvl.grid[p][0] - row0, lvl.grid[p][1] - col0
+            mosaic[r * h:(r + 1) * h, c * w:(c + 1) * w] = images[k, oy:oy + h, ox:ox + w]
+
+        um_per_pix = self.um_per_pix / self.level * level
+        return MetadataImage(reader='MicroMagellan',
+                             image=mosaic,
+                             pix_per_um=1 / um_per_pix, um_per_pix=um_per_pix,
+                             time_interval=self.time_interval,
+                             timestamp=self.timestamps[frame] if frame < len(self.timestamps) else None,
+                             frame=frame, channel=channel, z=zstack, width=mosaic.shape[1], height=mosaic.shape[0],
+                             intensity_range=self._intensity_range(mosaic))
+
+    def _plane_file(self, fid: int) -> Path:
+        return self.levels[self.level] / self.files[fid]
+
+    def _image(self, ix, row=0, col=0, fid=0) -> MetadataImage:
+        if ix is None or not 0 <= ix < len(self.planes):
+            raise FrameNotFoundError
+
+        plane = self.planes[ix]
+        t, c, z = int(plane['t']), int(plane['c']), int(plane['z'])
+        image = self._memmap_plane(ix)
+        if image is None:
+            image = np.zeros((self.height, self.width), dtype=self._index_level(self.level).dtype)
+            self._read_planes(np.array([ix]), image[np.newaxis])
+        return MetadataImage(reader='MicroMagellan',
+                             image=image,
+                             pix_per_um=self.pix_per_um, um_per_pix=self.um_per_pix,
+                             time_interval=self.time_interval,
+                             timestamp=self.timestamps[t] if t < len(self.timestamps) else None,
+                             frame=t, channel=c, z=z, width=self.width, height=self.height,
+                             intensity_range=self._intensity_range(image))
@@ -1,8 +1,6 @@
-import json
 import os
 import re
 from datetime import datetime
-from json import JSONDecodeError
 from pathlib import Path
 
 import numpy as np
@@ -11,13 +9,17 @@ import tifffile as tf
 from scipy.stats import stats
 
 from fileops.image._mmagellan import folder_is_micromagellan
+from fileops.image._mmanager_metadata import iter_metadata_entries
+from fileops.image._plane_table import PlaneTable
+from fileops.image._tiff_pool import tiff_pool
+from fileops.image._tifffile_planes import PlanesTifffileMixin
 from fileops.image.exceptions import FrameNotFoundError
 from fileops.image.image_file import ImageFile
 from fileops.image.imagemeta import MetadataImage
 from fileops.logger import get_logger
 
 
-class MicroMagellanPositionImageStack(ImageFile):
+class MicroMagellanPositionImageStack(PlanesTifffileMixin, ImageFile):
     log = get_logger(name='MicroMagellanPositionImageStack')
 
     def __init__(self, image_path: Path = None, failover_dt=1, **kwargs):
@@ -34,18 +36,11 @@ class MicroMagellanPositionImageStack(ImageFile):
 
         self.metadata_path = Path(image_path) / f'{img_file[:-8]}_metadata.txt'
 
-        with open(self.metadata_path) as f:
-            json_str = f.readlines()
-
-            try:
-                self.md = json.loads("".join(json_str))
-            except JSONDecodeError as e:
-                json_str[-2] = json_str[-2][:-2] + "\n"
-                terminator = [] if json_str[-2].find(":") > 0 else ["]\n"]
-                json_str = json_str[:-1] + terminator + ["}\n"] + ["}\n"]
-                # json_str = json_str[:-1]
-                print(json_str[-5:])
-                self.md = json.loads("".join(json_str))
+        # only the summary is loaded here; frame entries are streamed into the plane table by _load_imageseries
+        for key, value in iter_metadata_entries(self.metadata_path):
+            if key == 'Summary':
+                self.md = {'Summary': value}
+                break
 
         self.all_positions = [f'Pos{image_series}']
         self._load_imageseries()
@@ -133,6 +128,23 @@ class MicroMagellanPositionImageStack(ImageFile):
 
         pos = int(all_positions[self._series][-1])
         frkey = f"FrameKey-0-0-0"
+        file_ids = dict()
+
+        def _plane_rows():
+            for key, kmd in iter_metadata_entries(self.metadata_path):
+                if key[0:8] != "FrameKey":
+                    continue
+                if key == frkey:
+                    self.md[frkey] = kmd
+                t, c, z = re.search(r'^FrameKey-([0-9]*)-([0-9]*)-([0-9]*)$', key).groups()
+                t, c, z = int(t), int(c), int(z)
+
+                fname = kmd["FileName"] if "FileName" in kmd else ""
+                fid = file_ids.setdefault(fname, len(file_ids))
+                # planes of a position are stored in the page of their frame number
+                yield 0, t, c, z, fid, t, kmd["ElapsedTime-ms"] / 1000, kmd["ZPositionUm"]
+
+        self.planes = PlaneTable.from_iter(_plane_rows())
         if frkey not in self.md:
             raise FileNotFoundError(f"Couldn't find data for position {pos}.")
 
@@ -140,24 +152,13 @@ class MicroMagellanPositionImageStack(ImageFile):
         mag_rgx = re.search(r"(?P<mag>[0-9]+)x", mag_str)
         self.magnification = int(mag_rgx.groupdict()['mag'])
 
-        counter = 0
-        for key in self.md:
-            if key[0:8] == "FrameKey":
-                t, c, z = re.search(r'^FrameKey-([0-9]*)-([0-9]*)-([0-9]*)$', key).groups()
-                t, c, z = int(t), int(c), int(z)
-
-                fname = self.md[key]["FileName"] if "FileName" in self.md[key] else ""
-                fname = fname.split("/")[1] if "/" in fname else fname
-                self.files.append(fname)
-                self.timestamps.append(self.md[key]["ElapsedTime-ms"] / 1000)
-                self.zstacks.append(self.md[key]["ZPositionUm"])
-                self.frames.append(int(t))
-                self.all_planes.append(key)
-                # build dictionary where the keys are combinations of c z t and values are the index
-                self.all_planes_md_dict[f"c{int(c):0{len(str(self._md_n_channels))}d}"
-                                        f"z{int(z):0{len(str(self._md_n_zstacks))}d}"
-                                        f"t{int(t):0{len(str(self._md_n_frames))}d}"] = counter
-                counter += 1
+        self.files = list(file_ids.keys())
+        self.planes.files = self.files
+        first_planes = (self.planes.records['c'] == 0) & (self.planes.records['z'] == 0)
+        self.timestamps = sorted(np.unique(self.planes.records['timestamp'][first_planes]))
+        self.frames = sorted(self.planes.frames)
+        self.zstacks = sorted(self.planes.zstacks)
+        self.zstacks_um = sorted(np.unique(self.planes.records['z_um']))
 
         self.time_interval = getattr(stats.mode(np.diff(self.timestamps), axis=None), "mode")
 
@@ -180,42 +181,40 @@ class MicroMagellanPositionImageStack(ImageFile):
 
         self.position_md = self.md["Summary"]["StagePositions"][self._series]
 
-        self.log.info(f"{len(self.frames)} frames and {counter} image planes in total.")
+        self.log.info(f"{len(self.frames)} frames and {len(self.planes)} image planes in total.")
         super()._load_imageseries()
 
-    def ix_at(self, c, z, t):
-        czt_str = f"c{c:0{len(str(self.n_channels))}d}z{z:0{len(str(self.n_zstacks))}d}t{t:0{len(str(self.n_frames))}d}"
-        if czt_str in self.all_planes_md_dict:
-            return self.all_planes_md_dict[czt_str]
-        self.log.warning(f"No index found for c={c}, z={z}, and t={t}.")
+    def _image(self, ix, row=0, col=0, fid=0) -> MetadataImage:
+        if ix is None or not 0 <= ix < len(self.planes):
+            raise FrameNotFoundError
 
-    def _image(self, plane, row=0, col=0, fid=0) -> MetadataImage:  # PLANE HAS THE NAME OF THE FILE OF THE IMAGE PLANE
-        t, c, z = re.search(r'^FrameKey-([0-9]*)-([0-9]*)-([0-9]*)$', plane).groups()
-        t, c, z = int(t), int(c), int(z)
+        plane = self.planes[ix]
+        t, c, z = int(plane['t']), int(plane['c']), int(plane['z'])
 
         # load file from folder
-        if "FileName" in self.md[plane]:
-            file = self.md[plane]["FileName"]
-        else:
+        file = self.files[plane['fid']]
+        if not file:
             self.log.error(f'Frame {t} not found in file.')
             raise FrameNotFoundError
 
         path = os.path.join(os.path.dirname(self.image_path), file)
         if os.path.exists(path):
-            with tf.TiffFile(path) as tif:
-                if t <= len(tif.pages):
-                    image = tif.pages[t].asarray()
-                    t_int = self.timestamps[t] - self.timestamps[t - 1] if t > 0 else self.timestamps[t]
-                    return MetadataImage(reader='MicroManagerStack',
-                                         image=image,
-                                         pix_per_um=self.pix_per_um, um_per_pix=self.um_per_pix,
-                                         time_interval=t_int,
-                                         timestamp=self.timestamps[t],
-                                         frame=t, channel=c, z=z, width=self.width, height=self.height,
-                                         intensity_range=[np.min(image), np.max(image)])
-                else:
-                    self.log.error(f'Frame {t} not found in file.')
-                    raise FrameNotFoundError
+            image = self._memmap_plane(ix)
+            if image is None:
+                with tiff_pool.acquire(path) as tif, tif.filehandle.lock:
+                    page = int(plane['page'])
+                    if page >= len(tif.pages):
+                        self.log.error(f'Frame {t} not found in file.')
+                        raise FrameNotFoundError
+                    image = tif.pages[page].asarray()
+            t_int = self.timestamps[t] - self.timestamps[t - 1] if t > 0 else self.timestamps[t]
+            return MetadataImage(reader='MicroManagerStack',
+                                 image=image,
+                                 pix_per_um=self.pix_per_um, um_per_pix=self.um_per_pix,
+                                 time_interval=t_int,
+                                 timestamp=self.timestamps[t],
+                                 frame=t, channel=c, z=z, width=self.width, height=self.height,
+                                 intensity_range=self._intensity_range(image))
         else:
             self.log.error(f'Frame {t} not found in file.')
             raise FrameNotFoundError
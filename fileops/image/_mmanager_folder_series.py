@@ -1,4 +1,3 @@
-import json
 import os
 import re
 from datetime import datetime
@@ -10,13 +9,17 @@ import tifffile as tf
 from scipy.stats import stats
 
 from fileops.image._mmagellan import folder_is_micromagellan
+from fileops.image._mmanager_metadata import iter_metadata_entries
+from fileops.image._plane_table import PlaneTable
+from fileops.image._tiff_pool import tiff_pool
+from fileops.image._tifffile_planes import PlanesTifffileMixin
 from fileops.image.exceptions import FrameNotFoundError
 from fileops.image.image_file import ImageFile
 from fileops.image.imagemeta import MetadataImage
 from fileops.logger import get_logger
 
 
-class MicroManagerFolderSeries(ImageFile):
+class MicroManagerFolderSeries(PlanesTifffileMixin, ImageFile):
     log = get_logger(name='MicroManagerFolderSeries')
 
     def __init__(self, image_path: Path = None, **kwargs):
@@ -38,8 +41,11 @@ class MicroManagerFolderSeries(ImageFile):
 
         self.metadata_path = self.base_path / 'metadata.txt'
 
-        with open(self.metadata_path) as f:
-            self.md = json.load(f)
+        # only the summary is loaded here; image entries are streamed into the plane table by _load_imageseries
+        for key, value in iter_metadata_entries(self.metadata_path):
+            if key == 'Summary':
+                self.md = {'Summary': value}
+                break
 
         self.all_positions = self.md['Summary']['StagePositions']
         self._load_imageseries()
@@ -130,13 +136,39 @@ class MicroManagerFolderSeries(ImageFile):
         if not self.md:
             return
 
-        all_positions = list(set([s.split('/')[0].split('-')[1] for s in self.md.keys() if s[:8] == 'Metadata']))
-
         self.channels = self.md["Summary"]["ChNames"]
         self.um_per_z = self.md["Summary"]["z-step_um"]
 
+        w = set()
+        h = set()
+        pos_set = set()
+        all_positions = set()
+        file_ids = dict()
+
+        def _plane_rows():
+            for key, kmd in iter_metadata_entries(self.metadata_path):
+                if key[0:8] != "Metadata":
+                    continue
+                c, p, t, z = re.search(r'img_channel([0-9]*)_position([0-9]*)_time([0-9]*)_z([0-9]*).tif$',
+                                       key).groups()
+                c, p, t, z = int(c), int(p), int(t), int(z)
+                all_positions.add(key.split('/')[0].split('-')[1])
+                if c == 0 and t == 0 and z == 0:
+                    # the first image of every position is kept for the calibration and the info table
+                    self.md[key] = kmd
+                # if int(pos) == self._series:
+                fid = file_ids.setdefault(kmd["FileName"].split("/")[1], len(file_ids))
+                w.add(kmd["Width"])
+                h.add(kmd["Height"])
+                if f"Pos{p}" not in pos_set:
+                    pos_set.add(f"Pos{p}")
+                yield 0, t, c, z, fid, 0, kmd["ElapsedTime-ms"] / 1000, kmd["ZPositionUm"]
+
+        # each plane is stored in its own file
+        self.planes = PlaneTable.from_iter(_plane_rows())
+
         assert len(all_positions) == 1, "only single position stacks are currently allowed"
-        pos = int(all_positions[0][-1])
+        pos = int(all_positions.pop()[-1])
         self.image_path = self.base_path / f'img_channel000_position{pos:03d}_time000000000_z000.tif'
 
         frkey = f"Metadata-Pos{pos}/img_channel000_position{pos:03d}_time000000000_z000.tif"
@@ -150,30 +182,13 @@ class MicroManagerFolderSeries(ImageFile):
         self.um_per_pix = self.md[frkey]["PixelSizeUm"]
         self.pix_per_um = 1 / self.um_per_pix if self.um_per_pix > 0 else None
 
-        counter = 0
-        w = set()
-        h = set()
-        pos_set = set()
-        for key in self.md:
-            if key[0:8] == "Metadata":
-                c, p, t, z = re.search(r'img_channel([0-9]*)_position([0-9]*)_time([0-9]*)_z([0-9]*).tif$',
-                                       key).groups()
-                c, p, t, z = int(c), int(p), int(t), int(z)
-                # if int(pos) == self._series:
-                self.files.append(self.md[key]["FileName"].split("/")[1])
-                self.timestamps.append(self.md[key]["ElapsedTime-ms"] / 1000)
-                self.zstacks.append(self.md[key]["ZPositionUm"])
-                self.frames.append(int(t))
-                self.all_planes.append(key[14:])
-                # build dictionary where the keys are combinations of c z t and values are the index
-                self.all_planes_md_dict[f"c{int(c):0{len(str(self._md_n_channels))}d}"
-                                        f"z{int(z):0{len(str(self._md_n_zstacks))}d}"
-                                        f"t{int(t):0{len(str(self._md_n_frames))}d}"] = counter
-                w.add(self.md[key]["Width"])
-                h.add(self.md[key]["Height"])
-                if f"Pos{p}" not in pos_set:
-                    pos_set.add(f"Pos{p}")
-                counter += 1
+        self.files = list(file_ids.keys())
+        self.planes.files = self.files
+        first_planes = (self.planes.records['c'] == 0) & (self.planes.records['z'] == 0)
+        self.timestamps = sorted(np.unique(self.planes.records['timestamp'][first_planes]))
+        self.frames = sorted(self.planes.frames)
+        self.zstacks = sorted(self.planes.zstacks)
+        self.zstacks_um = sorted(np.unique(self.planes.records['z_um']))
 
         self.time_interval = getattr(stats.mode(np.diff(self.timestamps), axis=None), "mode")
         self.width = w.pop() if len(w) == 1 else None
@@ -197,31 +212,31 @@ class MicroManagerFolderSeries(ImageFile):
                     self.pix_per_um = res
                     self.um_per_pix = 1. / res
 
-        self.log.info(f"{len(self.frames)} frames and {counter} image planes in total.")
+        self.log.info(f"{len(self.frames)} frames and {len(self.planes)} image planes in total.")
         super()._load_imageseries()
 
-    def _image(self, plane, row=0, col=0, fid=0) -> MetadataImage:
-        if re.search(r'^*_Z([0-9]*)_C([0-9]*)_T([0-9]*).ome.tif$', plane) is not None:
-            z, c, t = re.search(r'^*_Z([0-9]*)_C([0-9]*)_T([0-9]*).ome.tif$', plane).groups()
-            z, c, t = int(z), int(c), int(t)
-        elif re.search(r'img_channel([0-9]*)_position([0-9]*)_time([0-9]*)_z([0-9]*).tif$', plane) is not None:
-            c, p, t, z = re.search(r'img_channel([0-9]*)_position([0-9]*)_time([0-9]*)_z([0-9]*).tif$', plane).groups()
-            c, p, t, z = int(c), int(p), int(t), int(z)
-        else:
+    def _plane_file(self, fid: int) -> Path:
+        return self.base_path / self.files[fid]
+
+    def _image(self, ix, row=0, col=0, fid=0) -> MetadataImage:
+        if ix is None or not 0 <= ix < len(self.planes):
             raise FrameNotFoundError
 
+        plane = self.planes[ix]
+        c, t, z = int(plane['c']), int(plane['t']), int(plane['z'])
+
         # load file from folder
-        fname = os.path.join(self.base_path, plane)
+        fname = self._plane_file(plane['fid'])
         if os.path.exists(fname):
-            with tf.TiffFile(fname) as tif:
+            with tiff_pool.acquire(fname) as tif, tif.filehandle.lock:
                 image = tif.pages[0].asarray()
             return MetadataImage(reader='MicroManagerFolder',
                                  image=image,
                                  pix_per_um=self.pix_per_um, um_per_pix=self.um_per_pix,
                                  time_interval=None,
-                                 timestamp=self.timestamps[t],
+                                 timestamp=float(plane['timestamp']),
                                  frame=t, channel=c, z=z, width=self.width, height=self.height,
-                                 intensity_range=[np.min(image), np.max(image)])
+                                 intensity_range=self._intensity_range(image))
         else:
             self.log.error(f'File of frame {t} not found in folder.')
             raise FrameNotFoundError
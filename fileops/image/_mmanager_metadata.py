@@ -1,16 +1,22 @@
-import itertools
 import json
 import os
 import re
 from logging import Logger
 from pathlib import Path
-from typing import List, Dict
+from itertools import chain
+from typing import Dict, Iterator, List, Tuple
 
 import numpy as np
 import tifffile as tf
 from fileops.image._base import ImageFileBase
+from fileops.image._metadata_index import load_index, save_index
+from fileops.image._plane_table import PlaneTable
+from fileops.image._tiff_pool import tiff_pool
+from fileops.logger import get_logger
 from fileops.pathutils import find
 
+log = get_logger(name='mmanager_metadata')
+
 
 def _find_associated_files(path, prefix) -> List[Path]:
     out = list()
@@ -23,6 +29,51 @@ def _find_associated_files(path, prefix) -> List[Path]:
     return out
 
 
+def iter_metadata_entries(path: Path, chunk_size=1 << 20) -> Iterator[Tuple[str, Dict]]:
+    """
+    Iterates over the top level entries (Summary, FrameKey-*, Metadata-Pos*) of a Micro-Manager metadata file,
+    decoding one entry at a time instead of loading the whole JSON document in memory.
+    A truncated trailer, as left by interrupted acquisitions, ends the iteration after the last complete entry.
+    """
+    decoder = json.JSONDecoder()
+    separator = re.compile(r'[\s,]*')
+    colon = re.compile(r'\s*:\s*')
+    with open(path, encoding='utf-8') as f:
+        buf = f.read(chunk_size)
+        eof = len(buf) < chunk_size
+        pos = separator.match(buf).end()
+        if buf[pos:pos + 1] != '{':
+            raise ValueError(f"{path} does not hold a JSON object.")
+        pos += 1
+
+        while True:
+            pos = separator.match(buf, pos).end()
+            if buf.startswith('}', pos):
+                return
+            try:
+                key, end = decoder.raw_decode(buf, pos)
+                sep = colon.match(buf, end)
+                if sep is None:
+                    raise ValueError
+                value, end = decoder.raw_decode(buf, sep.end())
+                if end >= len(buf) and not eof:
+                    raise ValueError
+            except ValueError:  # also catches json.JSONDecodeError
+                if eof:
+                    if buf[pos:].strip():
+                        log.warning(f"Metadata file {path} is truncated, ignoring its last entry.")
+                    return
+                # the entry continues in the next chunk of the file
+                chunk = f.read(chunk_size)
+                eof = len(chunk) < chunk_size
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+
+            pos = end
+            yield key, value
+
+
 def mm_metadata_files(search_path: Path, image_path: Path) -> List[str]:
     base_name = image_path.name.split(".ome")[0]
     if base_name[-2:] == "_1":
@@ -37,6 +88,12 @@ def mm_metadata_files(search_path: Path, image_path: Path) -> List[str]:
 class MetadataVersion10Mixin(ImageFileBase):
     log: Logger
     frames_per_file: Dict
+    use_metadata_index = True  # keep the parsed metadata in an index that is reused while the files don't change
+    _index_attributes = ('files', 'frames_per_file', 'timestamps', 'time_interval', 'frames', 'zstacks', 'zstacks_um',
+                         'channels', 'positions', 'all_positions', 'n_frames', 'n_channels', 'n_zstacks',
+                         'n_positions', 'width', 'height', 'pix_per_um', 'um_per_pix', 'um_per_z',
+                         '_md_channel_names', '_md_channels', '_md_n_frames', '_md_n_channels', '_md_n_zstacks',
+                         '_dtype')
 
     def __init__(self, **kwargs):
         m_names_match = mm_metadata_files(self.image_path.parent, self.image_path)
@@ -56,11 +113,40 @@ class MetadataVersion10Mixin(ImageFileBase):
         super().__init__(**kwargs)
 
     def _load_metadata(self):
+        state = load_index(self.image_path) if self.use_metadata_index else None
+        if state is not None:
+            self._restore_index_state(state)
+            return
+
+        self._parse_metadata()
+        if self.use_metadata_index and not self.error_loading_metadata:
+            sources = [self.image_path, self.metadata_path] + [self.image_path.parent / f for f in self.files]
+            save_index(self.image_path, sources, self._index_state())
+
+    def _index_state(self) -> Dict:
+        state = {a: getattr(self, a) for a in self._index_attributes}
+        state['md'] = self.md
+        state['planes'] = self.planes.records
+        return state
+
+    def _restore_index_state(self, state: Dict):
+        for a in self._index_attributes:
+            setattr(self, a, state[a])
+        self.md = state['md']
+        self.planes = PlaneTable(state['planes'], files=self.files)
+
+    def _parse_metadata(self):
+        # metadata entries are parsed as the plane table is built; only the summary and the first frame are kept
+        entries = iter_metadata_entries(self.metadata_path)
         try:
-            with open(self.metadata_path) as f:
-                self.md = json.load(f)
-                summary = self.md['Summary']
+            self.md = dict()
+            for key, value in entries:
+                self.md[key] = value
+                if key == 'Summary':
+                    break
+            summary = self.md['Summary']
         except FileNotFoundError:
+            entries = iter(())
             self.error_loading_metadata = True
             summary = {
                 "ChNames":        None,
@@ -74,8 +160,9 @@ class MetadataVersion10Mixin(ImageFileBase):
                 "z-step_um":      np.nan,
             }
 
-        with tf.TiffFile(self.image_path) as tif:
-            imagej_metadata = tif.imagej_metadata
+        with tiff_pool.acquire(self.image_path) as tif, tif.filehandle.lock:
+            # copied as the parsed metadata is cached in the shared file handle
+            imagej_metadata = dict(tif.imagej_metadata) if tif.imagej_metadata is not None else None
             if imagej_metadata is not None and "Info" in imagej_metadata:
                 # get rid of any comments in the beginning of the file that are not JSON compliant
                 info_str = re.sub(r'^(.|\n)*?\{', '{', imagej_metadata["Info"])
@@ -128,50 +215,57 @@ class MetadataVersion10Mixin(ImageFileBase):
         self._md_n_frames = max(mmf_size_t, mm_size_t)
         self._md_n_channels = max(mmf_size_c, mm_size_c)
 
-        # build a list of the images stored in sequence
+        # build a table of the images stored in sequence
         positions = set()
-        for counter, fkey in enumerate(list(self.md.keys())[1:]):
-            if fkey[0:8] == "FrameKey":
+        # associated files found through the file prefix keep their order in the list of files
+        file_ids = {f: k for k, f in enumerate(self.files)}
+        timestamps = list()
+
+        def _frame_rows():
+            frame_keys = ((k, v) for k, v in chain(list(self.md.items()), entries) if k[0:8] == "FrameKey")
+            for page, (fkey, fmd) in enumerate(frame_keys):
                 t, c, z = re.search(r'^FrameKey-([0-9]*)-([0-9]*)-([0-9]*)$', fkey).groups()
                 t, c, z = int(t), int(c), int(z)
+                if page == 0:
+                    self.md[fkey] = fmd
 
-                positions.add(self.md[fkey]["PositionName"])
-                fname = self.md[fkey]["FileName"] if "FileName" in self.md[fkey] else ""
+                positions.add(fmd["PositionName"])
+                fname = fmd["FileName"] if "FileName" in fmd else ""
                 fname = fname.split("/")[1] if "/" in fname else fname
-                self.files.append(fname)
+                fid = file_ids.setdefault(fname, len(file_ids))
+                ts = int(fmd.get("ElapsedTime-ms", -1e6)) / 1000
                 if z == 0 and c == 0:
-                    self.timestamps.append(int(self.md[fkey].get("ElapsedTime-ms", -1e6)) / 1000)
-                self.channels.add(c)
-                self.zstacks.append(z)
-                self.zstacks_um.append(self.md[fkey]["ZPositionUm"])
-                self.frames.append(t)
-                # build dictionary where the keys are combinations of c z t and values are the index
-                key = (f"c{c:0{len(str(self._md_n_channels))}d}"
-                       f"z{z:0{len(str(self._md_n_zstacks))}d}"
-                       f"t{t:0{len(str(self._md_n_frames))}d}")
-                self.all_planes.append(key)
-                if key in self.all_planes_md_dict:
-                    # raise KeyError("Keys should not repeat!")
-                    print(f"Keys should not repeat! ({key})")
-                else:
-                    # print(f"{fkey} - {key} gets {counter}")
-                    self.all_planes_md_dict[key] = counter
-
-        self.timestamps = sorted(np.unique(self.timestamps))
-        self.frames = sorted(np.unique(self.frames))
-        self.zstacks = sorted(np.unique(self.zstacks))
-        self.zstacks_um = sorted(np.unique(self.zstacks_um))
+                    timestamps.append(ts)
+                yield 0, t, c, z, fid, page, ts, fmd["ZPositionUm"]
+
+        self.planes = PlaneTable.from_iter(_frame_rows())
+        self.files = list(file_ids.keys())
+        self.planes.files = self.files
+        if self.planes.n_repeated > 0:
+            self.log.warning(f"Keys should not repeat! ({self.planes.n_repeated} repeated planes found)")
+
+        self.channels = set(self.planes.channels.tolist())
+        self.timestamps = sorted(np.unique(timestamps))
+        self.frames = sorted(self.planes.frames)
+        self.zstacks = sorted(self.planes.zstacks)
+        self.zstacks_um = sorted(np.unique(self.planes.records['z_um']))
 
         # count stored images
-        unq_files = np.unique(self.files)
         n_idx = 0
-        for f in unq_files:
-            with tf.TiffFile(self.image_path.parent / f) as tif:
+        for f in self.files:
+            with tiff_pool.acquire(self.image_path.parent / f) as tif, tif.filehandle.lock:
                 self.frames_per_file[f] = len(tif.pages)
                 n_idx += len(tif.pages)
-        last_recorded_image_idx = self.all_planes[n_idx - 1]
-        rgx = re.search(r'^c([0-9]*)z([0-9]*)t([0-9]*)$', last_recorded_image_idx)
-        last_c, last_z, last_t = rgx.groups()
+        last_t = self.planes[n_idx - 1]['t']
+
+        # address every plane by the page inside the file that stores it; files follow each other in the order
+        # in which their planes were recorded
+        fids = self.planes.records['fid']
+        recorded, first_row = np.unique(fids, return_index=True)
+        recorded = recorded[np.argsort(first_row)]
+        file_first_page = np.zeros(len(self.files), dtype=np.int64)
+        file_first_page[recorded] = np.cumsum([0] + [self.frames_per_file[self.files[f]] for f in recorded[:-1]])
+        self.planes.records['page'] -= file_first_page[fids]
 
         # check consistency of stored number of frames vs originally recorded in the metadata
         n_frames = int(last_t)
@@ -224,16 +318,9 @@ class MetadataVersion10Mixin(ImageFileBase):
         self.time_interval = max(float(delta_t_mm), float(delta_t_im)) / 1000
 
         if self.error_loading_metadata:
-            for counter, fkey in enumerate(itertools.product(self.frames, self.channels, self.zstacks)):
-                t, c, z = fkey
-                t, c, z = int(t), int(c), int(z)
-
-                # build dictionary where the keys are combinations of c z t and values are the index
-                key = (f"c{c:0{len(str(self._md_n_channels))}d}"
-                       f"z{z:0{len(str(self._md_n_zstacks))}d}"
-                       f"t{t:0{len(str(self._md_n_frames))}d}")
-                self.all_planes.append(key)
-                self.all_planes_md_dict[key] = counter
+            t, c, z = np.meshgrid(self.frames, sorted(self.channels), self.zstacks, indexing='ij')
+            self.planes = PlaneTable.from_columns(t=t.ravel(), c=c.ravel(), z=z.ravel(),
+                                                  timestamp=self.time_interval * t.ravel(), files=self.files)
 
             self.timestamps = [self.time_interval * f for f in self.frames]
 
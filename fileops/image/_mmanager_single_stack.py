@@ -2,18 +2,19 @@ import numpy as np
 import os
 import pandas as pd
 import re
-import tifffile as tf
 from datetime import datetime, time
 from pathlib import Path
 
 from fileops.logger import get_logger
 from ._mmanager_metadata import MetadataVersion10Mixin, mm_metadata_files
+from ._tiff_pool import tiff_pool
+from ._tifffile_planes import PlanesTifffileMixin
 from .exceptions import FrameNotFoundError
 from .image_file import ImageFile
 from .imagemeta import MetadataImage
 
 
-class MicroManagerSingleImageStack(ImageFile, MetadataVersion10Mixin):
+class MicroManagerSingleImageStack(PlanesTifffileMixin, ImageFile, MetadataVersion10Mixin):
     log = get_logger(name='MicroManagerSingleImageStack')
 
     def __init__(self, image_path: Path, **kwargs):
@@ -34,7 +35,7 @@ class MicroManagerSingleImageStack(ImageFile, MetadataVersion10Mixin):
             return False
 
         # check for data structures in tiff file
-        with tf.TiffFile(path) as tif:
+        with tiff_pool.acquire(path) as tif, tif.filehandle.lock:
             if not hasattr(tif, "ome_metadata") or not tif.ome_metadata:
                 return False
             if not hasattr(tif, "micromanager_metadata") or not tif.micromanager_metadata:
@@ -89,34 +90,31 @@ class MicroManagerSingleImageStack(ImageFile, MetadataVersion10Mixin):
         self._info = pd.DataFrame(self._info, index=[0])
         return self._info
 
-    def _image(self, plane, row=0, col=0, fid=0) -> MetadataImage:
-        rgx = re.search(r'^c([0-9]*)z([0-9]*)t([0-9]*)$', plane)
-        if rgx is None:
-            raise FrameNotFoundError
-
-        c, z, t = rgx.groups()
-        t, c, z = int(t), int(c), int(z)
-
-        key = f"c{c:0{len(str(self.n_channels))}d}z{z:0{len(str(self.n_zstacks))}d}t{t:0{len(str(self.n_frames))}d}"
-        ix = self.all_planes_md_dict[key]
-
-        filename = self.files[ix] if not self.error_loading_metadata else self.files[0]
-        im_path = self.image_path.parent / filename
-
-        # find all files previous to this frame to calculate number of indexes already visited
-        fprev_set = set(np.unique(self.files[:ix + 1])) - set([filename])
-        idx_prev = np.sum(self.frames_per_file[f] for f in fprev_set)
-        ix -= idx_prev
+    def _read_page(self, ix, t, c, z) -> np.ndarray:
+        plane = self.planes[ix]
+        fid, ix = int(plane['fid']), int(plane['page'])
+        im_path = self._plane_file(fid)
 
         if not os.path.exists(im_path):
             self.log.error(f'Frame, channel, z ({t},{c},{z}) not found in file.')
             raise FrameNotFoundError(f'Frame, channel, z ({t},{c},{z}) not found in file.')
 
-        with tf.TiffFile(im_path) as tif:
+        with self._open_tiff(fid) as tif, tif.filehandle.lock:
             if ix >= len(tif.pages):
                 self.log.error(f'Frame, channel, z ({t},{c},{z}) not found in file.')
                 raise FrameNotFoundError(f'Frame, channel, z ({t},{c},{z}) not found in file.')
-            image = tif.pages[ix].asarray()
+            return tif.pages[ix].asarray()
+
+    def _image(self, ix, row=0, col=0, fid=0) -> MetadataImage:
+        if ix is None or not 0 <= ix < len(self.planes):
+            raise FrameNotFoundError
+
+        plane = self.planes[ix]
+        t, c, z = int(plane['t']), int(plane['c']), int(plane['z'])
+
+        image = self._memmap_plane(ix)
+        if image is None:
+            image = self._read_page(ix, t, c, z)
 
         t_int = self.timestamps[t] - self.timestamps[t - 1] if t > 0 else self.timestamps[t]
         return MetadataImage(reader='MicroManagerStack',
@@ -125,4 +123,4 @@ class MicroManagerSingleImageStack(ImageFile, MetadataVersion10Mixin):
                              time_interval=t_int,
                              timestamp=self.timestamps[t],
                              frame=t, channel=c, z=z, width=self.width, height=self.height,
-                             intensity_range=[np.min(image), np.max(image)])
+                             intensity_range=self._intensity_range(image))
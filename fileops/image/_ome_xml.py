@@ -0,0 +1,69 @@
+import io
+from array import array
+from typing import Dict, List, NamedTuple, Union
+from xml.etree.ElementTree import iterparse
+
+import numpy as np
+
+
+class OMEImageInfo(NamedTuple):
+    attrib: Dict[str, str]  # attributes of the Image element (ID, Name, ...)
+    pixels: Dict[str, str]  # attributes of the Pixels element (SizeX, PhysicalSizeX, DimensionOrder, ...)
+    planes: Dict[str, np.ndarray]  # TheC, TheZ, TheT, DeltaT and PositionZ columns of the Plane elements
+
+
+def _local(tag: str) -> str:
+    return tag.rpartition('}')[2]
+
+
+def parse_ome_xml(xml: Union[str, bytes]) -> List[OMEImageInfo]:
+    """
+    Reads the Image, Pixels and Plane elements of an OME-XML document in a single streaming pass.
+    Plane attributes go straight into typed columns (DeltaT and PositionZ are NaN where missing), and elements are
+    discarded as soon as they are read, so memory grows with the number of planes rather than with the document.
+    """
+    source = io.BytesIO(xml.encode('utf-8') if isinstance(xml, str) else xml)
+    images = list()
+    image, pixels, columns = None, None, None
+    open_elements = list()
+    for event, elem in iterparse(source, events=('start', 'end')):
+        tag = _local(elem.tag)
+        if event == 'start':
+            open_elements.append(elem)
+            if tag == 'Image':
+                image, pixels = dict(elem.attrib), dict()
+                columns = {'TheC': array('i'), 'TheZ': array('i'), 'TheT': array('i'),
+                           'DeltaT': array('d'), 'PositionZ': array('d')}
+            elif tag == 'Pixels' and image is not None:
+                pixels = dict(elem.attrib)
+            continue
+
+        open_elements.pop()
+        if tag == 'Plane' and columns is not None:
+            get = elem.attrib.get
+            columns['TheC'].append(int(get('TheC', 0)))
+            columns['TheZ'].append(int(get('TheZ', 0)))
+            columns['TheT'].append(int(get('TheT', 0)))
+            columns['DeltaT'].append(float(get('DeltaT', 'nan')))
+            columns['PositionZ'].append(float(get('PositionZ', 'nan')))
+        elif tag == 'Image' and image is not None:
+            images.append(OMEImageInfo(attrib=image, pixels=pixels,
+                                       planes={k: np.frombuffer(v, dtype=np.int32 if v.typecode == 'i' else np.float64)
+                                               for k, v in columns.items()}))
+            image, pixels, columns = None, None, None
+        if open_elements:
+            # elements are dropped from the tree as soon as they end, so it never holds more than one branch
+            open_elements[-1].remove(elem)
+    return images
+
+
+def planes_from_dimension_order(pixels: Dict[str, str]) -> Dict[str, np.ndarray]:
+    """ TheC, TheZ and TheT columns of the planes of a Pixels element without Plane elements, in DimensionOrder. """
+    order = pixels.get('DimensionOrder', 'XYZCT')[2:]
+    sizes = {d: int(pixels.get(f"Size{d}", 1)) for d in order}
+    # the first dimension of the order varies fastest
+    grids = np.meshgrid(*(np.arange(sizes[d]) for d in reversed(order)), indexing='ij')
+    coords = {d: g.ravel().astype(np.int32) for d, g in zip(reversed(order), grids)}
+    n = coords[order[0]].size
+    return {'TheC': coords['C'], 'TheZ': coords['Z'], 'TheT': coords['T'],
+            'DeltaT': np.full(n, np.nan), 'PositionZ': np.full(n, np.nan)}
@@ -0,0 +1,136 @@
+from typing import Iterable, List, Union
+
+import numpy as np
+
+PLANE_DTYPE = np.dtype([
+    ('p', np.int32),  # stage position
+    ('t', np.int32),  # frame
+    ('c', np.int32),  # channel
+    ('z', np.int32),  # focal plane
+    ('fid', np.int32),  # index in the list of files that the acquisition extends to
+    ('page', np.int64),  # page offset of the plane (meaning depends on the reader)
+    ('timestamp', np.float64),  # in seconds
+    ('z_um', np.float64),  # position of the focal plane in micrometers
+])
+
+Selector = Union[None, int, slice, range, Iterable[int]]
+
+
+class PlaneTable:
+    """
+    Compact table of all the image planes of an acquisition.
+    Rows are stored in a NumPy structured array (see PLANE_DTYPE), and a dense (p, t, c, z) -> row lookup array
+    allows constant time and vectorized queries of plane indexes.
+    """
+
+    def __init__(self, records: np.ndarray, files: List[str] = None):
+        self.records = np.asarray(records, dtype=PLANE_DTYPE)
+        self.files = list(files) if files is not None else list()
+        self.n_repeated = 0
+        self._lut = self._build_lut()
+
+    @classmethod
+    def from_iter(cls, rows: Iterable, files: List[str] = None, count=-1) -> 'PlaneTable':
+        """
+        Builds the table from an iterable of (p, t, c, z, fid, page, timestamp, z_um) tuples without
+        instantiating intermediate Python lists.
+        """
+        return cls(np.fromiter(rows, dtype=PLANE_DTYPE, count=count), files=files)
+
+    @classmethod
+    def from_columns(cls, t, c, z, p=0, fid=0, page=None, timestamp=np.nan, z_um=np.nan,
+                     files: List[str] = None) -> 'PlaneTable':
+        """ Builds the table from array-like columns; scalars are broadcast to the number of planes. """
+        t = np.asarray(t)
+        records = np.empty(t.size, dtype=PLANE_DTYPE)
+        records['t'] = t
+        records['c'] = c
+        records['z'] = z
+        records['p'] = p
+        records['fid'] = fid
+        records['page'] = np.arange(t.size) if page is None else page
+        records['timestamp'] = timestamp
+        records['z_um'] = z_um
+        return cls(records, files=files)
+
+    def _build_lut(self) -> np.ndarray:
+        if len(self.records) == 0:
+            return np.full((0, 0, 0, 0), -1, dtype=np.int64)
+
+        coords = tuple(self.records[k].astype(np.int64) for k in ('p', 't', 'c', 'z'))
+        shape = tuple(int(a.max()) + 1 for a in coords)
+        lut = np.full(shape, -1, dtype=np.int64)
+        # in case of repeated keys, the first plane recorded takes precedence
+        linear_ix = np.ravel_multi_index(coords, shape)
+        unq_ix, first_row = np.unique(linear_ix, return_index=True)
+        self.n_repeated = len(linear_ix) - len(unq_ix)
+        lut.flat[unq_ix] = first_row
+        return lut
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, item):
+        return self.records[item]
+
+    @property
+    def shape(self):
+        """ Size of the (p, t, c, z) lookup space. """
+        return self._lut.shape
+
+    @property
+    def positions(self) -> np.ndarray:
+        return np.unique(self.records['p'])
+
+    @property
+    def frames(self) -> np.ndarray:
+        return np.unique(self.records['t'])
+
+    @property
+    def channels(self) -> np.ndarray:
+        return np.unique(self.records['c'])
+
+    @property
+    def zstacks(self) -> np.ndarray:
+        return np.unique(self.records['z'])
+
+    def ix(self, c, z, t, p=0) -> Union[int, None]:
+        """ Returns the row of the plane at the given coordinates, or None if the plane was not recorded. """
+        try:
+            if min(p, t, c, z) < 0:
+                return None
+            row = self._lut[p, t, c, z]
+        except IndexError:
+            return None
+        return int(row) if row >= 0 else None
+
+    def rows(self, t: Selector = None, c: Selector = None, z: Selector = None, p: Selector = None) -> np.ndarray:
+        """
+        Vectorized lookup of plane rows; each argument is either None (all values), an integer, a slice, a range or
+        an iterable of integers. Planes that were not recorded are left out of the result.
+        The output array keeps the (p, t, c, z) order of the lookup space.
+        """
+        rows = self.rows_grid(t=t, c=c, z=z, p=p).ravel()
+        return rows[rows >= 0]
+
+    def rows_grid(self, t: Selector = None, c: Selector = None, z: Selector = None, p: Selector = None) -> np.ndarray:
+        """ Same as rows, but keeps the (p, t, c, z) shape of the selection and marks missing planes with -1. """
+        sel = [self._axis_selection(s, n) for s, n in zip((p, t, c, z), self.shape)]
+        grid = np.full([len(s) for s in sel], -1, dtype=np.int64)
+        inside = [(s >= 0) & (s < n) for s, n in zip(sel, self.shape)]
+        if all(np.any(i) for i in inside):
+            grid[np.ix_(*inside)] = self._lut[np.ix_(*[s[i] for s, i in zip(sel, inside)])]
+        return grid
+
+    @staticmethod
+    def _axis_selection(s: Selector, n: int) -> np.ndarray:
+        if s is None:
+            return np.arange(n)
+        if isinstance(s, slice):
+            return np.arange(n)[s]
+        if isinstance(s, (int, np.integer)):
+            return np.array([s], dtype=np.int64)
+        return np.asarray(list(s), dtype=np.int64)
+
+    def file_of(self, ix: int) -> str:
+        return self.files[self.records['fid'][ix]]
@@ -0,0 +1,78 @@
+from typing import Dict, Iterable
+
+import numpy as np
+
+PROJECTIONS = ('max', 'min', 'mean', 'sum', 'std', 'argmax')
+
+
+class ProjectionAccumulator:
+    """
+    Folds image planes one at a time into running statistics, so that projections of a stack are computed in a
+    single pass without holding the whole volume in memory.
+    The mean and standard deviation are updated with Welford's algorithm; argmax is the depth index of the maximum.
+    """
+
+    def __init__(self, projections: Iterable[str] = PROJECTIONS):
+        self.projections = tuple(projections)
+        unknown = set(self.projections) - set(PROJECTIONS)
+        if unknown:
+            raise ValueError(f"unknown projections {unknown}, expected any of {PROJECTIONS}.")
+
+        self.n = 0
+        self._max = self._min = self._sum = self._mean = self._m2 = self._argmax = None
+
+    def add(self, plane: np.ndarray, z: int = None):
+        z = self.n if z is None else z
+        need = set(self.projections)
+        self.n += 1
+
+        if self.n == 1:
+            if need & {'max', 'argmax'}:
+                self._max = np.array(plane)
+            if 'argmax' in need:
+                self._argmax = np.full(plane.shape, z, dtype=np.int32)
+            if 'min' in need:
+                self._min = np.array(plane)
+            if 'sum' in need:
+                self._sum = plane.astype(np.int64 if np.issubdtype(plane.dtype, np.integer) else np.float64)
+            if need & {'mean', 'std'}:
+                self._mean = plane.astype(np.float64)
+            if 'std' in need:
+                self._m2 = np.zeros(plane.shape, dtype=np.float64)
+            return
+
+        if self._argmax is not None:
+            self._argmax[plane > self._max] = z
+        if self._max is not None:
+            np.maximum(self._max, plane, out=self._max)
+        if self._min is not None:
+            np.minimum(self._min, plane, out=self._min)
+        if self._sum is not None:
+            self._sum += plane
+        if self._mean is not None:
+            delta = plane - self._mean
+            self._mean += delta / self.n
+            if self._m2 is not None:
+                self._m2 += delta * (plane - self._mean)
+
+    def result(self, projection: str) -> np.ndarray:
+        if projection not in self.projections:
+            raise ValueError(f"projection {projection} was not accumulated.")
+        if self.n == 0:
+            raise ValueError("no planes were accumulated.")
+
+        if projection == 'max':
+            return self._max
+        if projection == 'min':
+            return self._min
+        if projection == 'sum':
+            return self._sum
+        if projection == 'mean':
+            return self._mean
+        if projection == 'std':
+            return np.sqrt(self._m2 / self.n)
+        if projection == 'argmax':
+            return self._argmax
+
+    def results(self) -> Dict[str, np.ndarray]:
+        return {p: self.result(p) for p in self.projections}
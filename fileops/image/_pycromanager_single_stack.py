@@ -1,12 +1,15 @@
 import numbers
 import re
 from pathlib import Path
+from typing import Union
 
 import numpy as np
 from pycromanager import Core, Studio
 
 from fileops.image import MicroManagerSingleImageStack
+from fileops.image._roi import Bounds
 from fileops.image.exceptions import FrameNotFoundError
+from fileops.image.image_file import ImageFile
 from fileops.image.imagemeta import MetadataImage
 from fileops.logger import get_logger
 
@@ -17,6 +20,7 @@ class MMCoreException(BaseException):
 
 class PycroManagerSingleImageStack(MicroManagerSingleImageStack):
     log = get_logger(name='PycroManagerSingleImageStack')
+    max_read_workers = 1  # the Micro-Manager data store is accessed from one thread
 
     def __init__(self, image_path: Path, raise_pycromanager_exception=False, **kwargs):
         self.mmc = None
@@ -63,13 +67,23 @@ class PycroManagerSingleImageStack(MicroManagerSingleImageStack):
                 self._fail_pycromanager = True
                 raise MMCoreException(e)
 
-    def _image(self, plane, row=0, col=0, fid=0) -> MetadataImage:
-        rgx = re.search(r'^c([0-9]*)z([0-9]*)t([0-9]*)$', plane)
-        if rgx is None:
+    def _read_planes(self, ix: np.ndarray, out: np.ndarray, roi: Union[None, Bounds] = None):
+        # planes are read one by one through the Micro-Manager data store unless it failed to start
+        if self._fail_pycromanager:
+            return super()._read_planes(ix, out, roi=roi)
+        return ImageFile._read_planes(self, ix, out, roi=roi)
+
+    def _image_roi(self, ix, roi: Union[None, Bounds]) -> MetadataImage:
+        if self._fail_pycromanager:
+            return super()._image_roi(ix, roi)
+        return ImageFile._image_roi(self, ix, roi)
+
+    def _image(self, ix, row=0, col=0, fid=0) -> MetadataImage:
+        if ix is None or not 0 <= ix < len(self.planes):
             raise FrameNotFoundError
 
-        c, z, t = rgx.groups()
-        c, z, t = int(c), int(z), int(t)
+        plane = self.planes[ix]
+        c, z, t = int(plane['c']), int(plane['z']), int(plane['t'])
 
         if not self._fail_pycromanager:
             try:
@@ -78,11 +92,11 @@ class PycroManagerSingleImageStack(MicroManagerSingleImageStack):
                 if self._raise_pycromanager_exception:
                     raise e
                 else:
-                    return super()._image(plane, row=0, col=0, fid=0)
+                    return super()._image(ix, row=0, col=0, fid=0)
         else:
             if self._raise_pycromanager_exception:
                 raise MMCoreException("Micro-Manager server is not on.")
-            return super()._image(plane, row=0, col=0, fid=0)
+            return super()._image(ix, row=0, col=0, fid=0)
 
         img = self.mm_store.get_image(self.mm_cb.t(t).p(self.position).c(c).z(z).build())
         if img is not None:
@@ -96,4 +110,4 @@ class PycroManagerSingleImageStack(MicroManagerSingleImageStack):
                              time_interval=None,
                              timestamp=self.timestamps[t],
                              frame=t, channel=c, z=z, width=self.width, height=self.height,
-                             intensity_range=[np.min(image), np.max(image)])
+                             intensity_range=self._intensity_range(image))
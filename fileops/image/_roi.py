@@ -0,0 +1,33 @@
+from typing import Tuple, Union
+
+import numpy as np
+
+Bounds = Tuple[int, int, int, int]  # (y0, y1, x0, x1) in pixels, end exclusive
+
+
+def roi_bounds(roi, width: int, height: int) -> Union[None, Bounds]:
+    """
+    Rectangle of pixels covered by a region of interest, clipped to the image.
+    The region can be an ImageJ ROI (anything with left, top, right and bottom attributes), a (rows, columns) tuple
+    of slices, or a (y0, y1, x0, x1) tuple of bounds. None stands for the whole image.
+    """
+    if roi is None:
+        return None
+    if all(hasattr(roi, a) for a in ('left', 'top', 'right', 'bottom')):
+        x0, y0 = int(min(roi.left, roi.right)), int(min(roi.top, roi.bottom))
+        y1, x1 = y0 + int(abs(roi.bottom - roi.top)), x0 + int(abs(roi.right - roi.left))
+    elif len(roi) == 2 and all(isinstance(s, slice) for s in roi):
+        (y0, y1, _), (x0, x1, _) = roi[0].indices(height), roi[1].indices(width)
+    else:
+        y0, y1, x0, x1 = (int(v) for v in roi)
+
+    y0, y1 = int(np.clip(y0, 0, height)), int(np.clip(y1, 0, height))
+    x0, x1 = int(np.clip(x0, 0, width)), int(np.clip(x1, 0, width))
+    if y1 <= y0 or x1 <= x0:
+        raise ValueError(f"Region of interest {roi} doesn't overlap the image of {width}x{height} pixels.")
+    return y0, y1, x0, x1
+
+
+def roi_shape(bounds: Bounds) -> Tuple[int, int]:
+    y0, y1, x0, x1 = bounds
+    return y1 - y0, x1 - x0
@@ -0,0 +1,141 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Union
+
+import tifffile as tf
+
+
+class _PooledTiff:
+    def __init__(self, tif: tf.TiffFile):
+        self.tif = tif
+        self.n_users = 0
+
+
+class TiffFilePool:
+    """
+    Bounded pool of open TiffFile handles keyed by path, shared across reader instances.
+    Handles that are not in use are closed in least recently used order once the pool exceeds max_open files.
+    File handles are opened with their lock enabled, so callers that share a handle between threads should hold
+    tif.filehandle.lock while accessing pages.
+    """
+
+    def __init__(self, max_open: int = 32):
+        self._max_open = max(1, int(max_open))
+        self._handles: Dict[str, _PooledTiff] = OrderedDict()
+        self._opened_before = set()
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.opens = 0
+        self.reopens = 0
+        self.evictions = 0
+
+    @property
+    def max_open(self) -> int:
+        return self._max_open
+
+    @max_open.setter
+    def max_open(self, value: int):
+        with self._lock:
+            self._max_open = max(1, int(value))
+            self._evict()
+
+    @property
+    def n_open(self) -> int:
+        return len(self._handles)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'open':      len(self._handles),
+                'max_open':  self._max_open,
+                'hits':      self.hits,
+                'opens':     self.opens,
+                'reopens':   self.reopens,
+                'evictions': self.evictions,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.opens = self.reopens = self.evictions = 0
+
+    @contextmanager
+    def acquire(self, path: Union[str, Path]) -> tf.TiffFile:
+        """ Yields an open TiffFile for path; the handle is kept open in the pool after the block exits. """
+        key = str(Path(path).absolute())
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._handles.move_to_end(key)
+                entry.n_users += 1
+        if entry is None:
+            # parsing the file may take long, so it is opened without holding the lock of the pool
+            tif = tf.TiffFile(key)
+            with self._lock:
+                entry = self._handles.get(key)
+                if entry is not None:
+                    # another thread opened the same file in the meantime
+                    self.hits += 1
+                    self._handles.move_to_end(key)
+                else:
+                    tif.filehandle.set_lock(True)
+                    entry = _PooledTiff(tif)
+                    self._handles[key] = entry
+                    self.opens += 1
+                    if key in self._opened_before:
+                        self.reopens += 1
+                    self._opened_before.add(key)
+                    tif = None
+                entry.n_users += 1
+                self._evict()
+            if tif is not None:
+                tif.close()
+        try:
+            yield entry.tif
+        finally:
+            with self._lock:
+                entry.n_users -= 1
+                if entry.n_users == 0 and self._handles.get(key) is not entry:
+                    # the handle was dropped from the pool while in use
+                    entry.tif.close()
+                else:
+                    self._evict()
+
+    def adopt(self, path: Union[str, Path], tif: tf.TiffFile):
+        """ Hands an already open TiffFile over to the pool, which becomes responsible for closing it. """
+        key = str(Path(path).absolute())
+        with self._lock:
+            if key in self._handles:
+                tif.close()
+                return
+            tif.filehandle.set_lock(True)
+            self._handles[key] = _PooledTiff(tif)
+            self.opens += 1
+            if key in self._opened_before:
+                self.reopens += 1
+            self._opened_before.add(key)
+            self._evict()
+
+    def _evict(self):
+        # handles currently in use are skipped, so the pool may temporarily hold more than max_open files
+        for key in [k for k, e in self._handles.items() if e.n_users == 0]:
+            if len(self._handles) <= self._max_open:
+                break
+            self._handles.pop(key).tif.close()
+            self.evictions += 1
+
+    def close(self, path: Union[str, Path, None] = None):
+        """ Closes the handle of path, or all idle handles in the pool if no path is given. """
+        with self._lock:
+            keys = list(self._handles.keys()) if path is None else [str(Path(path).absolute())]
+            for key in keys:
+                entry = self._handles.pop(key, None)
+                if entry is not None and entry.n_users == 0:
+                    entry.tif.close()
+
+
+tiff_pool = TiffFilePool()
@@ -0,0 +1,55 @@
+from pathlib import Path
+from typing import Dict, Union
+
+import tifffile as tf
+
+from fileops.image._mmanager_metadata import mm_metadata_files
+from fileops.logger import get_logger
+
+log = get_logger(name='tiff_probe')
+
+
+class TiffProbe:
+    """
+    Format markers of a TIFF file, read from its header and first IFD with a single open of the file.
+    The open handle is kept so that it can be handed over to the reader that is chosen for the file.
+    """
+
+    def __init__(self, path: Path, tif: tf.TiffFile):
+        self.path = path
+        self.tif = tif
+
+        self.is_imagej = bool(tif.is_imagej)
+        self.is_micromanager = bool(tif.is_micromanager)
+        self.ome_metadata: Union[None, str] = tif.ome_metadata
+        self.micromanager_metadata: Union[None, Dict] = tif.micromanager_metadata if self.is_micromanager else None
+
+    @property
+    def is_ome(self) -> bool:
+        return self.ome_metadata is not None
+
+    @property
+    def is_micromanager_stack(self) -> bool:
+        """ Same test as MicroManagerSingleImageStack.has_valid_format, without opening the file again. """
+        if not self.ome_metadata or not self.micromanager_metadata or not self.is_micromanager:
+            return False
+        # image folder has to have only one metadata file at maximum
+        return len(mm_metadata_files(self.path.parent, self.path)) <= 1
+
+    def close(self):
+        if self.tif is not None:
+            self.tif.close()
+            self.tif = None
+
+
+def probe_tiff(path: Path) -> Union[None, TiffProbe]:
+    try:
+        tif = tf.TiffFile(path)
+    except tf.TiffFileError as e:
+        log.warning(f"File {path} is not a valid TIFF file: {e}")
+        return None
+    try:
+        return TiffProbe(path, tif)
+    except Exception:
+        tif.close()
+        raise
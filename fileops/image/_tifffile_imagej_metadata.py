@@ -1,15 +1,15 @@
-import itertools
 import json
 import os
 import re
 from logging import Logger
 from pathlib import Path
-from typing import List
+from typing import List, Union
 
 import numpy as np
 import tifffile as tf
 
 from fileops.image._base import ImageFileBase
+from fileops.image._plane_table import PlaneTable
 
 
 def _find_associated_files(path, prefix) -> List[Path]:
@@ -24,17 +24,19 @@ def _find_associated_files(path, prefix) -> List[Path]:
 
 class MetadataImageJTifffileMixin(ImageFileBase):
     log: Logger
+    _tif: Union[None, tf.TiffFile] = None  # may be set beforehand to reuse a handle that is already open
 
     def __init__(self, **kwargs):
         self.error_loading_metadata = False
-        self._tif = None
         self._load_metadata()
 
         super().__init__(**kwargs)
 
     def _load_metadata(self):
-        self._tif = tf.TiffFile(self.image_path)
-        imagej_metadata = self._tif.imagej_metadata
+        if self._tif is None:
+            self._tif = tf.TiffFile(self.image_path)
+        # copied as the parsed metadata is cached in the file handle
+        imagej_metadata = dict(self._tif.imagej_metadata) if self._tif.imagej_metadata is not None else None
         micromanager_metadata = self._tif.micromanager_metadata
         ij_nfo = {}
         if imagej_metadata and "Info" in imagej_metadata:
@@ -87,8 +89,7 @@ class MetadataImageJTifffileMixin(ImageFileBase):
         self._md_n_channels = max(mm_size_c, -1)
         self._md_deltaT_ms = int(ij_nfo.get("Interval_ms", -1e6))
 
-        # build a list of the images stored in sequence
-        positions = set()
+        # build a table of the images stored in sequence
         if "IntendedDimensions" in ij_nfo and "AxisOrder" in ij_nfo:
             ax_dim = ij_nfo["IntendedDimensions"]
             ax_ord = list(reversed([a for a in ij_nfo["AxisOrder"] if a in ax_dim.keys()]))
@@ -108,37 +109,25 @@ class MetadataImageJTifffileMixin(ImageFileBase):
                       "z":        self._md_n_zstacks}
             ax_ord = []
 
-        for counter, key_pos in enumerate(itertools.product(*[range(ax_dim[a]) for a in ax_ord if a in ax_dim.keys()])):
-            p = key_pos[ax_ord.index("position")] if "position" in ax_ord else 0
-            c = key_pos[ax_ord.index("channel")] if "channel" in ax_ord else 0
-            t = key_pos[ax_ord.index("time")] if "time" in ax_ord else 0
-            z = key_pos[ax_ord.index("z")] if "z" in ax_ord else 0
-            if z == 0 and c == 0:
-                self.timestamps.append(self._md_deltaT_ms * t / 1000)
-            self.channels.add(c)
-            self.zstacks.append(z)
-            self.zstacks_um.append(self.um_per_z * z)
-            self.frames.append(t)
-
-            positions.add(p)
-
-            # build dictionary where the keys are combinations of c z t and values are the index
-            key = (f"c{c:0{len(str(ax_dim['channel']))}d}"
-                   f"z{z:0{len(str(ax_dim['z']))}d}"
-                   f"t{t:0{len(str(ax_dim['time']))}d}")
-            self.all_planes.append(key)
-            if key in self.all_planes_md_dict:
-                # raise KeyError("Keys should not repeat!")
-                # print(f"Keys should not repeat! ({key})")
-                pass
-            else:
-                # print(f"{fkey} - {key} gets {counter}")
-                self.all_planes_md_dict[key] = (counter, c, z, t)
-
-        self.timestamps = sorted(np.unique(self.timestamps))
-        self.frames = sorted(np.unique(self.frames))
-        self.zstacks = sorted(np.unique(self.zstacks))
-        self.zstacks_um = sorted(np.unique(self.zstacks_um))
+        # the planes are stored in the order given by the product of the axes
+        axes = np.meshgrid(*[np.arange(ax_dim[a]) for a in ax_ord], indexing='ij')
+        axes = [a.ravel() for a in axes]
+        n_planes = axes[0].size if axes else 1
+
+        def _axis(name):
+            return axes[ax_ord.index(name)] if name in ax_ord else np.zeros(n_planes, dtype=int)
+
+        p, c, t, z = _axis("position"), _axis("channel"), _axis("time"), _axis("z")
+        self.planes = PlaneTable.from_columns(t=t, c=c, z=z, p=p,
+                                              timestamp=self._md_deltaT_ms * t / 1000,
+                                              z_um=self.um_per_z * z)
+        positions = set(p.tolist())
+
+        self.channels = set(c.tolist())
+        self.timestamps = sorted(np.unique(self.planes.records['timestamp'][(z == 0) & (c == 0)]))
+        self.frames = sorted(np.unique(t))
+        self.zstacks = sorted(np.unique(z))
+        self.zstacks_um = sorted(np.unique(self.planes.records['z_um']))
 
         # check consistency of stored number of frames vs originally recorded in the metadata
         n_frames = len(self.frames)
@@ -0,0 +1,225 @@
+from contextlib import contextmanager
+from logging import Logger
+from pathlib import Path
+from typing import Dict, Tuple, Union
+
+import numpy as np
+import tifffile as tf
+
+from fileops.image._base import ImageFileBase
+from fileops.image._roi import Bounds, roi_shape
+from fileops.image._tiff_pool import tiff_pool
+from fileops.image.exceptions import FrameNotFoundError
+from fileops.image.imagemeta import MetadataImage
+
+JPEG_COMPRESSIONS = (6, 7, 33007, 34892)  # decoding needs the JPEG tables of the file
+
+
+def contiguous_offset(page: tf.TiffPage) -> Union[int, None]:
+    """ Byte offset of the image data of an uncompressed page stored in one contiguous block, or None otherwise. """
+    contiguous = page.is_contiguous
+    if not contiguous:
+        return None
+    if isinstance(contiguous, tuple):  # older versions of tifffile return (offset, bytecount)
+        return int(contiguous[0])
+    return int(page.dataoffsets[0])
+
+
+class PlanesTifffileMixin(ImageFileBase):
+    """
+    Batched reading of image planes stored as pages of one or more TIFF files.
+    Planes are grouped by file and read in storage order, decoding each page straight into the output buffer.
+    """
+    log: Logger
+    max_read_workers = 4  # pooled file handles are locked, so planes can be read from several threads
+
+    def __init__(self, *args, memmap=False, **kwargs):
+        # when memmap is set, planes stored uncompressed in one contiguous block are returned as read-only views
+        # of the file mapped in memory instead of being read into a new buffer
+        self._memmap = memmap
+        self._mm_files: Dict[int, np.memmap] = dict()
+        self._mm_offsets: Union[None, np.ndarray] = None
+        self._mm_layout: Dict[int, Tuple[np.dtype, Tuple[int, ...]]] = dict()
+
+        super().__init__(*args, **kwargs)
+
+    def _plane_file(self, fid: int) -> Path:
+        return self.image_path.parent / self.files[fid]
+
+    def _plane_pages(self, ix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Returns the file ids and the page inside each file of the planes at rows ix of the plane table. """
+        rec = self.planes.records[ix]
+        return rec['fid'].astype(np.int64), rec['page'].astype(np.int64)
+
+    @contextmanager
+    def _open_tiff(self, fid: int) -> tf.TiffFile:
+        path = self._plane_file(fid)
+        if not path.exists():
+            self.log.error(f'File {path} not found.')
+            raise FrameNotFoundError(f'File {path} not found.')
+        with tiff_pool.acquire(path) as tif:
+            yield tif
+
+    def _resolve_memmap(self, fid: int):
+        """ Resolves once the byte offset of every plane stored in file fid, and maps the file in memory. """
+        if self._mm_offsets is None:
+            self._mm_offsets = np.full(len(self.planes), -2, dtype=np.int64)
+
+        rows = np.arange(len(self.planes))
+        fids, pages = self._plane_pages(rows)
+        in_file = fids == fid
+        rows, pages = rows[in_file], pages[in_file]
+        self._mm_offsets[rows] = -1
+
+        with self._open_tiff(fid) as tif, tif.filehandle.lock:
+            page0 = tif.pages[0]
+            dtype = np.dtype(tif.byteorder + page0.dtype.char)
+            shape = page0.shape
+            for r, pg in zip(rows, pages):
+                if pg >= len(tif.pages):
+                    continue
+                page = tif.pages[int(pg)]
+                if page.shape == shape and page.dtype == page0.dtype:
+                    offset = contiguous_offset(page)
+                    self._mm_offsets[r] = offset if offset is not None else -1
+
+        if np.any(self._mm_offsets[rows] >= 0):
+            self._mm_files[fid] = np.memmap(self._plane_file(fid), dtype=np.uint8, mode='r')
+            self._mm_layout[fid] = (dtype, shape)
+
+    def _memmap_plane(self, ix: int) -> Union[None, np.ndarray]:
+        """ Returns a read-only view of the plane at row ix mapped from the file, or None if it can't be mapped. """
+        if not self._memmap:
+            return None
+        fid = int(self._plane_pages(np.array([ix]))[0][0])
+        if self._mm_offsets is None or self._mm_offsets[ix] == -2:
+            self._resolve_memmap(fid)
+
+        offset = self._mm_offsets[ix]
+        if offset < 0 or fid not in self._mm_files:
+            return None
+        dtype, shape = self._mm_layout[fid]
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        return self._mm_files[fid][offset:offset + nbytes].view(dtype).reshape(shape)
+
+    def _image_roi(self, ix, roi: Union[None, Bounds]) -> MetadataImage:
+        if roi is None:
+            return self._image(ix)
+        if ix is None or not 0 <= ix < len(self.planes):
+            raise FrameNotFoundError
+
+        y0, y1, x0, x1 = roi
+        image = self._memmap_plane(ix)
+        if image is not None:
+            image = image[y0:y1, x0:x1]
+        else:
+            fids, pages = self._plane_pages(np.array([ix]))
+            with self._open_tiff(int(fids[0])) as tif, tif.filehandle.lock:
+                if pages[0] >= len(tif.pages):
+                    raise FrameNotFoundError(f'Page {pages[0]} not found in file.')
+                image = read_page_roi(tif, tif.pages[int(pages[0])], roi)
+
+        plane = self.planes[ix]
+        t = int(plane['t'])
+        timestamp = float(plane['timestamp'])
+        if not np.isfinite(timestamp):
+            timestamp = self.timestamps[t] if self.timestamps and t < len(self.timestamps) else None
+        return MetadataImage(reader=type(self).__name__,
+                             image=image,
+                             pix_per_um=self.pix_per_um, um_per_pix=self.um_per_pix,
+                             time_interval=self.time_interval,
+                             timestamp=timestamp,
+                             frame=t, channel=int(plane['c']), z=int(plane['z']), width=x1 - x0, height=y1 - y0,
+                             intensity_range=self._intensity_range(image))
+
+    def _read_planes(self, ix: np.ndarray, out: np.ndarray, roi: Union[None, Bounds] = None):
+        if roi is not None and self._memmap:
+            for k, i in enumerate(np.asarray(ix).ravel()):
+                if i >= 0:
+                    out[k] = self._image_roi(int(i), roi).image
+            return
+
+        ix = np.asarray(ix).ravel()
+        dst = np.flatnonzero(ix >= 0)
+        fids, pages = self._plane_pages(ix[dst])
+
+        # group planes by file and visit them in the order they are stored
+        order = np.lexsort((pages, fids))
+        dst, fids, pages = dst[order], fids[order], pages[order]
+        for fid in np.unique(fids):
+            in_file = fids == fid
+            with self._open_tiff(int(fid)) as tif, tif.filehandle.lock:
+                if roi is None:
+                    _read_pages(tif, pages[in_file], dst[in_file], out)
+                else:
+                    for d, pg in zip(dst[in_file], pages[in_file]):
+                        out[d] = read_page_roi(tif, tif.pages[int(pg)], roi)
+
+
+def _read_pages(tif: tf.TiffFile, pages: np.ndarray, dst: np.ndarray, out: np.ndarray):
+    """ Reads pages of an open TIFF file into out[dst], merging runs of pages stored back to back into one read. """
+    k = 0
+    while k < len(pages):
+        page = tif.pages[int(pages[k])]
+        fits_out = page.shape == out.shape[1:] and page.dtype == out.dtype
+
+        # extend the run while pages are consecutive both in the file and in the output buffer
+        n = 1
+        offset = contiguous_offset(page) if fits_out and out.flags.c_contiguous else None
+        if offset is not None:
+            end = offset + page.nbytes
+            while k + n < len(pages) and pages[k + n] == pages[k] + n and dst[k + n] == dst[k] + n:
+                nxt = tif.pages[int(pages[k + n])]
+                if contiguous_offset(nxt) != end or nxt.shape != page.shape or nxt.dtype != page.dtype:
+                    break
+                end += nxt.nbytes
+                n += 1
+
+        if n > 1:
+            dtype = np.dtype(tif.byteorder + page.dtype.char)
+            with tif.filehandle.lock:
+                tif.filehandle.read_array(dtype, offset=offset, out=out[dst[k]:dst[k] + n])
+        elif fits_out:
+            page.asarray(out=out[dst[k]])
+        else:
+            out[dst[k]] = page.asarray().reshape(out.shape[1:])
+        k += n
+
+
+def read_page_roi(tif: tf.TiffFile, page: tf.TiffPage, roi: Bounds) -> np.ndarray:
+    """
+    Reads the region roi of a page. Only the rows of the region are read from uncompressed contiguous pages, and
+    only the strips or tiles that intersect the region are read and decoded otherwise.
+    """
+    y0, y1, x0, x1 = roi
+    if len(page.shape) != 2 or page.compression in JPEG_COMPRESSIONS:
+        return page.asarray()[y0:y1, x0:x1]
+
+    width = page.shape[1]
+    offset = contiguous_offset(page)
+    if offset is not None:
+        dtype = np.dtype(tif.byteorder + page.dtype.char)
+        rows = tif.filehandle.read_array(dtype, count=(y1 - y0) * width, offset=offset + y0 * width * dtype.itemsize)
+        return rows.reshape(y1 - y0, width)[:, x0:x1].astype(page.dtype)
+
+    # segments are laid out in a grid of n_rows x n_cols strips or tiles of chunk_h x chunk_w pixels
+    chunk_h, chunk_w = page.chunks[-2:]
+    n_cols = page.chunked[-1]
+    indices = [r * n_cols + c
+               for r in range(y0 // chunk_h, (y1 - 1) // chunk_h + 1)
+               for c in range(x0 // chunk_w, (x1 - 1) // chunk_w + 1)]
+    out = np.zeros(roi_shape(roi), dtype=page.dtype)
+    fh = tif.filehandle
+    for index in indices:
+        data = None
+        if page.databytecounts[index] > 0:
+            fh.seek(page.dataoffsets[index])
+            data = fh.read(page.databytecounts[index])
+        segment, (_, _, sy, sx, _), _ = page.decode(data, index)
+        if segment is None:
+            continue
+        segment = segment.reshape(segment.shape[-3:-1])
+        ys, ye = max(y0, sy), min(y1, sy + segment.shape[0])
+        xs, xe = max(x0, sx), min(x1, sx + segment.shape[1])
+        out[ys - y0:ye - y0, xs - x0:xe - x0] = segment[ys - sy:ye - sy, xs - sx:xe - sx]
+    return out
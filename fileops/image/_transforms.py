@@ -0,0 +1,239 @@
+import threading
+from typing import Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+
+from fileops.image._bleach_correction import PhotobleachCorrection
+from fileops.image._roi import Bounds, roi_bounds, roi_shape
+
+Coefficient = Union[float, np.ndarray]  # a scalar, or a map with the shape of the region being read
+
+BLOCK_SIZE = 1 << 15  # pixels of a plane processed at a time, so that temporaries stay in the processor cache
+
+
+def _crop(value, bounds: Union[None, Bounds]):
+    if np.ndim(value) == 0:
+        return float(value)
+    if bounds is None:
+        return value
+    y0, y1, x0, x1 = bounds
+    return value[y0:y1, x0:x1]
+
+
+def _compose(state: Tuple, g: Coefficient, o: Coefficient) -> Tuple:
+    """
+    Composes the affine map g * x + o after the one of state=(G, O, a, b), which stands for a * (G * x + O) + b.
+    Scalar maps are folded into (a, b), so that maps of the size of the plane are only multiplied by scalars when
+    the plane is processed.
+    """
+    G, O, a, b = state
+    if np.ndim(g) == 0 and np.ndim(o) == 0:
+        return G, O, g * a, g * b + o
+    return g * (a * G), g * (a * O + b) + o, 1.0, 0.0
+
+
+class Transform:
+    """
+    Operation of a TransformPipeline. Operations on the intensity of pixels are expressed as an affine map
+    gain * x + offset, so that any number of them is applied to a plane in a single pass.
+    """
+    static = True  # whether the coefficients are the same for every plane
+
+    def coefficients(self, channel: int, frame: int, bounds: Union[None, Bounds]) -> Tuple[Coefficient, Coefficient]:
+        return 1.0, 0.0
+
+
+class Crop(Transform):
+    """ Keeps the region roi (see roi_bounds) of the planes; only that region is read from the file. """
+
+    def __init__(self, roi):
+        self.roi = roi
+
+
+class Subtract(Transform):
+    """ Subtracts a background, either a constant or an image of the size of the planes. """
+
+    def __init__(self, background):
+        self.background = np.asarray(background, dtype=np.float32)
+
+    def coefficients(self, channel, frame, bounds):
+        return 1.0, -_crop(self.background, bounds)
+
+
+class FlatField(Transform):
+    """
+    Flat-field correction: subtracts the dark image (or constant) and divides by the flat image, normalized to its
+    mean so that intensities keep their scale.
+    """
+
+    def __init__(self, flat: np.ndarray, dark=0.0):
+        self.dark = np.asarray(dark, dtype=np.float32)
+        flat = np.asarray(flat, dtype=np.float32) - self.dark
+        self.gain = np.divide(flat.mean(), flat, out=np.zeros_like(flat), where=flat > 0)
+
+    def coefficients(self, channel, frame, bounds):
+        gain = _crop(self.gain, bounds)
+        return gain, -_crop(self.dark, bounds) * gain
+
+
+class BleachCorrection(Transform):
+    """ Photobleaching correction of the planes of every channel and frame (see PhotobleachCorrection). """
+    static = False
+
+    def __init__(self, correction: PhotobleachCorrection):
+        self.correction = correction
+
+    def coefficients(self, channel, frame, bounds):
+        gain = self.correction.gain(channel, frame, roi=bounds)
+        return 1.0 if gain is None else gain, 0.0
+
+
+class Rescale(Transform):
+    """ Maps the [vmin, vmax] range of intensities linearly onto [out_min, out_max]. """
+
+    def __init__(self, vmin: float, vmax: float, out_min: float = 0.0, out_max: float = 255.0):
+        self.vmin, self.vmax = float(vmin), float(vmax)
+        self.out_min, self.out_max = float(out_min), float(out_max)
+
+    def coefficients(self, channel, frame, bounds):
+        gain = (self.out_max - self.out_min) / (self.vmax - self.vmin) if self.vmax > self.vmin else 0.0
+        return gain, self.out_min - self.vmin * gain
+
+
+class Cast(Transform):
+    """ Data type of the output; values are rounded and clipped to the range of integer types. """
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+
+
+class TransformPipeline:
+    """
+    Chain of transforms applied to planes as they are read.
+    Crops are pushed down to the reader, and the remaining transforms are planned the first time a plane of a given
+    data type and region is processed: consecutive transforms that don't change from plane to plane are composed
+    into one affine map, and every plane is then written into the output in a single pass, a block of rows at a time.
+    """
+
+    def __init__(self, transforms: Iterable[Transform] = ()):
+        self.transforms: List[Transform] = list(transforms)
+        self._plans: Dict[Tuple, Tuple] = dict()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {'transforms': self.transforms}
+
+    def __setstate__(self, state):
+        self.__init__(state['transforms'])
+
+    def __iter__(self):
+        return iter(self.transforms)
+
+    def __len__(self):
+        return len(self.transforms)
+
+    def __repr__(self):
+        return f"TransformPipeline({', '.join(type(t).__name__ for t in self.transforms)})"
+
+    def read_bounds(self, roi, width: int, height: int) -> Union[None, Bounds]:
+        """ Region of the file to read for the region roi of the output (see roi_bounds), or None for all of it. """
+        y0, x0, h, w = 0, 0, height, width
+        for region in [t.roi for t in self.transforms if isinstance(t, Crop)] + [roi]:
+            if region is not None:
+                by0, by1, bx0, bx1 = roi_bounds(region, w, h)
+                y0, x0, h, w = y0 + by0, x0 + bx0, by1 - by0, bx1 - bx0
+        return None if (y0, x0, h, w) == (0, 0, height, width) else (y0, y0 + h, x0, x0 + w)
+
+    def output_shape(self, width: int, height: int, roi=None) -> Tuple[int, int]:
+        bounds = self.read_bounds(roi, width, height)
+        return (height, width) if bounds is None else roi_shape(bounds)
+
+    def output_dtype(self, dtype) -> np.dtype:
+        casts = [t.dtype for t in self.transforms if isinstance(t, Cast)]
+        return casts[-1] if casts else np.dtype(dtype)
+
+    def _plan(self, dtype: np.dtype, bounds: Union[None, Bounds]) -> Tuple:
+        key = (dtype, bounds)
+        # read without a lock by the reader threads, so the plan is returned from a local and not looked up again
+        plan = self._plans.get(key)
+        if plan is None:
+            # runs of static transforms are composed once; dynamic ones are kept to be evaluated plane by plane
+            stages, run = list(), None
+            for t in self.transforms:
+                if isinstance(t, (Crop, Cast)):
+                    continue
+                if t.static:
+                    run = _compose(run or (1.0, 0.0, 1.0, 0.0), *t.coefficients(0, 0, bounds))
+                    continue
+                if run is not None:
+                    stages.append(self._fold(run))
+                    run = None
+                stages.append(t)
+            if run is not None:
+                stages.append(self._fold(run))
+            plan = (self.output_dtype(dtype), stages)
+            if len(self._plans) > 16:
+                self._plans.clear()
+            self._plans[key] = plan
+        return plan
+
+    @staticmethod
+    def _fold(state: Tuple) -> Tuple[Coefficient, Coefficient]:
+        G, O, a, b = state
+        return a * G, a * O + b
+
+    def _scratch(self, rows: int, width: int) -> np.ndarray:
+        scratch = getattr(self._local, 'scratch', None)
+        if scratch is None or scratch.shape[0] < rows or scratch.shape[1] != width:
+            scratch = self._local.scratch = np.empty((rows, width), dtype=np.float32)
+        return scratch
+
+    def apply(self, image: np.ndarray, channel: int, frame: int, bounds: Union[None, Bounds] = None,
+              out: np.ndarray = None) -> np.ndarray:
+        """
+        Transforms a plane that was read from the region bounds of the file (see read_bounds) into out, which can be
+        the plane itself if the pipeline keeps its data type.
+        """
+        dtype, stages = self._plan(image.dtype, bounds)
+        out = np.empty(image.shape, dtype=dtype) if out is None else out
+        state = (1.0, 0.0, 1.0, 0.0)
+        for stage in stages:
+            state = _compose(state, *(stage.coefficients(channel, frame, bounds) if isinstance(stage, Transform)
+                                      else stage))
+        G, O, a, b = state
+        if np.ndim(G) == 0 and np.ndim(O) == 0:
+            G, O, a, b = a * G, a * O + b, 1.0, 0.0
+        if np.ndim(G) == 0 and G == 1 and np.ndim(O) == 0 and O == 0 and dtype == image.dtype:
+            if out is not image:
+                out[:] = image
+            return out
+
+        integer = np.issubdtype(dtype, np.integer)
+        if integer:
+            info = np.iinfo(dtype)
+            if info.min == 0:
+                # non-negative values are rounded by truncation after adding a half
+                if np.ndim(O) == 0 and a == 1 and b == 0:
+                    O = O + 0.5
+                else:
+                    b = b + 0.5
+
+        h, w = image.shape
+        rows = max(1, BLOCK_SIZE // w)
+        scratch = self._scratch(rows, w)
+        for y in range(0, h, rows):
+            blk = slice(y, min(y + rows, h))
+            s = scratch[:blk.stop - y]
+            np.multiply(image[blk], G if np.ndim(G) == 0 else G[blk], out=s, dtype=np.float32)
+            if np.ndim(O) > 0 or O != 0:
+                np.add(s, O if np.ndim(O) == 0 else O[blk], out=s)
+            if a != 1:
+                np.multiply(s, a, out=s)
+            if b != 0:
+                np.add(s, b, out=s)
+            if integer:
+                if info.min != 0:
+                    np.rint(s, out=s)
+                np.clip(s, info.min, info.max, out=s)
+            np.copyto(out[blk], s, casting='unsafe')
+        return out
@@ -3,12 +3,48 @@ from pathlib import Path
 from typing import Union
 
 from fileops.image import (ImageFile, VolocityFile, MicroManagerFolderSeries, MicroManagerSingleImageStack,
-                           TifffileOMEImageFile, PycroManagerSingleImageStack, BioioOMEImageFile)
+                           TifffileOMEImageFile, PycroManagerSingleImageStack, BioioOMEImageFile,
+                           MicroMagellanDataset)
+from fileops.image._tiff_pool import tiff_pool
+from fileops.image._tiff_probe import probe_tiff
 from fileops.logger import get_logger
 
 log = get_logger(name='loading-factory')
 
 
+def _load_tiff_file(path: Path, **kwargs) -> Union[ImageFile, None]:
+    # the file is opened once, and its format is told from the markers found in the header and first IFD
+    probe = probe_tiff(path)
+    if probe is None:
+        log.warning(f'Could not find file {path}')
+        return None
+
+    if probe.is_micromanager_stack:
+        # the open handle is shared with the reader through the pool of file handles
+        tiff_pool.adopt(path, probe.tif)
+        # let's try to open tiff file with PycroManager if available
+        try:
+            log.info(f'Processing MicroManager file {path} using PycroManager')
+            return PycroManagerSingleImageStack(path, **kwargs)
+        except Exception as e:
+            log.error(e)
+            log.error(traceback.format_exc())
+        log.info(f'Processing MicroManager file {path}')
+        return MicroManagerSingleImageStack(path, **kwargs)
+
+    if probe.is_ome:
+        log.info(f'Using Tifffile to open file {path}')
+        return TifffileOMEImageFile(path, tif=probe.tif, **kwargs)
+
+    probe.close()
+    if BioioOMEImageFile.has_valid_format(path):
+        log.info(f'Using BioIO to open file {path}')
+        return BioioOMEImageFile(path, **kwargs)
+
+    log.warning(f'Could not find file {path}')
+    return None
+
+
 def load_image_file(path: Path, **kwargs) -> Union[ImageFile, None]:
     ext = path.name.split('.')[-1]
     ini = path.name[0]
@@ -19,28 +55,14 @@ def load_image_file(path: Path, **kwargs) -> Union[ImageFile, None]:
         if ext == 'mvd2':
             img_file = VolocityFile(path, **kwargs)
         elif ext == 'tif' or ext == 'tiff':
-            if MicroManagerFolderSeries.has_valid_format(path.parent):  # folder is full of tif files
+            if MicroMagellanDataset.has_valid_format(path):
+                log.info(f'Processing Micro-Magellan dataset {path.parent}')
+                img_file = MicroMagellanDataset(path, **kwargs)
+            elif MicroManagerFolderSeries.has_valid_format(path.parent):  # folder is full of tif files
                 log.info(f'Processing MicroManager folder {path.parent}')
                 img_file = MicroManagerFolderSeries(path.parent, **kwargs)
-            # let's try to open tiff file with PycroManager if available
-            elif PycroManagerSingleImageStack.has_valid_format(path):
-                try:
-                    log.info(f'Processing MicroManager file {path} using PycroManager')
-                    img_file = PycroManagerSingleImageStack(path, **kwargs)
-                except Exception as e:
-                    log.error(e)
-                    log.error(traceback.format_exc())
-            elif TifffileOMEImageFile.has_valid_format(path):
-                log.info(f'Using Tifffile to open file {path}')
-                img_file = TifffileOMEImageFile(path, **kwargs)
-            elif BioioOMEImageFile.has_valid_format(path):
-                log.info(f'Using BioIO to open file {path}')
-                img_file = BioioOMEImageFile(path, **kwargs)
-            elif MicroManagerSingleImageStack.has_valid_format(path):
-                log.info(f'Processing MicroManager file {path}')
-                img_file = MicroManagerSingleImageStack(path, **kwargs)
             else:
-                log.warning(f'Could not find file {path}')
+                img_file = _load_tiff_file(path, **kwargs)
         else:
             log.warning(f'Could not find file {path}')
     except FileNotFoundError as e:
@@ -1,19 +1,34 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 
 import numpy as np
 
-from fileops.image import to_8bit
+from fileops.image.to_8bit import histogram_limits, to_8bit
 from fileops.image._base import ImageFileBase
+from fileops.image._bleach_correction import PhotobleachCorrection, fit_photobleach, tile_means
+from fileops.image._metadata_index import load_index, save_index
+from fileops.image._plane_table import PlaneTable
+from fileops.image._projection import PROJECTIONS, ProjectionAccumulator
+from fileops.image._roi import Bounds, roi_bounds, roi_shape
+from fileops.image._transforms import BleachCorrection, TransformPipeline
 from fileops.image.exceptions import FrameNotFoundError
-from fileops.image.imagemeta import MetadataImageSeries, MetadataImage
+from fileops.image.imagemeta import IntensityRange, MetadataImageSeries, MetadataImage
 from fileops.logger import get_logger
 
 
 class ImageFile(ImageFileBase):
     log = get_logger(name='ImageFile')
+    max_read_workers = 1  # threads reading planes concurrently in the streaming operations
+    transforms: Union[None, TransformPipeline] = None  # applied to the planes as they are read
+    contrast_percentiles = (1.0, 99.0)  # intensity limits of the percentile contrast of 8 bit conversions
+    plane_cache = None  # cache of the planes as they are in the file (see fileops.cached.CachedImageFile)
 
-    def __init__(self, image_path: Path, image_series=0, failover_dt=None, failover_mag=None, **kwargs):
+    def __init__(self, image_path: Path, image_series=0, failover_dt=None, failover_mag=None,
+                 compute_intensity_range=True, **kwargs):
         self.image_path = image_path
+        self.compute_intensity_range = compute_intensity_range
         self.base_path = self.image_path.parent
         self.metadata_path = None
         self.log.debug(f"Image file path is {self.image_path.as_posix().encode('ascii')}.")
@@ -36,8 +51,7 @@ class ImageFile(ImageFileBase):
         self.md = dict()
         self.images_md = dict()
         self.planes_md = dict()
-        self.all_planes = list()
-        self.all_planes_md_dict = dict()
+        self.planes = PlaneTable.from_columns(t=[], c=[], z=[])
         self.timestamps = list()
         self.positions = set()
         self.channels = set()
@@ -45,6 +59,7 @@ class ImageFile(ImageFileBase):
         self.zstacks_um = list()
         self.frames = list()
         self.files = list()
+        self._intensity_stats = dict()
 
     def _fix_defaults(self, failover_dt=None, failover_mag=None):
         if not self.timestamps and self.frames:
@@ -79,80 +94,396 @@ class ImageFile(ImageFileBase):
             __series = sorted(self.all_series)
             return __series[self._series]
 
-    def plane_at(self, c, z, t):
-        return (f"c{int(c):0{len(str(self._md_n_channels))}d}"
-                f"z{int(z):0{len(str(self._md_n_zstacks))}d}"
-                f"t{int(t):0{len(str(self._md_n_frames))}d}")
+    def _source_files(self) -> List[Path]:
+        """ Files that exist among the ones the planes and metadata of the acquisition are read from. """
+        files = [Path(self.image_path)] + ([Path(self.metadata_path)] if self.metadata_path else [])
+        plane_file = getattr(self, '_plane_file', None)
+        for fid, name in enumerate(self.planes.files or self.files):
+            files.append(plane_file(fid) if plane_file is not None else Path(self.base_path) / name)
+        return [f for f in dict.fromkeys(files) if f.exists()]
+
+    def __fileops_key__(self):
+        """ Identity of the file for the keys of cached steps (see cached_step): its source, series and transforms. """
+        path = Path(self.image_path).absolute()
+        st = path.stat() if path.exists() else None
+        return (type(self).__name__, path.as_posix(), st and (st.st_size, st.st_mtime_ns), self._series,
+                self.transforms)
+
+    def _intensity_range(self, image: np.ndarray) -> Union[None, IntensityRange]:
+        # evaluated only if the caller reads it
+        return IntensityRange(image) if self.compute_intensity_range else None
 
     def ix_at(self, c, z, t):
-        czt_str = self.plane_at(c, z, t)
-        if czt_str in self.all_planes_md_dict:
-            return self.all_planes_md_dict[czt_str]
+        ix = self.planes.ix(c=c, z=z, t=t)
+        if ix is not None:
+            return ix
         self.log.warning(f"No index found for c={c}, z={z}, and t={t}.")
 
-    def image(self, *args, **kwargs) -> MetadataImage:
-        if len(args) == 1 and isinstance(args[0], int):
+    @property
+    def photobleach_correction(self) -> Union[None, PhotobleachCorrection]:
+        stages = [t for t in (self.transforms or []) if isinstance(t, BleachCorrection)]
+        return stages[0].correction if stages else None
+
+    @photobleach_correction.setter
+    def photobleach_correction(self, correction: Union[None, PhotobleachCorrection]):
+        """ Sets the bleach correction stage of the transforms, keeping its place if there was one already. """
+        stages = list(self.transforms or [])
+        at = next((k for k, t in enumerate(stages) if isinstance(t, BleachCorrection)), len(stages))
+        stages = [t for t in stages if not isinstance(t, BleachCorrection)]
+        if correction is not None:
+            stages.insert(at, BleachCorrection(correction))
+        self.transforms = TransformPipeline(stages) if stages else None
+
+    def _read_bounds(self, roi) -> Union[None, Bounds]:
+        """ Region of the planes in the file that the region roi of the (transformed) planes comes from. """
+        return self._bounds_through(self.transforms, roi)
+
+    def _bounds_through(self, transforms: Union[None, TransformPipeline], roi) -> Union[None, Bounds]:
+        if transforms is None:
+            return roi_bounds(roi, self.width, self.height)
+        return transforms.read_bounds(roi, self.width, self.height)
+
+    def plane_shape(self, roi=None) -> tuple:
+        """ Shape of the planes returned by the file, or of their region roi, once transformed. """
+        bounds = self._read_bounds(roi)
+        return (self.height, self.width) if bounds is None else roi_shape(bounds)
+
+    def image(self, *args, roi=None, **kwargs) -> MetadataImage:
+        """
+        Returns the plane at row ix of the plane table. If a region of interest is given (see roi_bounds), only
+        that region is returned; readers of TIFF files only read the strips or tiles that cover it.
+        """
+        if len(args) == 1 and isinstance(args[0], (int, np.integer)):
             ix = args[0]
-            plane = self.all_planes[ix]
-            return self._image(plane, row=0, col=0, fid=0)
+            roi = self._read_bounds(roi)
+            mdimg = self._image(ix, row=0, col=0, fid=0) if roi is None else self._image_roi(ix, roi)
+            if self.transforms is None:
+                return mdimg
+            image = self._transform(ix, mdimg.image, roi)
+            return mdimg._replace(image=image, intensity_range=self._intensity_range(image))
+
+    def _transform(self, ix: int, image: np.ndarray, roi: Union[None, Bounds] = None,
+                   out: np.ndarray = None) -> np.ndarray:
+        """ Applies the transforms set on the file to the plane at row ix, read from the region roi of the file. """
+        return self._transform_through(self.transforms, ix, image, roi, out=out)
+
+    def _transform_through(self, transforms: Union[None, TransformPipeline], ix: int, image: np.ndarray,
+                           roi: Union[None, Bounds] = None, out: np.ndarray = None) -> np.ndarray:
+        if transforms is None:
+            return image
+        if out is None and image.flags.writeable and transforms.output_dtype(image.dtype) == image.dtype:
+            out = image
+        plane = self.planes[ix]
+        return transforms.apply(image, int(plane['c']), int(plane['t']), bounds=roi, out=out)
+
+    def _read_plane(self, ix: int, roi: Union[None, Bounds] = None) -> np.ndarray:
+        return self._transform(ix, self._plane(ix, roi), roi)
+
+    def _plane(self, ix: int, roi: Union[None, Bounds] = None) -> np.ndarray:
+        """ Plane at row ix (or its region roi) as it is in the file, through the plane cache if there is one. """
+        if self.plane_cache is None:
+            return self._image_roi(ix, roi).image
+        key = (self._series, int(ix), roi)
+        image = self.plane_cache.get(key)
+        if image is None:
+            image = self._image_roi(ix, roi).image
+            self.plane_cache.put(key, image)
+        return image
+
+    def _read_cached_planes(self, ix: np.ndarray, out: np.ndarray, roi: Union[None, Bounds] = None):
+        """ Reads planes like _read_planes, taking the ones in the plane cache from there. """
+        if self.plane_cache is None:
+            self._read_planes(ix, out, roi=roi)
+            return
+        missing = np.array(ix, copy=True)
+        for k in np.flatnonzero(missing >= 0):
+            cached = self.plane_cache.get((self._series, int(ix[k]), roi))
+            if cached is not None:
+                out[k] = cached
+                missing[k] = -1
+        self._read_planes(missing, out, roi=roi)
+        for k in np.flatnonzero(missing >= 0):
+            self.plane_cache.put((self._series, int(ix[k]), roi), out[k])
+
+    def _image_roi(self, ix, roi: Union[None, Bounds]) -> MetadataImage:
+        """ Reads the region roi of the plane at row ix; by default the whole plane is read and then cropped. """
+        mdimg = self._image(ix)
+        if roi is None:
+            return mdimg
+        y0, y1, x0, x1 = roi
+        image = mdimg.image[y0:y1, x0:x1]
+        return mdimg._replace(image=image, width=x1 - x0, height=y1 - y0,
+                              intensity_range=self._intensity_range(image))
+
+    def _read_planes(self, ix: np.ndarray, out: np.ndarray, roi: Union[None, Bounds] = None):
+        """
+        Reads the planes at rows ix of the plane table into out, an array with one plane per element of ix.
+        Negative rows stand for planes that are not in the file, and are skipped. If roi bounds are given, only
+        that region of every plane is read.
+        """
+        for k, i in enumerate(ix):
+            if i >= 0:
+                out[k] = self._image_roi(int(i), roi).image
+
+    def read_planes(self, ix: np.ndarray, out: np.ndarray, roi=None, batch_size=16):
+        """
+        Reads the planes at rows ix of the plane table into out (see _read_planes), with the transforms set on the
+        file applied as each batch is read. Transforms that keep the data type are applied in place; otherwise
+        planes are read batch_size at a time into a buffer in the data type of the file.
+        """
+        self._read_planes_through(self.transforms, ix, out, roi=roi, batch_size=batch_size)
+
+    def _read_planes_through(self, transforms: Union[None, TransformPipeline], ix: np.ndarray, out: np.ndarray,
+                             roi=None, batch_size=16):
+        """ Reads planes like read_planes, applying transforms instead of the ones set on the file. """
+        ix = np.asarray(ix)
+        roi = self._bounds_through(transforms, roi)
+        if transforms is None:
+            self._read_cached_planes(ix, out, roi=roi)
+            return
+        valid = np.flatnonzero(ix >= 0)
+        if len(valid) == 0:
+            return
+        first = self._plane(int(ix[valid[0]]), roi)
+        if transforms.output_dtype(first.dtype) == first.dtype == out.dtype:
+            self._read_cached_planes(ix, out, roi=roi)
+            for k in valid:
+                self._transform_through(transforms, int(ix[k]), out[k], roi, out=out[k])
+            return
+
+        self._transform_through(transforms, int(ix[valid[0]]), first, roi, out=out[valid[0]])
+        valid = valid[1:]
+        raw = np.zeros((min(batch_size, len(valid)), *first.shape), dtype=first.dtype)
+        for start in range(0, len(valid), batch_size):
+            batch = valid[start:start + batch_size]
+            self._read_cached_planes(ix[batch], raw, roi=roi)
+            for k, plane in zip(batch, raw):
+                self._transform_through(transforms, int(ix[k]), plane, roi, out=out[k])
+
+    def correct_photobleaching(self, tiles=(1, 1), n_workers: int = None, use_cache=True) -> PhotobleachCorrection:
+        """
+        Fits an exponential photobleaching model to the mean intensity over time of every channel, optionally split
+        into tiles=(rows, columns) regions of the field, and corrects planes from then on as they are read.
+        The fitted model is stored with the metadata index of the acquisition, so the data is read only once to fit it.
+        """
+        kind = f"photobleach-s{self._series}-{tiles[0]}x{tiles[1]}"
+        state = load_index(self.image_path, kind=kind) if use_cache else None
+        if state is not None:
+            correction = PhotobleachCorrection(**state)
+        else:
+            # fitted on the planes as they are in the file
+            transforms, self.transforms = self.transforms, None
+            try:
+                correction = self._fit_photobleaching(tiles, n_workers=n_workers)
+            finally:
+                self.transforms = transforms
+            save_index(self.image_path, self._source_files(), kind=kind,
+                       state={'params': correction.params, 'channels': correction.channels,
+                              'shape': correction.shape})
+        self.photobleach_correction = correction
+        return correction
+
+    def _fit_photobleaching(self, tiles, n_workers: int = None) -> PhotobleachCorrection:
+        frames, channels = list(self.frames), sorted(self.channels)
+        rows = self.planes.rows_grid(t=frames, c=channels, z=self.zstacks)[0]
+        flat = rows.ravel()
+        valid = np.flatnonzero(flat >= 0)
+        if len(valid) == 0:
+            raise FrameNotFoundError("none of the planes were found in the file.")
+
+        # mean intensity of every tile, averaged over the z-stack
+        sums = np.zeros((len(channels), len(frames), *tiles))
+        counts = np.zeros((len(channels), len(frames)))
+        shape = None
+        for k, img in zip(valid, self._iter_planes(flat[valid], n_workers=n_workers)):
+            t, c, _ = np.unravel_index(k, rows.shape)
+            sums[c, t] += tile_means(img, tiles)
+            counts[c, t] += 1
+            shape = img.shape
+
+        complete = np.all(counts > 0, axis=0)
+        means = sums[:, complete] / counts[:, complete, np.newaxis, np.newaxis]
+        y = means.transpose(0, 2, 3, 1).reshape(-1, np.count_nonzero(complete))
+        params = fit_photobleach(y, x=np.asarray(frames)[complete]).reshape(len(channels), *tiles, 3)
+        self.log.info(f"Photobleaching fitted on {np.count_nonzero(complete)} frames of {len(channels)} channels.")
+        return PhotobleachCorrection(params, channels, shape)
+
+    def intensity_limits(self, channel: int, percentiles: Tuple[float, float] = None,
+                         n_workers: int = None) -> Tuple[float, float]:
+        """
+        Intensity range of a channel over the whole series, either (min, max) or the given pair of percentiles.
+        Statistics are gathered in a single pass over the planes the first time they are needed, and kept for the
+        following calls. Percentiles are exact, and only available for integer data of up to 16 bits.
+        """
+        key = (self._series, channel, self.transforms)
+        if key not in self._intensity_stats:
+            self._intensity_stats[key] = self._intensity_histogram(channel, n_workers=n_workers)
+        histogram, offset, vmin, vmax = self._intensity_stats[key]
+        if histogram is None:
+            if percentiles is not None:
+                self.log.warning("Percentiles can't be computed on data that is not integer of up to 16 bits; "
+                                 "using the minimum and maximum instead.")
+            return vmin, vmax
+        return histogram_limits(histogram, percentiles=percentiles, offset=offset)
+
+    def _intensity_histogram(self, channel: int, n_workers: int = None) -> Tuple:
+        rows = self.planes.rows(c=channel)
+        if len(rows) == 0:
+            raise FrameNotFoundError(f"no planes of channel {channel} were found in the file.")
+        histogram, vmin, vmax, offset = None, np.inf, -np.inf, 0
+        for img in self._iter_planes(rows, n_workers=n_workers):
+            if img.dtype.kind in 'ui' and img.dtype.itemsize <= 2:
+                # counted on the unsigned view of the data; signed values are put in order below
+                counts = np.bincount(img.view(f"u{img.dtype.itemsize}").ravel(),
+                                     minlength=1 << (8 * img.dtype.itemsize))
+                histogram = counts if histogram is None else histogram + counts
+                offset = (len(histogram) // 2) if img.dtype.kind == 'i' else 0
+            else:
+                vmin, vmax = min(vmin, float(img.min())), max(vmax, float(img.max()))
+        if histogram is not None and offset:
+            histogram = np.roll(histogram, offset)
+        self.log.debug(f"Intensity statistics of channel {channel} gathered over {len(rows)} planes.")
+        return histogram, offset, vmin, vmax
+
+    def _limits_8bit(self, channels: Iterable[int], as_8bit) -> Dict[int, Tuple]:
+        """
+        Intensity limits of the 8 bit conversion of every channel. as_8bit is True (or 'plane') to stretch every
+        plane on its own, 'global' to use the range of the channel over the series, or 'percentile' to clip it to
+        contrast_percentiles.
+        """
+        if as_8bit is True or as_8bit == 'plane':
+            return {int(c): (None, None) for c in channels}
+        if as_8bit not in ('global', 'percentile'):
+            raise ValueError(f"Unknown 8 bit conversion {as_8bit}; use 'plane', 'global' or 'percentile'.")
+        percentiles = self.contrast_percentiles if as_8bit == 'percentile' else None
+        return {int(c): self.intensity_limits(int(c), percentiles=percentiles) for c in channels}
+
+    def _planes_to_8bit(self, ix: np.ndarray, planes: np.ndarray, out: np.ndarray, limits: Dict[int, Tuple]):
+        """ Converts the planes read from rows ix of the plane table into out; missing planes are left as they are. """
+        channels = self.planes.records['c']
+        for k in np.flatnonzero(ix >= 0):
+            to_8bit(planes[k], *limits[int(channels[ix[k]])], out=out[k])
 
     def image_series(self, channel='all', zstack='all', frame='all', as_8bit=False) -> MetadataImageSeries:
-        images = list()
         frames = self.frames if frame == 'all' else [frame]
         zstacks = self.zstacks if zstack == 'all' else [zstack]
         channels = self.channels if channel == 'all' else [channel]
 
-        for t in frames:
-            for zs in zstacks:
-                for ch in channels:
-                    ix = self.ix_at(ch, zs, t)
-                    plane = self.all_planes[ix]
-                    img = self._image(plane).image
-                    images.append(to_8bit(img) if as_8bit else img)
-        images = np.asarray(images).reshape((len(frames), len(zstacks), len(channels), *images[-1].shape))
+        # rows of the plane table in TZC order
+        ix = self.planes.rows_grid(t=frames, c=list(channels), z=zstacks)[0].transpose(0, 2, 1)
+        valid = np.flatnonzero(ix.ravel() >= 0)
+        if len(valid) == 0:
+            raise FrameNotFoundError("none of the requested planes were found in the file.")
+        if len(valid) < ix.size:
+            self.log.warning(f"{ix.size - len(valid)} planes were not found in the file; they will be left blank.")
+
+        # the first plane tells the format of the output, and then the remaining planes are read in one go
+        first = self.image(int(ix.flat[valid[0]])).image
+        images = np.zeros((*ix.shape, *first.shape), dtype=first.dtype)
+        flat_images = images.reshape((-1, *first.shape))
+        flat_images[valid[0]] = first
+        pending = ix.ravel().copy()
+        pending[valid[0]] = -1
+        self.read_planes(pending, flat_images)
+
+        if as_8bit:
+            images_8bit = np.zeros(images.shape, dtype=np.uint8)
+            self._planes_to_8bit(ix.ravel(), flat_images, images_8bit.reshape((-1, *first.shape)),
+                                 self._limits_8bit(channels, as_8bit))
+            images = images_8bit
+
         return MetadataImageSeries(reader="ImageFile",
                                    images=images, pix_per_um=self.pix_per_um, um_per_pix=self.um_per_pix,
                                    frames=len(frames), timestamps=len(frames),
                                    time_interval=None,  # self.time_interval,
                                    channels=len(channels),
                                    zstacks=len(zstacks), um_per_z=self.um_per_z,
-                                   width=self.width, height=self.height,
+                                   width=first.shape[1], height=first.shape[0],
                                    series=None, intensity_ranges=None,
                                    axes=["channel", "z", "time"])
 
-    def z_projection(self, frame: int, channel: int, projection='max', as_8bit=False):
-        self.log.debug(f"executing z-{projection}-projection of frame {frame} and channel {channel}")
+    def _iter_planes(self, ix: Iterable[int], n_workers: int = None,
+                     roi: Union[None, Bounds] = None) -> Iterator[np.ndarray]:
+        """
+        Reads the planes at rows ix of the plane table in order. With more than one worker, reads are spread over a
+        pool of threads while keeping only a few planes in flight.
+        """
+        n_workers = self.max_read_workers if n_workers is None else n_workers
+        if n_workers <= 1:
+            for i in ix:
+                yield self._read_plane(int(i), roi)
+            return
 
-        images = list()
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            in_flight = deque()
+            for i in ix:
+                in_flight.append(executor.submit(self._read_plane, int(i), roi))
+                if len(in_flight) >= 2 * n_workers:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
 
-        for zs in range(self.n_zstacks):
-            try:
-                if self.ix_at(channel, zs, frame) is not None:
-                    plane = self.plane_at(channel, zs, frame)
-                    img = self._image(plane).image
-                    images.append(to_8bit(img) if as_8bit else img)
-            except FrameNotFoundError as e:
-                self.log.error(f"image at t={frame} c={channel} z={zs} not found in file.")
-                raise e
-            except IndexError as e:
-                raise FrameNotFoundError(f"image not found in the file at t={frame} c={channel} z={zs}.")
-            except KeyError as e:
-                self.log.error(f"internal class error at t={frame} c={channel} z={zs}.")
-                raise e
-
-        if len(images) == 0:
+    def _z_planes(self, frame: int, channel: int) -> np.ndarray:
+        ix = self.planes.rows(t=frame, c=channel, z=range(self.n_zstacks))
+        if len(ix) == 0:
             self.log.error(f"not able to make a z-projection at t={frame} c={channel}.")
             raise FrameNotFoundError
+        return ix
 
-        im_vol = np.asarray(images).reshape((len(images), *images[-1].shape))
-        if projection == 'max':
-            im_proj = np.max(im_vol, axis=0)
-        else:
-            im_proj = np.zeros_like(images[0])
+    def _accumulate(self, ix: np.ndarray, accumulators: List[ProjectionAccumulator], slot: np.ndarray,
+                    as_8bit=False, n_workers: int = None, roi: Union[None, Bounds] = None):
+        """ Folds the planes at rows ix into accumulators[slot[k]] as they are read. """
+        z, c = self.planes.records['z'][ix], self.planes.records['c'][ix]
+        limits = self._limits_8bit(np.unique(c), as_8bit) if as_8bit else None
+        try:
+            for k, img in enumerate(self._iter_planes(ix, n_workers=n_workers, roi=roi)):
+                accumulators[slot[k]].add(to_8bit(img, *limits[int(c[k])]) if as_8bit else img, z=int(z[k]))
+        except IndexError as e:
+            raise FrameNotFoundError("image not found in the file.") from e
+
+    def z_projections(self, frame: int, channel: int, projections=PROJECTIONS, as_8bit=False,
+                      n_workers: int = None, roi=None) -> Dict[str, np.ndarray]:
+        """
+        Computes the requested projections (any of max, min, mean, sum, std and argmax) along the z axis
+        of one frame and channel in a single pass over the planes; with a region of interest, only that region of
+        the planes is read.
+        """
+        ix = self._z_planes(frame, channel)
+        acc = ProjectionAccumulator(projections)
+        self._accumulate(ix, [acc], np.zeros(len(ix), dtype=int), as_8bit=as_8bit, n_workers=n_workers,
+                         roi=self._read_bounds(roi))
+        return acc.results()
+
+    def z_projection(self, frame: int, channel: int, projection='max', as_8bit=False, n_workers: int = None,
+                     roi=None):
+        self.log.debug(f"executing z-{projection}-projection of frame {frame} and channel {channel}")
+
+        im_proj = self.z_projections(frame, channel, projections=(projection,), as_8bit=as_8bit,
+                                     n_workers=n_workers, roi=roi)[projection]
         return MetadataImage(reader='MaxProj',
                              image=im_proj,
                              pix_per_um=self.pix_per_um, um_per_pix=self.um_per_pix,
                              frame=frame, timestamp=None, time_interval=None,
                              channel=channel, z=None,
-                             width=self.width, height=self.height,
-                             intensity_range=[np.min(im_proj), np.max(im_proj)])
+                             width=im_proj.shape[1], height=im_proj.shape[0],
+                             intensity_range=self._intensity_range(im_proj))
+
+    def z_projection_series(self, channel: int, projection='max', frame='all', as_8bit=False,
+                            n_workers: int = None, roi=None) -> np.ndarray:
+        """
+        Projects along the z axis every frame of a channel as one job, streaming the planes of all frames through
+        the same pool of readers. Returns an array with one projected plane per frame.
+        """
+        frames = self.frames if frame == 'all' else list(frame)
+        ix = self.planes.rows_grid(t=frames, c=channel, z=range(self.n_zstacks))[0, :, 0, :]
+        found = ix >= 0
+        if not np.all(np.any(found, axis=1)):
+            missing = [f for f, ok in zip(frames, np.any(found, axis=1)) if not ok]
+            self.log.error(f"not able to make a z-projection of frames {missing} at c={channel}.")
+            raise FrameNotFoundError
+
+        accumulators = [ProjectionAccumulator((projection,)) for _ in frames]
+        slot = np.nonzero(found)[0]
+        self._accumulate(ix[found], accumulators, slot, as_8bit=as_8bit, n_workers=n_workers,
+                         roi=self._read_bounds(roi))
+        return np.stack([acc.result(projection) for acc in accumulators])
@@ -4,6 +4,7 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 
+from fileops.image._plane_table import PlaneTable
 from fileops.image.image_file import ImageFile
 from fileops.image.imagemeta import MetadataImage
 from fileops.loaders import load_tiff
@@ -27,8 +28,6 @@ class ImageJImageFile(ImageFile):
 
         self.md = self.md_xml = None
 
-        self.all_planes_md_dict = {}
-
         self._images = []
         self._nimgs = 0
         self._load_imageseries()
@@ -66,15 +65,9 @@ class ImageJImageFile(ImageFile):
 
         self._nimgs = tiff_series.channels * tiff_series.frames * tiff_series.zstacks
 
-        counter = 0
-        for c in self.channels:
-            for z in self.zstacks:
-                for t in self.frames:
-                    self.all_planes_md_dict[f"{int(c):0{len(str(self._md_n_channels))}d}"
-                                            f"{int(z):0{len(str(self._md_n_zstacks))}d}"
-                                            f"{int(t):0{len(str(self._md_n_frames))}d}"] = counter
-                    self.all_planes.append({"c": c, "t": t, "z": z})
-                    counter += 1
+        # planes are enumerated in channel, z and frame order
+        c, z, t = np.meshgrid(sorted(self.channels), self.zstacks, self.frames, indexing='ij')
+        self.planes = PlaneTable.from_columns(t=t.ravel(), c=c.ravel(), z=z.ravel())
 
         self.log.info(f"ImageJ tiff file loaded. "
                       f"Image size (WxH)=({self.width:d}x{self.height:d}); "
@@ -83,14 +76,16 @@ class ImageJImageFile(ImageFile):
                       f"{self._nimgs} image planes in total.")
         super()._load_imageseries()
 
-    def _image(self, plane, **kwargs) -> MetadataImage:
-        self.log.debug(f"Retrieving image of index={plane}")
+    def _image(self, ix, **kwargs) -> MetadataImage:
+        self.log.debug(f"Retrieving image of index={ix}")
 
-        image = self._images[plane["t"], plane["z"], plane["c"], :, :]
+        plane = self.planes[ix]
+        c, z, t = int(plane['c']), int(plane['z']), int(plane['t'])
+        image = self._images[t, z, c, :, :]
         return MetadataImage(reader='ImageJImageFile',
                              image=image,
                              pix_per_um=self.pix_per_um, um_per_pix=self.um_per_pix,
                              time_interval=None,
-                             timestamp=self.timestamps[plane["t"]],
-                             frame=plane["t"], channel=plane["c"], z=plane["z"], width=self.width, height=self.height,
-                             intensity_range=[np.min(image), np.max(image)])
+                             timestamp=self.timestamps[t],
+                             frame=t, channel=c, z=z, width=self.width, height=self.height,
+                             intensity_range=self._intensity_range(image))
@@ -1,4 +1,7 @@
 from collections import namedtuple
+from collections.abc import Sequence
+
+import numpy as np
 
 MetadataImage = namedtuple('MetadataImage', ['reader', 'image', 'pix_per_um', 'um_per_pix',
                                              'time_interval', 'frame', 'channel',
@@ -10,3 +13,33 @@ MetadataImageSeries = namedtuple('MetadataImageSeries', ['reader', 'images',
                                                          'time_interval', 'frames', 'channels',
                                                          'zstacks', 'width', 'height', 'series',
                                                          'timestamps', 'intensity_ranges', 'axes'])
+
+
+class IntensityRange(Sequence):
+    """ [min, max] intensity of an image, computed on first access. """
+    __slots__ = ('_image', '_range')
+
+    def __init__(self, image: np.ndarray):
+        self._image = image
+        self._range = None
+
+    def _evaluate(self):
+        if self._range is None:
+            self._range = [np.min(self._image), np.max(self._image)]
+            self._image = None
+        return self._range
+
+    def __getitem__(self, item):
+        return self._evaluate()[item]
+
+    def __len__(self):
+        return 2
+
+    def __eq__(self, other):
+        return self._evaluate() == list(other)
+
+    def __array__(self, dtype=None):
+        return np.array(self._evaluate(), dtype=dtype)
+
+    def __repr__(self):
+        return repr(self._evaluate())
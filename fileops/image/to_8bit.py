@@ -1,7 +1,74 @@
+from functools import lru_cache
+from typing import Tuple
+
 import numpy as np
 
+BLOCK_SIZE = 1 << 16  # pixels converted at a time for data types that don't fit in a lookup table
+
+
+@lru_cache(maxsize=64)
+def _lut(vmin: float, vmax: float, dtype: str) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    # indexed by the unsigned view of the data, so that signed values don't need an offset
+    values = np.arange(1 << (8 * dtype.itemsize), dtype=f"u{dtype.itemsize}").view(dtype).astype(np.float64)
+    lut = np.zeros(len(values), dtype=np.uint8)
+    if vmax > vmin:
+        lut[:] = np.clip((values - vmin) / (vmax - vmin) * 255, 0, 255)
+    lut.flags.writeable = False
+    return lut
+
+
+def lut_8bit(vmin: float, vmax: float, dtype=np.uint16) -> np.ndarray:
+    """
+    Read-only lookup table that maps the [vmin, vmax] range of an integer data type of up to 16 bits onto 0 - 255.
+    Tables are cached, so they are built once and shared by every caller and thread.
+    """
+    return _lut(float(vmin), float(vmax), np.dtype(dtype).str)
+
+
+def to_8bit(img: np.array, vmin: float = None, vmax: float = None, out: np.ndarray = None) -> np.array:
+    """
+    Converts an image to 8 bits, mapping the [vmin, vmax] range of intensities onto 0 - 255; by default the range
+    goes from 0 to the maximum of the image. Integer images of up to 16 bits are converted through a lookup table
+    (see lut_8bit), and the result is written into out if it's given.
+    """
+    vmin = 0 if vmin is None else vmin
+    vmax = img.max() if vmax is None else vmax
+    out = np.empty(img.shape, dtype=np.uint8) if out is None else out
+    if img.dtype.kind in 'ui' and img.dtype.itemsize <= 2:
+        np.take(lut_8bit(vmin, vmax, img.dtype), img.view(f"u{img.dtype.itemsize}"), out=out, mode='clip')
+        return out
+
+    # other data types are converted in blocks through a float32 buffer, into a contiguous copy of out if it isn't one
+    scale = 255 / (vmax - vmin) if vmax > vmin else 0.0
+    target = out if out.flags.c_contiguous else np.empty(out.shape, dtype=np.uint8)
+    flat, flat_out = img.reshape(-1), target.reshape(-1)
+    buffer = np.empty(min(BLOCK_SIZE, flat.size), dtype=np.float32)
+    for start in range(0, flat.size, BLOCK_SIZE):
+        block = buffer[:min(BLOCK_SIZE, flat.size - start)]
+        np.subtract(flat[start:start + len(block)], vmin, out=block, dtype=np.float32)
+        np.multiply(block, scale, out=block)
+        np.clip(block, 0, 255, out=block)
+        flat_out[start:start + len(block)] = block
+    if target is not out:
+        out[...] = target
+    return out
+
 
-def to_8bit(img: np.array) -> np.array:
-    img = img / img.max() * 255  # normalizes data in range 0 - 255
-    img = img.astype(np.uint8)
-    return img
+def histogram_limits(histogram: np.ndarray, percentiles: Tuple[float, float] = None,
+                     offset: int = 0) -> Tuple[float, float]:
+    """
+    Minimum and maximum, or the given pair of percentiles, of the values counted in a histogram whose bin i counts
+    the value i - offset. Percentiles are kept within the counted values, and fall back to the minimum and maximum
+    when they don't give a range; an empty histogram gives the whole range of its bins.
+    """
+    counted = np.flatnonzero(histogram)
+    if len(counted) == 0:
+        return float(-offset), float(len(histogram) - 1 - offset)
+    lo, hi = counted[0], counted[-1]
+    if percentiles is not None:
+        cdf = np.cumsum(histogram) / histogram.sum()
+        q_lo, q_hi = (np.clip(np.searchsorted(cdf, q / 100), lo, hi) for q in percentiles)
+        if q_lo < q_hi:
+            lo, hi = q_lo, q_hi
+    return float(lo - offset), float(hi - offset)
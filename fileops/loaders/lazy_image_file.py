@@ -1,71 +1,123 @@
+import threading
+import weakref
 from pathlib import Path
+from typing import Dict, Tuple, Union
 
 import dask
 import dask.array as da
 import numpy as np
 
 from fileops.image import ImageFile
-from fileops.image import to_8bit
 from fileops.image.imagemeta import MetadataImageSeries
 from fileops.logger import get_logger
 
+# image files reopened by worker processes, one per reader class, path, arguments and series
+_worker_files: Dict[Tuple, ImageFile] = dict()
+_worker_lock = threading.Lock()
+# bounds the threads reading each file at the same time to its max_read_workers, as some readers are not thread safe
+_read_slots: 'weakref.WeakKeyDictionary[ImageFile, threading.BoundedSemaphore]' = weakref.WeakKeyDictionary()
+
+
+def _read_slot(image_file: ImageFile) -> threading.BoundedSemaphore:
+    with _worker_lock:
+        if image_file not in _read_slots:
+            _read_slots[image_file] = threading.BoundedSemaphore(max(1, image_file.max_read_workers))
+        return _read_slots[image_file]
+
+
+class _BlockReader:
+    """
+    Reads blocks of planes of an image file through its batched plane reader.
+    Only the class, path, arguments and series of the file are pickled, so that worker processes of the dask
+    scheduler reopen the file once and reuse it for all the blocks they read. The series and transforms are the ones
+    of the file when the reader was made; transforms are applied by the reader, so files shared by readers of
+    different graphs are never modified.
+    """
+
+    def __init__(self, image_file: ImageFile, init_kwargs: Dict):
+        self._image_file = image_file
+        self._key = (type(image_file), Path(image_file.image_path), tuple(sorted(init_kwargs.items())),
+                     image_file._series)
+        self._transforms = image_file.transforms
+
+    def __getstate__(self):
+        return {'_key': self._key, '_transforms': self._transforms}
+
+    def __setstate__(self, state):
+        self._key = state['_key']
+        self._transforms = state['_transforms']
+        self._image_file = None
+
+    def _get_image_file(self) -> ImageFile:
+        if self._image_file is not None and self._image_file._series != self._key[3]:
+            # the series of the file was changed after the graph was built
+            self._image_file = None
+        if self._image_file is None:
+            with _worker_lock:
+                if self._key not in _worker_files:
+                    cls, path, kwargs, series = self._key
+                    _worker_files[self._key] = cls(path, **{**dict(kwargs), 'image_series': series})
+                self._image_file = _worker_files[self._key]
+        return self._image_file
+
+    def __call__(self, ix: np.ndarray, plane_shape: Tuple[int, ...], dtype: np.dtype,
+                 limits_8bit: Union[None, Dict[int, Tuple]]) -> np.ndarray:
+        image_file = self._get_image_file()
+        planes = np.zeros((ix.size, *plane_shape), dtype=dtype)
+        with _read_slot(image_file):
+            image_file._read_planes_through(self._transforms, ix.ravel(), planes)
+        if limits_8bit is not None:
+            planes_8bit = np.zeros(planes.shape, dtype=np.uint8)
+            image_file._planes_to_8bit(ix.ravel(), planes, planes_8bit, limits_8bit)
+            planes = planes_8bit
+        return planes.reshape((*ix.shape, *plane_shape))
+
 
 class LazyImageFile(ImageFile):
     log = get_logger(name='LazyImageFile')
 
     def __init__(self, image_path: Path, **kwargs):
+        self._init_kwargs = kwargs
         super(LazyImageFile, self).__init__(image_path, **kwargs)
 
-    def images(self, channel='all', zstack='all', frame='all', as_8bit=False) -> dask.array.Array:
-        series = [s.attrib['ID'] for s in self.all_series]
+    def images(self, channel='all', zstack='all', frame='all', as_8bit=False, chunks=(1, -1, 1)) -> dask.array.Array:
+        """
+        Lazy array of the planes of the current series with TZCYX axes.
+        Each chunk holds chunks=(frames, z-stacks, channels) planes (-1 takes the whole axis; a full z-stack by
+        default) and is read in one go through the batched plane reader, so the task graph grows with the number
+        of chunks rather than with the number of planes.
+        With as_8bit, planes are converted to 8 bits as they are read (see ImageFile._limits_8bit); the limits of the
+        'global' and 'percentile' conversions are computed once, before the array is built.
+        """
         frames = self.frames if frame == 'all' else [*frame]
         zstacks = self.zstacks if zstack == 'all' else [*zstack]
         channels = self.channels if channel == 'all' else [*channel]
 
-        @dask.delayed
-        def lazy_im(s, c, z, t):
-            if s != self.series_num:
-                self.series_num = s
-                self._load_imageseries()
-            try:
-                ix = self.ix_at(c, z, t)
-                img = to_8bit(self.image(ix).image) if as_8bit else self.image(ix).image
-
-                return img[np.newaxis, np.newaxis, np.newaxis, np.newaxis, :]
-            except Exception as e:
-                self.log.error(e)
-                return np.empty((self.width, self.height))[np.newaxis, np.newaxis, np.newaxis, np.newaxis, :]
+        # rows of the plane table in TZC order; planes that are missing in the file are read as blank
+        ix = self.planes.rows_grid(t=frames, c=list(channels), z=zstacks)[0].transpose(0, 2, 1)
+        chunks = tuple(n if k == -1 else k for k, n in zip(chunks, ix.shape))
 
         # get structure of first image to gather data type info
-        test_img = self.image(0).image
-
-        # Stack delayed images into one large dask.array
-        arr_t = list()
-        for t in frames:
-            arr_c = list()
-            for c in channels:
-                arr_z = list()
-                for z in zstacks:
-                    dask_z = da.stack([
-                        da.from_delayed(lazy_im(s, c, z, t),
-                                        shape=(1, 1, 1, 1, *test_img.shape,),
-                                        dtype=np.uint8 if as_8bit else test_img.dtype
-                                        )
-                        for s, _ in enumerate(series)], axis=0)
-                    arr_z.append(dask_z)
-                arr_c.append(da.stack(arr_z, axis=0))
-            arr_t.append(da.stack(arr_c, axis=0))
-        stack = da.stack(arr_t, axis=0)
-
-        return stack
-
-    def image_series(self, channel='all', zstack='all', frame='all', as_8bit=False) -> MetadataImageSeries:
-        stack = self.images(channel=channel, zstack=zstack, frame=frame, as_8bit=as_8bit)
+        test_img = self.image(int(ix[ix >= 0].flat[0])).image
+
+        limits_8bit = self._limits_8bit(channels, as_8bit) if as_8bit else None
+        reader = _BlockReader(self, self._init_kwargs)
+        return da.from_array(ix, chunks=chunks).map_blocks(
+            reader, test_img.shape, test_img.dtype, limits_8bit,
+            new_axis=list(range(3, 3 + test_img.ndim)),
+            chunks=da.core.normalize_chunks(chunks, ix.shape) + tuple((n,) for n in test_img.shape),
+            dtype=np.uint8 if as_8bit else test_img.dtype)
+
+    def image_series(self, channel='all', zstack='all', frame='all', as_8bit=False,
+                     chunks=(1, -1, 1)) -> MetadataImageSeries:
+        stack = self.images(channel=channel, zstack=zstack, frame=frame, as_8bit=as_8bit, chunks=chunks)
 
         return MetadataImageSeries(reader="tifffile",
                                    images=stack, pix_per_um=self.pix_per_um, um_per_pix=self.um_per_pix,
+                                   um_per_z=self.um_per_z,
                                    frames=stack.shape[0], timestamps=stack.shape[0],
                                    time_interval=self.time_interval,
                                    channels=stack.shape[2], zstacks=stack.shape[1],
                                    width=self.width, height=self.height,
-                                   series=None, intensity_ranges=None)
+                                   series=None, intensity_ranges=None,
+                                   axes=["time", "z", "channel"])
@@ -5,7 +5,7 @@ import os
 import numpy as np
 import tifffile as tf
 
-from fileops.image.imagemeta import MetadataImageSeries, MetadataImage
+from fileops.image.imagemeta import IntensityRange, MetadataImageSeries, MetadataImage
 
 logger = logging.getLogger(__name__)
 
@@ -77,5 +77,5 @@ def retrieve_image(md_img: MetadataImageSeries, frame=0, channel=0, z=0):
         time_interval=None, timestamp=None, frame=frame,
         channel=channel,
         z=z, width=md_img.width, height=md_img.height,
-        intensity_range=[image_arr[ix].min(), image_arr[ix].max()]
+        intensity_range=IntensityRange(image_arr[ix])
     )
@@ -1,8 +1,11 @@
 import os
 import argparse
 import logging
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import traceback
+from typing import Dict, Iterator, List, Tuple, Union
 
 import pandas as pd
 
@@ -15,54 +18,134 @@ from fileops.logger import get_logger, silence_loggers
 log = get_logger(name='summary')
 
 
-def process_dir(path) -> pd.DataFrame:
-    out = pd.DataFrame()
-    r = 1
-    files_visited = []
+def _silence_loggers():
     silence_loggers(loggers=["tifffile"], output_log_file="silenced.log")
+
+
+def _summarize_dir(root: str, filenames: List[str]) -> pd.DataFrame:
+    """ Summary of the acquisitions stored in the files of one folder. """
+    infos = list()
+    files_visited = set()
+    for filename in sorted(filenames):
+        joinf = 'No file specified yet'
+        try:
+            joinf = Path(root) / filename
+            log.info(f'Processing {joinf.as_posix()}')
+            if joinf not in files_visited:
+                img_struc = load_image_file(joinf)
+                if img_struc is None:
+                    continue
+                infos.append(img_struc.info)
+                files_visited.update(Path(root) / f for f in img_struc.files)
+                if type(img_struc) == MicroManagerFolderSeries:  # all files in the folder are of the same series
+                    break
+        except FileNotFoundError as e:
+            log.error(e)
+            log.warning(f'Data not found in folder {root}.')
+        except (IndexError, KeyError) as e:
+            log.error(e)
+            log.warning(f'Data index/key not found in file; perhaps the file is truncated? (in file {joinf}).')
+        except AssertionError as e:
+            log.error(f'Error trying to render images from folder {root}.')
+            log.error(e)
+        except BaseException as e:
+            log.error(e)
+            log.error(traceback.format_exc())
+            raise e
+
+    return pd.concat(infos, ignore_index=True) if infos else pd.DataFrame()
+
+
+def _walk(path) -> Iterator[Tuple[str, List[str]]]:
     for root, directories, filenames in os.walk(path):
-        for filename in filenames:
-            joinf = 'No file specified yet'
+        if filenames:
+            yield root, filenames
+
+
+def _read_progress(progress_file: Path) -> Tuple[Dict[str, pd.DataFrame], int]:
+    """
+    Summaries of the folders processed in a previous run, indexed by folder, and the size of the file up to the last
+    complete entry.
+    """
+    done = dict()
+    size = 0
+    if not progress_file.exists():
+        return done, size
+    with open(progress_file, 'rb') as f:
+        while True:
             try:
-                joinf = Path(root) / filename
-                log.info(f'Processing {joinf.as_posix()}')
-                if joinf not in files_visited:
-                    img_struc = load_image_file(joinf)
-                    if img_struc is None:
-                        continue
-                    out = pd.concat([out, img_struc.info], ignore_index=True)
-                    files_visited.extend([Path(root) / f for f in img_struc.files])
-                    r += 1
-                    if type(img_struc) == MicroManagerFolderSeries:  # all files in the folder are of the same series
-                        break
-            except FileNotFoundError as e:
-                log.error(e)
-                log.warning(f'Data not found in folder {root}.')
-            except (IndexError, KeyError) as e:
-                log.error(e)
-                log.warning(f'Data index/key not found in file; perhaps the file is truncated? (in file {joinf}).')
-            except AssertionError as e:
-                log.error(f'Error trying to render images from folder {root}.')
-                log.error(e)
-            except BaseException as e:
-                log.error(e)
-                log.error(traceback.format_exc())
-                raise e
-
-    return out
+                folder, df = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                # end of the file, or the entry being written when the run was interrupted
+                break
+            done[folder] = df
+            size = f.tell()
+    return done, size
+
+
+def process_dir(path, n_workers: int = None, progress_file: Union[None, str, Path] = None) -> pd.DataFrame:
+    """
+    Summarizes all the acquisitions found recursively in path.
+    Folders are distributed over a pool of n_workers processes (all CPUs by default; 1 runs in this process).
+    If progress_file is given, the summary of each folder is appended to it as soon as the folder is done, and folders
+    already in the file are skipped; an interrupted run is resumed by calling again with the same file.
+    """
+    _silence_loggers()
+    summaries = list()
+    done = dict()
+    progress = None
+    if progress_file is not None:
+        progress_file = Path(progress_file)
+        done, size = _read_progress(progress_file)
+        if done:
+            log.info(f'Resuming summary; {len(done)} folders were already processed.')
+        summaries.extend(done.values())
+        ensure_dir(progress_file.parent)
+        progress = open(progress_file, 'ab')
+        # drop an incomplete entry at the end, so the new ones can be read back
+        progress.truncate(size)
+
+    def _collect(root: str, df: pd.DataFrame):
+        summaries.append(df)
+        if progress is not None:
+            # dataframes are pickled so that the column types are kept when resuming
+            pickle.dump((root, df), progress)
+            progress.flush()
+
+    try:
+        pending = ((root, filenames) for root, filenames in _walk(path) if root not in done)
+        if n_workers == 1:
+            for root, filenames in pending:
+                _collect(root, _summarize_dir(root, filenames))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_silence_loggers) as executor:
+                futures = {executor.submit(_summarize_dir, root, filenames): root for root, filenames in pending}
+                for future in as_completed(futures):
+                    _collect(futures[future], future.result())
+    finally:
+        if progress is not None:
+            progress.close()
+
+    summaries = [df for df in summaries if not df.empty]
+    return pd.concat(summaries, ignore_index=True) if summaries else pd.DataFrame()
 
 
 if __name__ == '__main__':
     description = 'Generate pandas dataframe summary of microscope images stored in the specified path (recursively).'
     epilogue = '''
-    The outputs are two files in Excel and comma separated values (CSV) formats, i.e., summary.xlsx and summary.csv.
+    The output is an Excel file, summary-new.xlsx. Use --progress to keep the rows of every processed folder in a
+    file, which allows an interrupted run to be resumed.
     '''
     parser = argparse.ArgumentParser(description=description, epilog=epilogue,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('path', help='Path where to start the search.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes that summarize folders in parallel (all CPUs by default).')
+    parser.add_argument('--progress', default=None,
+                        help='File where the summary of each folder is appended as it finishes.')
     args = parser.parse_args()
     # ensure_dir(os.path.abspath(args.out))
 
-    df = process_dir(args.path)
+    df = process_dir(args.path, n_workers=args.workers, progress_file=args.progress)
     df.to_excel('summary-new.xlsx', index=False)
     print(df)
@@ -0,0 +1,39 @@
+import functools
+import subprocess
+import sys
+
+from fileops.cached import cached_step
+from fileops.cached.intermediate_step import step_key
+
+
+class Scaled:
+    def __init__(self, factor):
+        self.factor = factor
+
+    def scale(self, x=1):
+        return self.factor * x
+
+
+def add(x, y):
+    return x + y
+
+
+def test_bound_methods_are_keyed_by_their_object(tmp_path):
+    assert cached_step("a", Scaled(1).scale, cache_folder=tmp_path) == 1
+    assert cached_step("a", Scaled(2).scale, cache_folder=tmp_path) == 2
+    assert step_key(Scaled(3).scale, (), {}) == step_key(Scaled(3).scale, (), {})
+
+
+def test_partial_functions_are_keyed_by_their_arguments(tmp_path):
+    assert cached_step("p", functools.partial(add, 1), 10, cache_folder=tmp_path) == 11
+    assert cached_step("p", functools.partial(add, 2), 10, cache_folder=tmp_path) == 12
+    assert step_key(functools.partial(add, 1), (10,), {}) != step_key(functools.partial(add, y=1), (10,), {})
+
+
+def test_partial_function_keys_are_stable_across_processes():
+    script = ("import functools, importlib, sys; sys.path[:0] = %r; add = importlib.import_module(%r).add; "
+              "from fileops.cached.intermediate_step import step_key; "
+              "print(step_key(functools.partial(add, 1), (10,), {}))" % (sys.path, add.__module__))
+    keys = {subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout.split()[0]
+            for _ in range(2)}
+    assert keys == {step_key(functools.partial(add, 1), (10,), {})}
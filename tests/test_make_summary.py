@@ -0,0 +1,28 @@
+import pickle
+
+import pandas as pd
+
+from fileops.scripts.make_summary import _read_progress, process_dir
+
+
+def test_resume_keeps_column_types(tmp_path):
+    (tmp_path / "done").mkdir()
+    (tmp_path / "done" / "img.tif").touch()
+    (tmp_path / "new").mkdir()
+    (tmp_path / "new" / "notes.txt").touch()
+    summary = pd.DataFrame({'filename': ['img.tif'], 'channels': [2], 'um_per_pix': [0.1],
+                            'acquisition_date': [pd.Timestamp('2021-03-04 10:20')]})
+    progress_file = tmp_path / "progress" / "summary.pkl"
+    progress_file.parent.mkdir()
+    with open(progress_file, 'wb') as f:
+        pickle.dump((str(tmp_path / "done"), summary), f)
+        size = f.tell()
+        f.write(pickle.dumps((str(tmp_path / "new"), summary))[:-10])  # interrupted while writing
+
+    assert _read_progress(progress_file)[1] == size
+    df = process_dir(tmp_path, n_workers=1, progress_file=progress_file)
+    pd.testing.assert_frame_equal(df, summary)
+
+    done, _ = _read_progress(progress_file)
+    assert set(done) == {str(tmp_path / f) for f in ("done", "new", "progress")}
+    pd.testing.assert_frame_equal(done[str(tmp_path / "done")], summary)
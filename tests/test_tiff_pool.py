@@ -0,0 +1,26 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile as tf
+
+from fileops.image._tiff_pool import TiffFilePool
+
+
+def test_concurrent_acquire_opens_one_handle(tmp_path):
+    path = tmp_path / "img.tif"
+    tf.imwrite(path, np.arange(64, dtype=np.uint16).reshape(8, 8))
+    pool = TiffFilePool()
+    barrier = threading.Barrier(8)
+
+    def read(_):
+        barrier.wait()
+        with pool.acquire(path) as tif:
+            return tif.asarray().sum()
+
+    with ThreadPoolExecutor(8) as ex:
+        assert set(ex.map(read, range(8))) == {np.arange(64).sum()}
+    assert pool.n_open == 1
+    assert pool.stats['opens'] == 1 and pool.stats['hits'] == 7
+    pool.close()
+    assert pool.n_open == 0
@@ -0,0 +1,54 @@
+import numpy as np
+
+from fileops.image.to_8bit import histogram_limits, to_8bit
+
+
+def _histogram(values, n_bins=1 << 16):
+    return np.bincount(np.asarray(values, dtype=np.int64), minlength=n_bins)
+
+
+def test_histogram_limits_min_max():
+    assert histogram_limits(_histogram([5, 9, 300])) == (5.0, 300.0)
+
+
+def test_histogram_limits_empty_histogram():
+    # an empty region of interest, or planes that are all NaN
+    vmin, vmax = histogram_limits(np.zeros(1 << 16, dtype=np.int64), percentiles=(1, 99))
+    assert vmin < vmax
+    assert histogram_limits(np.zeros(256, dtype=np.int64), offset=128) == (-128.0, 127.0)
+
+
+def test_histogram_limits_percentile_bounds():
+    histogram = _histogram(np.arange(100, 200))
+    assert histogram_limits(histogram, percentiles=(0, 100)) == (100.0, 199.0)
+    vmin, vmax = histogram_limits(histogram, percentiles=(10, 90))
+    assert 100 < vmin < vmax < 199
+
+
+def test_histogram_limits_inverted_percentiles():
+    # most of the values in one bin make both percentiles fall on it
+    histogram = _histogram([7] * 1000 + [3, 2000])
+    assert histogram_limits(histogram, percentiles=(1, 99)) == (3.0, 2000.0)
+
+
+def test_histogram_limits_constant_image():
+    vmin, vmax = histogram_limits(_histogram([42] * 10), percentiles=(1, 99))
+    assert (vmin, vmax) == (42.0, 42.0)
+    assert not np.any(to_8bit(np.full((4, 4), 42, dtype=np.uint16), vmin, vmax))
+
+
+def test_histogram_limits_offset():
+    values = np.array([-5, 0, 10], dtype=np.int16)
+    offset = 1 << 15
+    assert histogram_limits(_histogram(values.astype(np.int64) + offset), offset=offset) == (-5.0, 10.0)
+
+
+def test_to_8bit_into_non_contiguous_out():
+    img = np.linspace(0, 1, 6 * 5, dtype=np.float32).reshape(6, 5)
+    big = np.zeros((12, 5), dtype=np.uint8)
+    to_8bit(img, 0, 1, out=big[::2])
+    assert np.array_equal(big[::2], to_8bit(img, 0, 1))
+    assert not np.any(big[1::2])
+    big[:] = 0
+    to_8bit((img * 1000).astype(np.uint16), 0, 1000, out=big[::2])
+    assert np.array_equal(big[::2], to_8bit((img * 1000).astype(np.uint16), 0, 1000))